@@ -10,7 +10,8 @@ ptype = {'scipy': ScipyParticle, 'jit': JITParticle}
 
 def two_dim_brownian_flat(particle, grid, time, dt):
     # Kernel for simple Brownian particle diffusion in zonal and meridional direction.
-    # Seed is called on first call only, when time is zero
+    # Seed is called on first call only, when time is zero. With random_streams,
+    # draws are keyed on the seed, particle ID and time, independent of particle order
 
     if time == 0:
         random.seed(grid.seedval)
@@ -50,7 +51,7 @@ def test_brownian_example(mode, npart=3000):
     dt = delta(minutes=5)
     interval = delta(hours=1)
 
-    k_brownian = pset.Kernel(two_dim_brownian_flat)
+    k_brownian = pset.Kernel(two_dim_brownian_flat, random_streams=True)
 
     pset.execute(k_brownian, endtime=endtime, dt=dt, interval=interval,
                  output_file=pset.ParticleFile(name="BrownianParticle"),
@@ -1,5 +1,7 @@
 #include <stdio.h>
 #include <stdlib.h>
+#include <stdint.h>
+#include <string.h>
 #include <math.h>
 
 typedef enum
@@ -14,21 +16,107 @@ typedef enum
 
 #define CHECKERROR(res) do {if (res != SUCCESS) return res;} while (0)
 
+/* Counters of instrumented kernels, which are compiled with PARCELS_INSTRUMENT
+   defined. Every kernel library holds its own instance of the counters. */
 typedef struct
 {
-  int xdim, ydim, tdim, tidx, allow_time_extrapolation;
-  float *lon, *lat;
+  long long particles, iterations, interpolations, searches, search_steps;
+  long long errors[6];
+} ParcelsStats;
+
+#ifdef PARCELS_INSTRUMENT
+static ParcelsStats parcels_stats;
+#define PARCELS_COUNT(counter, n) (parcels_stats.counter += (n))
+#else
+#define PARCELS_COUNT(counter, n) do {} while (0)
+#endif
+
+/* Fields on periodic domains have a positive lon_period and/or lat_period,
+   with the period in the units of lon and lat, and are 0 otherwise.
+   Surface fields have a single depth level (zdim = 1). */
+typedef struct
+{
+  int xdim, ydim, zdim, tdim, tidx, allow_time_extrapolation;
+  double lon_period, lat_period;
+  float *lon, *lat, *depth;
   double *time;
   float ***data;
 } CField;
 
+/* Corner indices and coordinates of a grid cell, and the weight of
+   the lower level k1 for interpolation in the vertical */
+typedef struct
+{
+  int i0, i1, j0, j1, k0, k1;
+  double x0, x1, y0, y1, wz;
+} CCell;
+
 
 /* Local linear search to update grid index */
-static inline ErrorCode search_linear_float(float x, int size, float *xvals, int *index)
+static inline ErrorCode search_linear_float(double x, int size, float *xvals, int *index)
 {
+  PARCELS_COUNT(searches, 1);
   if (x < xvals[0] || xvals[size-1] < x) {return ERROR_OUT_OF_BOUNDS;}
-  while (*index < size-1 && x > xvals[*index+1]) ++(*index);
-  while (*index > 0 && x < xvals[*index]) --(*index);
+  /* The last grid point is the upper corner of the last cell */
+  if (*index > size-2 && size > 1) {*index = size-2;}
+  while (*index < size-1 && x > xvals[*index+1]) {++(*index); PARCELS_COUNT(search_steps, 1);}
+  while (*index > 0 && x < xvals[*index]) {--(*index); PARCELS_COUNT(search_steps, 1);}
+  return SUCCESS;
+}
+
+/* Map x into [x0, x0 + period) if the axis is periodic */
+static inline double wrap_periodic(double x, double x0, double period)
+{
+  return (period > 0.) ? x - period * floor((x - x0) / period) : x;
+}
+
+/* Local linear search to update grid index on an axis that is periodic if
+   period > 0. The last cell of a periodic axis, with index size-1, connects
+   xvals[size-1] to xvals[0] + period. */
+static inline ErrorCode search_periodic_float(double x, int size, float *xvals, double period, int *index)
+{
+  if (period > 0.) {
+    x = wrap_periodic(x, xvals[0], period);
+    /* Avoid searching through the whole axis when crossing the boundary */
+    if (x >= xvals[size-1]) {PARCELS_COUNT(searches, 1); *index = size-1; return SUCCESS;}
+    if (x < xvals[1]) {PARCELS_COUNT(searches, 1); *index = 0; return SUCCESS;}
+  }
+  return search_linear_float(x, size, xvals, index);
+}
+
+/* Local linear search to update depth index. Fields with a single
+   depth level are sampled at that level for all depths, and positions
+   above the top level, such as the default depth 0, at the top level. */
+static inline ErrorCode search_depth(double z, int size, float *zvals, int *index)
+{
+  if (size == 1 || z < zvals[0]) {*index = 0; return SUCCESS;}
+  return search_linear_float(z, size, zvals, index);
+}
+
+/* Find the grid cell that contains (x, y, z), starting from indices (xi, yi, zi),
+   and map x and y into the domain on periodic axes */
+static inline ErrorCode search_cell(double *x, double *y, double z, int xi, int yi, int zi,
+                                    CField *f, CCell *c)
+{
+  ErrorCode err;
+  c->i0 = xi; c->j0 = yi; c->k0 = zi;
+  err = search_periodic_float(*x, f->xdim, f->lon, f->lon_period, &(c->i0)); CHECKERROR(err);
+  err = search_periodic_float(*y, f->ydim, f->lat, f->lat_period, &(c->j0)); CHECKERROR(err);
+  err = search_depth(z, f->zdim, f->depth, &(c->k0)); CHECKERROR(err);
+  if (z < f->depth[0]) {z = f->depth[0];}
+  *x = wrap_periodic(*x, f->lon[0], f->lon_period);
+  *y = wrap_periodic(*y, f->lat[0], f->lat_period);
+  c->x0 = f->lon[c->i0]; c->y0 = f->lat[c->j0];
+  if (c->i0 < f->xdim-1) {c->i1 = c->i0 + 1; c->x1 = f->lon[c->i1];}
+  else {c->i1 = 0; c->x1 = f->lon[0] + f->lon_period;}
+  if (c->j0 < f->ydim-1) {c->j1 = c->j0 + 1; c->y1 = f->lat[c->j1];}
+  else {c->j1 = 0; c->y1 = f->lat[0] + f->lat_period;}
+  if (f->zdim > 1) {
+    c->k1 = c->k0 + 1;
+    c->wz = (z - f->depth[c->k0]) / (f->depth[c->k1] - f->depth[c->k0]);
+  } else {
+    c->k1 = c->k0; c->wz = 0.;
+  }
   return SUCCESS;
 }
 
@@ -41,48 +129,70 @@ static inline ErrorCode search_linear_double(double t, int size, double *tvals,
 }
 
 /* Bilinear interpolation routine for 2D grid */
-static inline ErrorCode spatial_interpolation_bilinear(float x, float y, int i, int j, int xdim,
-                                                       float *lon, float *lat, float **f_data,
-                                                       float *value)
+static inline ErrorCode spatial_interpolation_bilinear(double x, double y, CCell *c, int xdim,
+                                                       float **f_data, double *value)
 {
   /* Cast data array into data[lat][lon] as per NEMO convention */
   float (*data)[xdim] = (float (*)[xdim]) f_data;
-  *value = (data[j][i] * (lon[i+1] - x) * (lat[j+1] - y)
-            + data[j][i+1] * (x - lon[i]) * (lat[j+1] - y)
-            + data[j+1][i] * (lon[i+1] - x) * (y - lat[j])
-            + data[j+1][i+1] * (x - lon[i]) * (y - lat[j]))
-            / ((lon[i+1] - lon[i]) * (lat[j+1] - lat[j]));
+  *value = (data[c->j0][c->i0] * (c->x1 - x) * (c->y1 - y)
+            + data[c->j0][c->i1] * (x - c->x0) * (c->y1 - y)
+            + data[c->j1][c->i0] * (c->x1 - x) * (y - c->y0)
+            + data[c->j1][c->i1] * (x - c->x0) * (y - c->y0))
+            / ((c->x1 - c->x0) * (c->y1 - c->y0));
   return SUCCESS;
 }
 
 /* Nearest neighbour interpolation routine for 2D grid */
-static inline ErrorCode spatial_interpolation_nearest2D(float x, float y, int i, int j, int xdim,
-                                                        float *lon, float *lat, float **f_data,
-                                                        float *value)
+static inline ErrorCode spatial_interpolation_nearest2D(double x, double y, CCell *c, int xdim,
+                                                        float **f_data, double *value)
 {
   /* Cast data array into data[lat][lon] as per NEMO convention */
   float (*data)[xdim] = (float (*)[xdim]) f_data;
   int ii, jj;
-  if (x - lon[i] < lon[i+1] - x) {ii = i;} else {ii = i + 1;}
-  if (y - lat[j] < lat[j+1] - y) {jj = j;} else {jj = j + 1;}
+  if (x - c->x0 < c->x1 - x) {ii = c->i0;} else {ii = c->i1;}
+  if (y - c->y0 < c->y1 - y) {jj = c->j0;} else {jj = c->j1;}
   *value = data[jj][ii];
   return SUCCESS;
 }
 
+/* Spatial interpolation on the levels of a 3D grid: trilinear interpolation
+   only reads the two levels around the particle, and a single level if the
+   particle is on it, and nearest neighbour interpolation the nearest level */
+static inline ErrorCode spatial_interpolation_3D(double x, double y, CCell *c, int xdim, int ydim,
+                                                 float **f_data, int interp_method, double *value)
+{
+  /* Cast data array into data[depth][lat][lon] as per NEMO convention */
+  float (*data)[ydim][xdim] = (float (*)[ydim][xdim]) f_data;
+  double f1;
+  if (interp_method == LINEAR){
+    spatial_interpolation_bilinear(x, y, c, xdim, (float**)(data[c->k0]), value);
+    if (c->wz > 0.) {
+      spatial_interpolation_bilinear(x, y, c, xdim, (float**)(data[c->k1]), &f1);
+      *value += (f1 - *value) * c->wz;
+    }
+  }
+  else if (interp_method == NEAREST){
+    spatial_interpolation_nearest2D(x, y, c, xdim, (float**)(data[c->wz < .5 ? c->k0 : c->k1]), value);
+  }
+  else {
+    return ERROR;
+  }
+  return SUCCESS;
+}
+
 /* Linear interpolation along the time axis */
-static inline ErrorCode temporal_interpolation_linear(float x, float y, int xi, int yi,
-                                                      double time, CField *f, float *value,
+static inline ErrorCode temporal_interpolation_linear(double x, double y, double z, int xi, int yi,
+                                                      int zi, double time, CField *f, double *value,
                                                       int interp_method)
 {
   ErrorCode err;
-  /* Cast data array intp data[time][lat][lon] as per NEMO convention */
-  float (*data)[f->ydim][f->xdim] = (float (*)[f->ydim][f->xdim]) f->data;
-  float f0, f1;
-  double t0, t1;
-  int i = xi, j = yi;
+  /* Cast data array into data[time][depth][lat][lon] as per NEMO convention */
+  float (*data)[f->zdim][f->ydim][f->xdim] = (float (*)[f->zdim][f->ydim][f->xdim]) f->data;
+  double f0, f1, t0, t1;
+  CCell c;
+  PARCELS_COUNT(interpolations, 1);
   /* Identify grid cell to sample through local linear search */
-  err = search_linear_float(x, f->xdim, f->lon, &i); CHECKERROR(err);
-  err = search_linear_float(y, f->ydim, f->lat, &j); CHECKERROR(err);
+  err = search_cell(&x, &y, z, xi, yi, zi, f, &c); CHECKERROR(err);
   /* Find time index for temporal interpolation */
   if (f->allow_time_extrapolation == 0 && (time < f->time[0] || time > f->time[f->tdim-1])){
     return ERROR_TIME_EXTRAPOLATION;
@@ -90,46 +200,104 @@ static inline ErrorCode temporal_interpolation_linear(float x, float y, int xi,
   err = search_linear_double(time, f->tdim, f->time, &(f->tidx));
   if (f->tidx < f->tdim-1 && time > f->time[f->tidx]) {
     t0 = f->time[f->tidx]; t1 = f->time[f->tidx+1];
-    if (interp_method == LINEAR){
-      err = spatial_interpolation_bilinear(x, y, i, j, f->xdim, f->lon, f->lat,
-                                          (float**)(data[f->tidx]), &f0);
-      err = spatial_interpolation_bilinear(x, y, i, j, f->xdim, f->lon, f->lat,
-                                          (float**)(data[f->tidx+1]), &f1);
-    }
-    else if  (interp_method == NEAREST){
-      err = spatial_interpolation_nearest2D(x, y, i, j, f->xdim, f->lon, f->lat,
-                                           (float**)(data[f->tidx]), &f0);
-      err = spatial_interpolation_nearest2D(x, y, i, j, f->xdim, f->lon, f->lat,
-                                           (float**)(data[f->tidx+1]), &f1);
-    }
-    else {
-        return ERROR;
-    }
-    *value = f0 + (f1 - f0) * (float)((time - t0) / (t1 - t0));
+    err = spatial_interpolation_3D(x, y, &c, f->xdim, f->ydim, (float**)(data[f->tidx]),
+                                   interp_method, &f0); CHECKERROR(err);
+    err = spatial_interpolation_3D(x, y, &c, f->xdim, f->ydim, (float**)(data[f->tidx+1]),
+                                   interp_method, &f1); CHECKERROR(err);
+    *value = f0 + (f1 - f0) * ((time - t0) / (t1 - t0));
     return SUCCESS;
   } else {
-    if (interp_method == LINEAR){
-      err = spatial_interpolation_bilinear(x, y, i, j, f->xdim, f->lon, f->lat,
-                                          (float**)(data[f->tidx]), value);
-    }
-    else if (interp_method == NEAREST){
-      err = spatial_interpolation_nearest2D(x, y, i, j, f->xdim, f->lon, f->lat,
-                                           (float**)(data[f->tidx]), value);
-    }
-    else {
-        return ERROR;    
+    return spatial_interpolation_3D(x, y, &c, f->xdim, f->ydim, (float**)(data[f->tidx]),
+                                    interp_method, value);
+  }
+}
+
+/* Interpolation of two fields on the same grid, such as the U and V components
+   of velocity, re-using the cell search and the spatial interpolation weights */
+static inline double weighted_sample(double w00, double w01, double w10, double w11,
+                                     CCell *c, int xdim, int ydim, float **f_data)
+{
+  /* Cast data array into data[depth][lat][lon] as per NEMO convention */
+  float (*data)[ydim][xdim] = (float (*)[ydim][xdim]) f_data;
+  double value;
+  value = w00 * data[c->k0][c->j0][c->i0] + w01 * data[c->k0][c->j0][c->i1]
+    + w10 * data[c->k0][c->j1][c->i0] + w11 * data[c->k0][c->j1][c->i1];
+  if (c->wz > 0.) {
+    value += (w00 * data[c->k1][c->j0][c->i0] + w01 * data[c->k1][c->j0][c->i1]
+              + w10 * data[c->k1][c->j1][c->i0] + w11 * data[c->k1][c->j1][c->i1] - value) * c->wz;
+  }
+  return value;
+}
+
+static inline ErrorCode temporal_interpolation_linear_uv(double x, double y, double z, int xi, int yi,
+                                                         int zi, double time, CField *U, CField *V,
+                                                         double *u, double *v, int interp_method)
+{
+  ErrorCode err;
+  /* Cast data arrays into data[time][depth][lat][lon] as per NEMO convention */
+  float (*udata)[U->zdim][U->ydim][U->xdim] = (float (*)[U->zdim][U->ydim][U->xdim]) U->data;
+  float (*vdata)[V->zdim][V->ydim][V->xdim] = (float (*)[V->zdim][V->ydim][V->xdim]) V->data;
+  double w00 = 0., w01 = 0., w10 = 0., w11 = 0., area, tw, u1, v1;
+  int t;
+  CCell c;
+  PARCELS_COUNT(interpolations, 1);
+  /* Identify grid cell to sample through local linear search */
+  err = search_cell(&x, &y, z, xi, yi, zi, U, &c); CHECKERROR(err);
+  /* Find time index for temporal interpolation */
+  if (U->allow_time_extrapolation == 0 && (time < U->time[0] || time > U->time[U->tdim-1])){
+    return ERROR_TIME_EXTRAPOLATION;
+  }
+  err = search_linear_double(time, U->tdim, U->time, &(U->tidx));
+  t = U->tidx;
+  if (interp_method == LINEAR){
+    area = (c.x1 - c.x0) * (c.y1 - c.y0);
+    w00 = (c.x1 - x) * (c.y1 - y) / area;
+    w01 = (x - c.x0) * (c.y1 - y) / area;
+    w10 = (c.x1 - x) * (y - c.y0) / area;
+    w11 = (x - c.x0) * (y - c.y0) / area;
+  }
+  else if (interp_method == NEAREST){
+    if (x - c.x0 < c.x1 - x) {
+      if (y - c.y0 < c.y1 - y) {w00 = 1.;} else {w10 = 1.;}
+    } else {
+      if (y - c.y0 < c.y1 - y) {w01 = 1.;} else {w11 = 1.;}
     }
-    return SUCCESS;
+    /* Sample the nearest level only */
+    if (c.wz >= .5) {c.k0 = c.k1;}
+    c.wz = 0.;
+  }
+  else {
+    return ERROR;
+  }
+  *u = weighted_sample(w00, w01, w10, w11, &c, U->xdim, U->ydim, (float**)(udata[t]));
+  *v = weighted_sample(w00, w01, w10, w11, &c, V->xdim, V->ydim, (float**)(vdata[t]));
+  if (t < U->tdim-1 && time > U->time[t]) {
+    tw = (time - U->time[t]) / (U->time[t+1] - U->time[t]);
+    u1 = weighted_sample(w00, w01, w10, w11, &c, U->xdim, U->ydim, (float**)(udata[t+1]));
+    v1 = weighted_sample(w00, w01, w10, w11, &c, V->xdim, V->ydim, (float**)(vdata[t+1]));
+    *u += (u1 - *u) * tw;
+    *v += (v1 - *v) * tw;
   }
+  return SUCCESS;
 }
 
 /**************************************************/
 /*   Random number generation (RNG) functions     */
 /**************************************************/
 
+/* Second variate of the last Box-Muller transform, see parcels_normalvariate */
+static float parcels_normal_spare;
+static int parcels_normal_has_spare = 0;
+
+static void parcels_reset_normalvariate()
+{
+  parcels_normal_has_spare = 0;
+}
+
 static void parcels_seed(int seed)
 {
   srand(seed);
+  parcels_reset_normalvariate();
 }
 
 static inline float parcels_random()
@@ -149,21 +317,114 @@ static inline int parcels_randint(int low, int high)
 
 static inline float parcels_normalvariate(float loc, float scale)
 /* Function to create a Gaussian random variable with mean loc and standard deviation scale */
-/* Uses Box-Muller transform, adapted from ftp://ftp.taygeta.com/pub/c/boxmuller.c          */
-/*     (c) Copyright 1994, Everett F. Carter Jr. Permission is granted by the author to use */
-/*     this software for any application provided this copyright notice is preserved.       */
-{
-  float x1, x2, w, y1;
-  static float y2;
-
-  do {
-    x1 = 2.0 * (float)rand()/(float)(RAND_MAX) - 1.0;
-    x2 = 2.0 * (float)rand()/(float)(RAND_MAX) - 1.0;
-    w = x1 * x1 + x2 * x2;
-  } while ( w >= 1.0 );
-
-  w = sqrt( (-2.0 * log( w ) ) / w );
-  y1 = x1 * w;
-  y2 = x2 * w;
-  return( loc + y1 * scale );
+/* Uses the Box-Muller transform, which yields two independent variates from two uniform    */
+/* draws without rejection; the second variate is cached for the next call.                 */
+{
+  double u1, u2, r;
+  if (parcels_normal_has_spare) {
+    parcels_normal_has_spare = 0;
+    return loc + parcels_normal_spare * scale;
+  }
+  /* u1 in (0, 1] to avoid log(0) */
+  u1 = ((double)rand() + 1.) / ((double)RAND_MAX + 1.);
+  u2 = (double)rand() / ((double)RAND_MAX + 1.);
+  r = sqrt(-2. * log(u1));
+  parcels_normal_spare = (float)(r * sin(2. * M_PI * u2));
+  parcels_normal_has_spare = 1;
+  return loc + (float)(r * cos(2. * M_PI * u2)) * scale;
+}
+
+/**************************************************/
+/*   Counter-based random number streams          */
+/**************************************************/
+
+/* Philox4x32-10 counter-based generator (Salmon et al., SC'11). Every
+   stream is keyed on the global seed and the particle ID, and its counter
+   is built from the particle time and the number of draws, so that random
+   numbers are independent of the order in which particles are processed. */
+
+static uint32_t parcels_stream_seed = 0;
+
+typedef struct
+{
+  uint32_t key[2], ctr[4], buf[4];
+  int nbuf, has_spare;
+  float spare;
+} parcels_rng_stream;
+
+static void parcels_seed_streams(int seed)
+{
+  parcels_stream_seed = (uint32_t)seed;
+}
+
+static inline void parcels_philox4x32(uint32_t *ctr, uint32_t *key, uint32_t *out)
+{
+  uint32_t c0 = ctr[0], c1 = ctr[1], c2 = ctr[2], c3 = ctr[3];
+  uint32_t k0 = key[0], k1 = key[1];
+  uint64_t p0, p1;
+  int r;
+  for (r = 0; r < 10; ++r) {
+    p0 = (uint64_t)0xD2511F53 * c0;
+    p1 = (uint64_t)0xCD9E8D57 * c2;
+    c0 = (uint32_t)(p1 >> 32) ^ c1 ^ k0;
+    c2 = (uint32_t)(p0 >> 32) ^ c3 ^ k1;
+    c1 = (uint32_t)p1;
+    c3 = (uint32_t)p0;
+    k0 += 0x9E3779B9; k1 += 0xBB67AE85;
+  }
+  out[0] = c0; out[1] = c1; out[2] = c2; out[3] = c3;
+}
+
+/* Initialise the stream of a particle at a given time */
+static inline void parcels_stream_init(parcels_rng_stream *s, int id, double time)
+{
+  uint64_t t;
+  memcpy(&t, &time, sizeof(t));
+  s->key[0] = parcels_stream_seed; s->key[1] = (uint32_t)id;
+  s->ctr[0] = (uint32_t)t; s->ctr[1] = (uint32_t)(t >> 32);
+  s->ctr[2] = 0; s->ctr[3] = 0;
+  s->nbuf = 0; s->has_spare = 0;
+}
+
+static inline uint32_t parcels_stream_next(parcels_rng_stream *s)
+{
+  if (s->nbuf == 0) {
+    parcels_philox4x32(s->ctr, s->key, s->buf);
+    if (++(s->ctr[2]) == 0) ++(s->ctr[3]);
+    s->nbuf = 4;
+  }
+  return s->buf[--(s->nbuf)];
+}
+
+static inline float parcels_stream_random(parcels_rng_stream *s)
+{
+  /* Use the upper 24 bits for a float in [0, 1) */
+  return (float)(parcels_stream_next(s) >> 8) * (1.0f / 16777216.0f);
+}
+
+static inline float parcels_stream_uniform(parcels_rng_stream *s, float low, float high)
+{
+  return low + parcels_stream_random(s) * (high - low);
+}
+
+static inline int parcels_stream_randint(parcels_rng_stream *s, int low, int high)
+{
+  return low + (int)(parcels_stream_next(s) % (uint32_t)(high - low));
+}
+
+static inline float parcels_stream_normalvariate(parcels_rng_stream *s, float loc, float scale)
+{
+  /* Box-Muller transform caching the spare variate on the stream */
+  double u1, u2, r;
+  if (s->has_spare) {
+    s->has_spare = 0;
+    return loc + s->spare * scale;
+  }
+  /* Use 32 bits per uniform draw, with u1 in (0, 1] to avoid log(0) */
+  u1 = ((double)parcels_stream_next(s) + 1.) * (1. / 4294967296.);
+  u2 = (double)parcels_stream_next(s) * (1. / 4294967296.);
+  r = sqrt(-2. * log(u1));
+  s->spare = (float)(r * sin(2. * M_PI * u2));
+  s->has_spare = 1;
+  return loc + (float)(r * cos(2. * M_PI * u2)) * scale;
 }
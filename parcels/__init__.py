@@ -5,4 +5,6 @@ from parcels.field import *  # noqa
 from parcels.kernel import *  # noqa
 import parcels.rng as random  # noqa
 from parcels.particlefile import *  # noqa
+from parcels.checkpoint import *  # noqa
+from parcels.profiling import *  # noqa
 from parcels.kernels import *  # noqa
@@ -0,0 +1,116 @@
+"""Module controlling binary checkpointing and restart of ParticleSets"""
+import parcels.particle
+import parcels.rng
+import numpy as np
+import json
+from os import path, rename
+from datetime import timedelta as delta
+
+
+__all__ = ['ParticleCheckpoint']
+
+
+class ParticleCheckpoint(object):
+    """Binary checkpoint of the full state of a
+    :class:`parcels.particleset.ParticleSet` during execution.
+
+    A checkpoint consists of a single file holding a small JSON header,
+    followed by the raw particle data as laid out in memory. The header
+    stores the particle dtype, the global particle ID counter, the state
+    of the parcels RNG and the position of the time loop, so that an
+    interrupted run can be resumed via
+    :meth:`parcels.particleset.ParticleSet.from_checkpoint`. Restoring
+    maps the particle data straight from disk, so no re-initialisation
+    of particles is needed.
+
+    Checkpoints are written to a temporary file first and then moved
+    into place, so that an interruption during writing never destroys
+    the previous checkpoint.
+
+    :param name: Basename of the checkpoint file
+    :param interval: Minimum interval of simulated time between two
+                     checkpoints. Default is to write a checkpoint after
+                     every leap of :meth:`ParticleSet.execute`
+    """
+
+    magic = b'PARCELS-CHECKPOINT'
+    version = 1
+    alignment = 64
+
+    def __init__(self, name, interval=None):
+        self.filename = "%s.ckpt" % name
+        if isinstance(interval, delta):
+            interval = interval.total_seconds()
+        self.interval = interval
+        self.lasttime_written = None
+
+    def due(self, time):
+        """Check whether a checkpoint is due at the given time"""
+        if self.lasttime_written is None or self.interval is None:
+            return True
+        return abs(time - self.lasttime_written) >= abs(self.interval)
+
+    def write(self, pset, time, endtime=None, dt=None, interval=None):
+        """Write the state of a :class:`parcels.particleset.ParticleSet` to file
+
+        :param pset: ParticleSet to checkpoint
+        :param time: Time up to which all particles have been advanced
+        :param endtime: End time of the current execution loop
+        :param dt: Timestep of the current execution loop
+        :param interval: Leap interval of the current execution loop
+        """
+        data = pset_to_array(pset)
+        header = {'version': self.version,
+                  'ptype': pset.ptype._cache_key,
+                  'dtype': data.dtype.descr,
+                  'size': data.size,
+                  'lastID': parcels.particle.lastID,
+                  'rng': parcels.rng.get_state(),
+                  'time': time, 'endtime': endtime,
+                  'dt': dt, 'interval': interval}
+        header = json.dumps(header).encode('utf-8')
+        offset = len(self.magic) + 1 + len(header) + 1
+        offset += -offset % self.alignment
+        tmpfile = "%s.tmp" % self.filename
+        with open(tmpfile, 'wb') as f:
+            f.write(self.magic + b'\n' + header + b'\n')
+            f.write(b' ' * (offset - f.tell()))
+            f.write(data.tobytes())
+        rename(tmpfile, self.filename)
+        self.lasttime_written = time
+
+    def read(self):
+        """Read checkpoint header and particle data from file
+
+        :rtype: Tuple of header dict and memory-mapped particle data"""
+        if not path.exists(self.filename):
+            raise IOError("Checkpoint file not found: %s" % self.filename)
+        with open(self.filename, 'rb') as f:
+            if f.readline().rstrip(b'\n') != self.magic:
+                raise IOError("%s is not a Parcels checkpoint file" % self.filename)
+            header = json.loads(f.readline().decode('utf-8'))
+            offset = f.tell()
+        if header['version'] != self.version:
+            raise IOError("Unsupported checkpoint version %s" % header['version'])
+        offset += -offset % self.alignment
+        dtype = np.dtype([tuple(str(d) for d in descr) for descr in header['dtype']])
+        if header['size'] > 0:
+            # Copy-on-write mapping: pages are only read when accessed
+            # and modifications are never written back to the checkpoint
+            data = np.memmap(self.filename, dtype=dtype, mode='c',
+                             offset=offset, shape=(header['size'],))
+        else:
+            data = np.empty(0, dtype=dtype)
+        self.lasttime_written = header['time']
+        return header, data
+
+
+def pset_to_array(pset):
+    """Gather the variables of all particles into a structured array"""
+    if pset.ptype.uses_jit:
+        pset._compact()
+        return pset._particle_data[:pset._nslots]
+    data = np.empty(pset.size, dtype=pset.ptype.dtype)
+    for v in pset.ptype.variables:
+        data[v.name] = [getattr(p, v.name) for p in pset]
+    return data
@@ -1,8 +1,11 @@
-from parcels.field import Field
+from parcels.field import Field, VectorField
+from parcels.kernels.error import ErrorCode
 import ast
 import cgen as c
 from collections import OrderedDict
 import math
+import numpy as np
+import operator
 import random
 
 
@@ -17,6 +20,9 @@ class GridNode(IntrinsicNode):
         if isinstance(getattr(self.obj, attr), Field):
             return FieldNode(getattr(self.obj, attr),
                              ccode="%s->%s" % (self.ccode, attr))
+        elif isinstance(getattr(self.obj, attr), VectorField):
+            return VectorFieldNode(getattr(self.obj, attr),
+                                   ccode="%s->%s" % (self.ccode, attr))
         else:
             return ConstNode(getattr(self.obj, attr),
                              ccode="%s" % (attr))
@@ -34,6 +40,19 @@ class FieldEvalNode(IntrinsicNode):
         self.var = var
 
 
+class VectorFieldNode(IntrinsicNode):
+    def __getitem__(self, attr):
+        return VectorFieldEvalNode(self.obj, attr)
+
+
+class VectorFieldEvalNode(IntrinsicNode):
+    def __init__(self, field, args, var, var2):
+        self.field = field
+        self.args = args
+        self.var = var
+        self.var2 = var2
+
+
 class ConstNode(IntrinsicNode):
     def __getitem__(self, attr):
         return attr
@@ -44,14 +63,17 @@ class MathNode(IntrinsicNode):
 
     def __getattr__(self, attr):
         if hasattr(math, attr):
-            if attr in self.symbol_map:
-                attr = self.symbol_map[attr]
-            return IntrinsicNode(None, ccode=attr)
+            return MathFunctionNode(attr, ccode=self.symbol_map.get(attr, attr))
         else:
             raise AttributeError("""Unknown math function encountered: %s"""
                                  % attr)
 
 
+class MathFunctionNode(IntrinsicNode):
+    """Pure function or constant of the math module, named by `obj`"""
+    pass
+
+
 class RandomNode(IntrinsicNode):
     symbol_map = {'random': 'parcels_random',
                   'uniform': 'parcels_uniform',
@@ -69,9 +91,30 @@ class RandomNode(IntrinsicNode):
                                  % attr)
 
 
+class RandomStreamNode(RandomNode):
+    """Random functions drawing from the counter-based stream of the particle"""
+    symbol_map = {'random': 'parcels_stream_random',
+                  'uniform': 'parcels_stream_uniform',
+                  'randint': 'parcels_stream_randint',
+                  'normalvariate': 'parcels_stream_normalvariate',
+                  'seed': 'parcels_seed_streams'}
+
+    def __getattr__(self, attr):
+        node = super(RandomStreamNode, self).__getattr__(attr)
+        if attr != 'seed':
+            node = RandomStreamCallNode(None, ccode=node.ccode)
+        return node
+
+
+class RandomStreamCallNode(IntrinsicNode):
+    """Random function that takes the stream as first argument"""
+    pass
+
+
 class ErrorCodeNode(IntrinsicNode):
     symbol_map = {'Success': 'SUCCESS', 'Repeat': 'REPEAT', 'Delete': 'DELETE',
-                  'Error': 'ERROR', 'ErrorOutOfBounds': 'ERROR_OUT_OF_BOUNDS'}
+                  'Error': 'ERROR', 'ErrorOutOfBounds': 'ERROR_OUT_OF_BOUNDS',
+                  'ErrorTimeExtrapolation': 'ERROR_TIME_EXTRAPOLATION'}
 
     def __getattr__(self, attr):
         if attr in self.symbol_map:
@@ -87,30 +130,24 @@ class ParticleAttributeNode(IntrinsicNode):
         self.obj = obj
         self.attr = attr
         self.ccode = "%s->%s" % (obj.ccode, attr)
-        self.ccode_index_var = None
-
-        if self.attr == 'lon':
-            self.ccode_index_var = "%s->%s" % (self.obj.ccode, "xi")
-        elif self.attr == 'lat':
-            self.ccode_index_var = "%s->%s" % (self.obj.ccode, "yi")
 
     @property
-    def pyast_index_update(self):
-        pyast = ast.Assign()
-        pyast.targets = [IntrinsicNode(None, ccode='err')]
-        pyast.value = IntrinsicNode(None, ccode=self.ccode_index_update)
-        return pyast
+    def is_position(self):
+        """Whether the attribute is a coordinate of the particle position"""
+        return self.attr in IndexUpdateNode.axes
 
-    @property
-    def ccode_index_update(self):
-        """C-code for the index update requires after updating p.lon/p.lat"""
-        if self.attr == 'lon':
-            return "search_linear_float(%s, U->xdim, U->lon, &(%s)); CHECKERROR(err)" \
-                % (self.ccode, self.ccode_index_var)
-        if self.attr == 'lat':
-            return "search_linear_float(%s, U->ydim, U->lat, &(%s)); CHECKERROR(err)" \
-                % (self.ccode, self.ccode_index_var)
-        return ""
+
+class IndexUpdateNode(IntrinsicNode):
+    """Update of the cached grid indices after a change of particle
+    position, for the coordinates of all fields used in a kernel. The
+    C code is generated by :class:`KernelGenerator` once these are known."""
+    axes = {'lon': 0, 'lat': 1, 'depth': 2}
+
+    def __init__(self, position, check_bounds=True):
+        self.position = position
+        self.axis = self.axes[position.attr]
+        self.check_bounds = check_bounds
+        self.ccode = None
 
 
 class ParticleNode(IntrinsicNode):
@@ -119,6 +156,8 @@ class ParticleNode(IntrinsicNode):
             return ParticleAttributeNode(self, attr)
         elif attr in ['delete']:
             return ParticleAttributeNode(self, 'state')
+        elif attr in ['exception']:
+            raise NotImplementedError("Particle exceptions are only available in Python")
         else:
             raise AttributeError("""Particle type %s does not define attribute "%s".
 Please add '%s' to %s.users_vars or define an appropriate sub-class."""
@@ -130,9 +169,11 @@ class IntrinsicTransformer(ast.NodeTransformer):
     names, such as 'particle' or 'grid', inserts placeholder objects
     and propagates attribute access."""
 
-    def __init__(self, grid, ptype):
+    def __init__(self, grid, ptype, check_bounds=True, random_streams=False):
         self.grid = grid
         self.ptype = ptype
+        self.check_bounds = check_bounds
+        self.random_streams = random_streams
 
         # Counter and variable names for temporaries
         self._tmp_counter = 0
@@ -158,7 +199,10 @@ class IntrinsicTransformer(ast.NodeTransformer):
         elif node.id == 'math':
             node = MathNode(math, ccode='')
         elif node.id == 'random':
-            node = RandomNode(math, ccode='')
+            if self.random_streams:
+                node = RandomStreamNode(math, ccode='')
+            else:
+                node = RandomNode(math, ccode='')
         return node
 
     def visit_Attribute(self, node):
@@ -180,6 +224,13 @@ class IntrinsicTransformer(ast.NodeTransformer):
             self.stmt_stack += [FieldEvalNode(node.value, node.slice, tmp)]
             # .. and return the name of the temporary that will be populated
             return ast.Name(id=tmp)
+        elif isinstance(node.value, VectorFieldNode):
+            tmp = self.get_tmp()
+            tmp2 = self.get_tmp()
+            # Insert placeholder node for the evaluation of both components
+            self.stmt_stack += [VectorFieldEvalNode(node.value, node.slice, tmp, tmp2)]
+            # .. and return the temporaries as a tuple to be unpacked
+            return ast.Tuple(elts=[ast.Name(id=tmp), ast.Name(id=tmp2)])
         elif isinstance(node.value, IntrinsicNode):
             raise NotImplementedError("Subscript not implemented for object type %s"
                                       % type(node.value).__name__)
@@ -192,10 +243,9 @@ class IntrinsicTransformer(ast.NodeTransformer):
         node.value = self.visit(node.value)
         stmts = [node]
 
-        # Capture p.lat/p.lon updates and insert p.xi/p.yi updates
-        if isinstance(node.target, ParticleAttributeNode) \
-           and node.target.ccode_index_var is not None:
-            stmts += [node.target.pyast_index_update]
+        # Capture p.lat/p.lon/p.depth updates and insert p.xi/p.yi/p.zi updates
+        if isinstance(node.target, ParticleAttributeNode) and node.target.is_position:
+            stmts += [IndexUpdateNode(node.target, self.check_bounds)]
 
         # Inject statements from the stack
         if len(self.stmt_stack) > 0:
@@ -208,10 +258,14 @@ class IntrinsicTransformer(ast.NodeTransformer):
         node.value = self.visit(node.value)
         stmts = [node]
 
-        # Capture p.lat/p.lon updates and insert p.xi/p.yi updates
-        if isinstance(node.targets[0], ParticleAttributeNode) \
-           and node.targets[0].ccode_index_var is not None:
-            stmts += [node.targets[0].pyast_index_update]
+        # Unpack the components of vector field evaluations
+        if isinstance(node.targets[0], ast.Tuple) and isinstance(node.value, ast.Tuple):
+            stmts = TupleSplitter().visit(node)
+
+        # Capture p.lat/p.lon/p.depth updates and insert p.xi/p.yi/p.zi updates
+        for stmt in list(stmts):
+            if isinstance(stmt.targets[0], ParticleAttributeNode) and stmt.targets[0].is_position:
+                stmts += [IndexUpdateNode(stmt.targets[0], self.check_bounds)]
 
         # Inject statements from the stack
         if len(self.stmt_stack) > 0:
@@ -246,6 +300,389 @@ class TupleSplitter(ast.NodeTransformer):
         return node
 
 
+def walk(node):
+    """Iterate over all nodes of an AST, including the arguments of field evaluations"""
+    todo = list(node) if isinstance(node, list) else [node]
+    while len(todo) > 0:
+        node = todo.pop()
+        yield node
+        if isinstance(node, (FieldEvalNode, VectorFieldEvalNode)):
+            todo.append(node.args)
+        else:
+            todo.extend(ast.iter_child_nodes(node))
+
+
+class ConstantFolder(ast.NodeTransformer):
+    """AST transformer that evaluates arithmetic on numeric literals,
+    math constants and math functions of literals at code generation
+    time. Integer division is left to C, which truncates instead of
+    rounding down."""
+
+    operators = {ast.Add: operator.add, ast.Sub: operator.sub,
+                 ast.Mult: operator.mul, ast.Div: operator.truediv}
+
+    @staticmethod
+    def value(node):
+        """Numeric value of a literal or math constant, or None"""
+        if isinstance(node, ast.Num) and not isinstance(node.n, complex):
+            return node.n
+        if isinstance(node, MathFunctionNode) and not callable(getattr(math, node.obj)):
+            return getattr(math, node.obj)
+        return None
+
+    @staticmethod
+    def literal(value, node):
+        """Literal replacing `node`, or `node` itself if C can not represent `value`"""
+        if isinstance(value, float):
+            if math.isinf(value) or math.isnan(value):
+                return node
+        elif not -2**31 <= value < 2**31:
+            return node
+        return ast.copy_location(ast.Num(n=value), node)
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        left, right = self.value(node.left), self.value(node.right)
+        if left is None or right is None or type(node.op) not in self.operators:
+            return node
+        if isinstance(node.op, ast.Div) and not (isinstance(left, float) or isinstance(right, float)):
+            return node
+        try:
+            return self.literal(self.operators[type(node.op)](left, right), node)
+        except (ArithmeticError, ValueError):
+            return node
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        operand = self.value(node.operand)
+        if operand is None or not isinstance(node.op, (ast.UAdd, ast.USub)):
+            return node
+        return self.literal(-operand if isinstance(node.op, ast.USub) else operand, node)
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        if not isinstance(node.func, MathFunctionNode) or not callable(getattr(math, node.func.obj)):
+            return node
+        args = [self.value(a) for a in node.args]
+        if any(a is None for a in args) or len(getattr(node, 'keywords', [])) > 0:
+            return node
+        try:
+            value = getattr(math, node.func.obj)(*args)
+        except (ArithmeticError, ValueError, TypeError):
+            return node
+        return self.literal(value, node) if isinstance(value, float) else node
+
+    def visit_FieldEvalNode(self, node):
+        node.args = self.visit(node.args)
+        return node
+
+    visit_VectorFieldEvalNode = visit_FieldEvalNode
+
+
+class TypeInference(object):
+    """Infers the C types of the local variables of a kernel from the
+    values assigned to them, following the usual arithmetic conversions
+    of C. Literals, particle :class:`Variable` dtypes and the return
+    types of intrinsic functions determine the type of an expression.
+    A variable takes the widest type of all values assigned to it, with
+    the rank ``int`` < ``float`` < ``double``.
+
+    :param ptype: Particle type, for the C types of particle variables
+    :param fixed: Dict of C types of variables that are not inferred
+    """
+
+    ctypes = ['int', 'float', 'double']
+
+    def __init__(self, ptype, fixed):
+        self.ptype_vars = dict((v.name, v) for v in ptype.variables)
+        self.fixed = fixed
+        self.types = OrderedDict()
+        # Element types of arrays initialised from list literals
+        self.arrays = OrderedDict()
+
+    def join(self, *ctypes):
+        return max(ctypes, key=self.ctypes.index)
+
+    def infer(self, py_ast):
+        """Infer the types of all variables assigned in a kernel
+
+        :rtype: Dict of the C types of scalar variables"""
+        assigns = [n for n in walk(py_ast) if isinstance(n, (ast.Assign, ast.AugAssign))]
+        for node in assigns:
+            if isinstance(node, ast.Assign) and isinstance(node.value, ast.List):
+                elts = [e for e in walk(node.value) if not isinstance(e, ast.List)]
+                self.arrays[node.targets[0].id] = self.join('int', *[self.ctype(e) for e in elts])
+        changed = True
+        while changed:
+            changed = False
+            for node in assigns:
+                target = node.targets[0] if isinstance(node, ast.Assign) else node.target
+                if not isinstance(target, ast.Name) or target.id in self.fixed \
+                   or target.id in self.arrays:
+                    continue
+                if isinstance(node, ast.Assign):
+                    value = self.ctype(node.value)
+                else:
+                    value = self.ctype(ast.BinOp(left=target, op=node.op, right=node.value))
+                ctype = self.join(self.types.get(target.id, 'int'), value)
+                if ctype != self.types.get(target.id):
+                    self.types[target.id] = ctype
+                    changed = True
+        return self.types
+
+    def ctype(self, node):
+        """C type of an expression"""
+        if isinstance(node, ast.Num):
+            return 'double' if isinstance(node.n, float) else 'int'
+        if isinstance(node, ast.Name):
+            if node.id in self.fixed:
+                return self.fixed[node.id]
+            # Variables without assignments so far have the lowest rank
+            return self.types.get(node.id, 'int')
+        if isinstance(node, ParticleAttributeNode):
+            dtype = np.dtype(self.ptype_vars[node.attr].dtype)
+            if dtype.kind in 'iub':
+                return 'int'
+            return 'double' if dtype == np.float64 else 'float'
+        if isinstance(node, ConstNode):
+            return 'float'
+        if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) \
+           and node.value.id in self.arrays:
+            return self.arrays[node.value.id]
+        if isinstance(node, ast.BinOp):
+            return self.join(self.ctype(node.left), self.ctype(node.right))
+        if isinstance(node, ast.UnaryOp):
+            return 'int' if isinstance(node.op, ast.Not) else self.ctype(node.operand)
+        if isinstance(node, (ast.Compare, ast.BoolOp)):
+            return 'int'
+        if isinstance(node, ast.Call) and isinstance(node.func, IntrinsicNode) \
+           and not isinstance(node.func, MathFunctionNode) and node.func.ccode.startswith('parcels_'):
+            return 'int' if node.func.ccode.endswith('randint') else 'float'
+        return 'double'
+
+
+class KernelOptimizer(object):
+    """Optimisation pass over the kernel AST after intrinsic
+    transformation and before the generation of C code:
+
+    * Constant folding of arithmetic on literals (see :class:`ConstantFolder`)
+    * Reuse of field evaluations with identical arguments, as long as
+      none of the variables in the arguments has been assigned in between
+    * Common-subexpression elimination of pure arithmetic expressions,
+      which are computed once into temporaries ``cse<n>``
+    * Removal of assignments to local variables and temporaries that
+      are never read
+
+    Field evaluations whose result is unused are kept, since they may
+    signal errors such as ``ErrorOutOfBounds``.
+
+    :param kernel_vars: Names of the kernel function arguments
+    """
+
+    def __init__(self, kernel_vars):
+        self.kernel_vars = kernel_vars
+        # Temporaries created by the optimizer
+        self.cse_vars = []
+        # Temporaries of field evaluations replaced by earlier ones
+        self.renamed = {}
+        self._hoisted = {}
+
+    def optimize(self, py_ast):
+        py_ast = ConstantFolder().visit(py_ast)
+        py_ast.body = self._cse_block(py_ast.body, OrderedDict())
+        while self._remove_dead(py_ast.body, self._reads(py_ast.body)):
+            pass
+        return py_ast
+
+    def key(self, node):
+        """Structural key of a pure expression, or None if `node` may
+        have side effects or is not supported"""
+        if isinstance(node, ast.Num):
+            return repr(node.n)
+        if isinstance(node, ast.Name):
+            return 'n:%s' % node.id
+        if isinstance(node, (ParticleAttributeNode, MathFunctionNode)):
+            return node.ccode
+        if isinstance(node, ConstNode):
+            return 'c:%s' % node.ccode
+        if isinstance(node, ast.Index):
+            return self.key(node.value)
+        if isinstance(node, ast.Tuple):
+            keys = [self.key(e) for e in node.elts]
+            return None if None in keys else "(%s)" % ", ".join(keys)
+        if isinstance(node, ast.BinOp):
+            left, right = self.key(node.left), self.key(node.right)
+            if left is None or right is None:
+                return None
+            return "(%s %s %s)" % (left, type(node.op).__name__, right)
+        if isinstance(node, ast.UnaryOp):
+            operand = self.key(node.operand)
+            return None if operand is None else "%s(%s)" % (type(node.op).__name__, operand)
+        if isinstance(node, ast.Call) and isinstance(node.func, MathFunctionNode) \
+           and len(getattr(node, 'keywords', [])) == 0:
+            keys = [self.key(a) for a in node.args]
+            return None if None in keys else "%s(%s)" % (node.func.ccode, ", ".join(keys))
+        return None
+
+    def deps(self, node):
+        """Keys of the variables read by an expression"""
+        return set(self.key(n) for n in walk(node)
+                   if isinstance(n, (ast.Name, ParticleAttributeNode)))
+
+    def written(self, stmts):
+        """Keys of the variables assigned by a list of statements"""
+        written = set()
+        for node in walk(stmts):
+            if isinstance(node, ast.Assign):
+                targets = node.targets
+            elif isinstance(node, IndexUpdateNode):
+                # Grid index updates after changes of particle position
+                written |= set(['particle->xi', 'particle->yi', 'particle->zi'])
+                continue
+            elif isinstance(node, ast.AugAssign):
+                targets = [node.target]
+            elif isinstance(node, FieldEvalNode):
+                targets = [ast.Name(id=node.var)]
+            elif isinstance(node, VectorFieldEvalNode):
+                targets = [ast.Name(id=node.var), ast.Name(id=node.var2)]
+            else:
+                continue
+            for t in targets:
+                if isinstance(t, ast.Subscript):
+                    t = t.value
+                if isinstance(t, (ast.Name, ParticleAttributeNode)):
+                    written.add(self.key(t))
+        return written
+
+    @staticmethod
+    def kill(available, written):
+        """Forget available values that depend on assigned variables"""
+        for key in [k for k, (_, _, deps) in available.items() if len(deps & written) > 0]:
+            del available[key]
+
+    def rename(self, node):
+        """Replace the temporaries of reused field evaluations"""
+        for n in walk(node):
+            if isinstance(n, ast.Name) and n.id in self.renamed:
+                n.id = self.renamed[n.id]
+
+    def _cse_block(self, stmts, available):
+        """Reuse field evaluations and common subexpressions in a list of
+        statements, given the values available before the first one.
+        `available` maps keys to (expression, anchor statement, deps) for
+        subexpressions and to (variables, None, deps) for field evaluations."""
+        body = []
+        for stmt in stmts:
+            self.rename(stmt)
+            if isinstance(stmt, (FieldEvalNode, VectorFieldEvalNode)):
+                args = self.key(stmt.args)
+                vfield = stmt.field.obj
+                if isinstance(stmt, FieldEvalNode):
+                    evals = [('f:%s%s' % (vfield.name, args), stmt.var)]
+                else:
+                    evals = [('v:%s%s' % (vfield.name, args), (stmt.var, stmt.var2)),
+                             ('f:%s%s' % (vfield.U.name, args), stmt.var),
+                             ('f:%s%s' % (vfield.V.name, args), stmt.var2)]
+                key, var = evals[0]
+                if args is not None and key in available:
+                    prev = available[key][0]
+                    if isinstance(stmt, FieldEvalNode):
+                        self.renamed[stmt.var] = prev
+                    else:
+                        self.renamed[stmt.var], self.renamed[stmt.var2] = prev
+                    continue
+                self._cse_expr(stmt.args, lambda new, s=stmt: setattr(s, 'args', new), stmt, available)
+                self.kill(available, self.written([stmt]))
+                if args is not None:
+                    deps = self.deps(stmt.args)
+                    for key, var in evals:
+                        available[key] = (var, None, deps)
+            elif isinstance(stmt, ast.If):
+                self._cse_expr(stmt.test, lambda new, s=stmt: setattr(s, 'test', new), stmt, available)
+                stmt.body = self._cse_block(stmt.body, OrderedDict(available))
+                stmt.orelse = self._cse_block(stmt.orelse, OrderedDict(available))
+                self.kill(available, self.written(stmt.body + stmt.orelse))
+            elif isinstance(stmt, ast.While):
+                # The body is executed repeatedly, and the test after the
+                # body since loops are translated to do-while loops in C
+                self.kill(available, self.written(stmt.body))
+                stmt.body = self._cse_block(stmt.body, OrderedDict(available))
+                self.kill(available, self.written(stmt.body))
+            else:
+                if isinstance(stmt, (ast.Assign, ast.AugAssign, ast.Expr, ast.Return)) \
+                   and not isinstance(stmt.value, IntrinsicNode) and stmt.value is not None:
+                    self._cse_expr(stmt.value, lambda new, s=stmt: setattr(s, 'value', new), stmt, available)
+                self.kill(available, self.written([stmt]))
+            body.append(stmt)
+
+        # Insert the computation of common subexpressions before their first use
+        block = []
+        for stmt in body:
+            # Inner subexpressions are smaller and computed first
+            block += [assign for _, assign in sorted(self._hoisted.pop(id(stmt), []),
+                                                     key=lambda h: h[0])]
+            block.append(stmt)
+        return block
+
+    def _cse_expr(self, node, replace, anchor, available):
+        """Replace subexpressions of `node` that are already available;
+        `replace` substitutes a new node for `node` in its parent"""
+        if isinstance(node, (ast.BinOp, ast.Call)):
+            key = self.key(node)
+            if key is not None:
+                if key in available:
+                    expr, first_anchor, deps = available[key]
+                    if isinstance(expr, tuple):
+                        # First occurrence not yet assigned to a temporary
+                        first, first_replace, size = expr
+                        var = "cse%d" % len(self.cse_vars)
+                        self.cse_vars.append(var)
+                        assign = ast.Assign(targets=[ast.Name(id=var)], value=first)
+                        self._hoisted.setdefault(id(first_anchor), []).append((size, assign))
+                        first_replace(ast.Name(id=var))
+                        available[key] = (var, first_anchor, deps)
+                        expr = var
+                    replace(ast.Name(id=expr))
+                    return
+                size = len(list(walk(node)))
+                available[key] = ((node, replace, size), anchor, self.deps(node))
+        if isinstance(node, ast.BoolOp):
+            # Operands after the first may not be evaluated in C
+            return
+        for field, value in ast.iter_fields(node):
+            if isinstance(value, ast.AST):
+                self._cse_expr(value, lambda new, f=field: setattr(node, f, new), anchor, available)
+            elif isinstance(value, list):
+                for i, v in enumerate(value):
+                    if isinstance(v, ast.AST):
+                        self._cse_expr(v, lambda new, i=i, values=value: values.__setitem__(i, new),
+                                       anchor, available)
+
+    def _reads(self, stmts):
+        """Names of all variables that are read in a list of statements"""
+        targets = set()
+        for node in walk(stmts):
+            if isinstance(node, ast.Assign):
+                targets |= set(id(t) for t in node.targets if isinstance(t, ast.Name))
+        return set(n.id for n in walk(stmts) if isinstance(n, ast.Name) and id(n) not in targets)
+
+    def _remove_dead(self, stmts, reads):
+        """Remove assignments of pure values to variables that are never read"""
+        removed = False
+        for stmt in list(stmts):
+            if isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 \
+               and isinstance(stmt.targets[0], ast.Name) \
+               and stmt.targets[0].id not in reads \
+               and stmt.targets[0].id not in self.kernel_vars \
+               and self.key(stmt.value) is not None:
+                stmts.remove(stmt)
+                removed = True
+            elif isinstance(stmt, (ast.If, ast.While)):
+                removed |= self._remove_dead(stmt.body, reads)
+                removed |= self._remove_dead(stmt.orelse, reads)
+        return removed
+
+
 class KernelGenerator(ast.NodeVisitor):
     """Code generator class that translates simple Python kernel
     functions into C functions by populating and accessing the `ccode`
@@ -255,35 +692,79 @@ class KernelGenerator(ast.NodeVisitor):
     kernel_vars = ['particle', 'grid', 'time', 'dt', 'output_time', 'tol']
     array_vars = []
 
-    def __init__(self, grid, ptype):
+    def generic_visit(self, node):
+        """Intrinsic nodes carry their C code already, while other nodes
+        without a visitor are not supported by the kernel language"""
+        if not isinstance(node, IntrinsicNode):
+            raise NotImplementedError("%s statements and expressions cannot be translated to C"
+                                      % type(node).__name__)
+
+    def __init__(self, grid, ptype, random_streams=False, optimize=True):
         self.grid = grid
         self.ptype = ptype
+        self.random_streams = random_streams
+        self.optimize = optimize
         self.field_args = OrderedDict()
-        # Hack alert: JIT requires U field to update grid indexes
-        self.field_args['U'] = grid.U
+        self.coordinate_sets = grid.coordinate_sets
+        self.vector_args = OrderedDict()
         self.const_args = OrderedDict()
 
-    def generate(self, py_ast, funcvars):
+    def generate(self, py_ast, funcvars, check_bounds=True):
+        """Generate a C function from the AST of a kernel function
+
+        :param check_bounds: Return an error when particles are moved outside
+                             the grid. Disabled for recovery kernels, which may
+                             legitimately move particles out of the domain."""
         # Untangle Pythonic tuple-assignment statements
         py_ast = TupleSplitter().visit(py_ast)
 
         # Replace occurences of intrinsic objects in Python AST
-        transformer = IntrinsicTransformer(self.grid, self.ptype)
+        transformer = IntrinsicTransformer(self.grid, self.ptype, check_bounds,
+                                           self.random_streams)
         py_ast = transformer.visit(py_ast)
+        tmp_vars = transformer.tmp_vars
+        cse_vars = []
+
+        # Record all sampled fields first, since grid index updates after
+        # changes of particle position search the coordinates of each of them
+        for node in walk(py_ast):
+            if isinstance(node, (FieldEvalNode, VectorFieldEvalNode)):
+                self.visit(node.field)
+
+        # Fold constants and remove redundant computations
+        if self.optimize:
+            optimizer = KernelOptimizer(self.kernel_vars)
+            py_ast = optimizer.optimize(py_ast)
+            tmp_vars = [v for v in tmp_vars if v not in optimizer.renamed]
+            cse_vars = optimizer.cse_vars
+
+        # Infer the types of local variables; temporaries hold interpolated values
+        fixed = dict((v, 'double') for v in tmp_vars)
+        fixed.update({'time': 'double', 'dt': 'double'})
+        typer = TypeInference(self.ptype, fixed)
+        local_types = typer.infer(py_ast)
+        self.array_types = typer.arrays
 
         # Generate C-code for all nodes in the Python AST
         self.visit(py_ast)
         self.ccode = py_ast.ccode
 
-        # Insert variable declarations for non-instrinsics
-        for kvar in self.kernel_vars + self.array_vars:
-            if kvar in funcvars:
-                funcvars.remove(kvar)
+        # Insert variable declarations for non-instrinsics, grouped by type
+        # The caller's list is kept intact, since merged kernels reuse it,
+        # and locals shared by merged kernels are only declared once
+        funcvars = [v for v in OrderedDict.fromkeys(funcvars)
+                    if v not in self.kernel_vars + self.array_vars]
+        decls = OrderedDict((ctype, []) for ctype in typer.ctypes)
+        decls['double'] += tmp_vars
+        for var in funcvars + [v for v in cse_vars if v in local_types]:
+            decls[local_types.get(var, 'float')].append(var)
         self.ccode.body.insert(0, c.Value('ErrorCode', 'err'))
-        if len(funcvars) > 0:
-            self.ccode.body.insert(0, c.Value("float", ", ".join(funcvars)))
-        if len(transformer.tmp_vars) > 0:
-            self.ccode.body.insert(0, c.Value("float", ", ".join(transformer.tmp_vars)))
+        if self.random_streams:
+            self.ccode.body.insert(0, c.Statement("parcels_stream_init(&__rng, particle->id, time)"))
+            self.ccode.body.insert(0, c.Value('parcels_rng_stream', '__rng'))
+        for ctype, cvars in reversed(list(decls.items())):
+            if len(cvars) > 0:
+                self.ccode.body.insert(0, c.Value(ctype, ", ".join(cvars)))
 
         return self.ccode
 
@@ -296,7 +777,7 @@ class KernelGenerator(ast.NodeVisitor):
         # Create function declaration and argument list
         decl = c.Static(c.DeclSpecifier(c.Value("ErrorCode", node.name), spec='inline'))
         args = [c.Pointer(c.Value(self.ptype.name, "particle")),
-                c.Value("double", "time"), c.Value("float", "dt")]
+                c.Value("double", "time"), c.Value("double", "dt")]
         for field, _ in self.field_args.items():
             args += [c.Pointer(c.Value("CField", "%s" % field))]
         for const, _ in self.const_args.items():
@@ -313,8 +794,10 @@ class KernelGenerator(ast.NodeVisitor):
         supported."""
         for a in node.args:
             self.visit(a)
-        ccode_args = ", ".join([a.ccode for a in node.args])
-        node.ccode = "%s(%s)" % (node.func.ccode, ccode_args)
+        ccode_args = [a.ccode for a in node.args]
+        if isinstance(node.func, RandomStreamCallNode):
+            ccode_args = ["&__rng"] + ccode_args
+        node.ccode = "%s(%s)" % (node.func.ccode, ", ".join(ccode_args))
 
     def visit_Name(self, node):
         """Catches any mention of intrinsic variable names, such as
@@ -341,7 +824,7 @@ class KernelGenerator(ast.NodeVisitor):
         if isinstance(node.value, ast.List):
             # Detect in-place initialisation of multi-dimensional arrays
             tmp_node = node.value
-            decl = c.Value('float', node.targets[0].id)
+            decl = c.Value(self.array_types[node.targets[0].id], node.targets[0].id)
             while isinstance(tmp_node, ast.List):
                 decl = c.ArrayOf(decl, len(tmp_node.elts))
                 if isinstance(tmp_node.elts[0], ast.List):
@@ -438,7 +921,8 @@ class KernelGenerator(ast.NodeVisitor):
         node.ccode = "/"
 
     def visit_Num(self, node):
-        node.ccode = str(node.n)
+        # Floats are printed with all digits, since folded constants may need them
+        node.ccode = repr(node.n) if isinstance(node.n, float) else str(node.n)
 
     def visit_BoolOp(self, node):
         self.visit(node.op)
@@ -487,18 +971,86 @@ class KernelGenerator(ast.NodeVisitor):
         """Record intrinsic fields used in kernel"""
         self.field_args[node.obj.name] = node.obj
 
+    def visit_VectorFieldNode(self, node):
+        """Record the component fields of vector fields used in kernel"""
+        self.vector_args[node.obj.name] = node.obj
+        self.field_args[node.obj.U.name] = node.obj.U
+        self.field_args[node.obj.V.name] = node.obj.V
+
+    def index_vars(self, field):
+        """Names of the particle variables that cache the grid indices of `field`"""
+        for names, fields in self.coordinate_sets:
+            if any(f is field for f in fields):
+                if names[0] not in [v.name for v in self.ptype.variables]:
+                    raise RuntimeError("Particle type %s does not cache the grid indices of field %s; "
+                                       "create kernels with ParticleSet.Kernel" % (self.ptype.name, field.name))
+                return names
+        raise RuntimeError("Field %s is not on the grid of the kernel" % field.name)
+
+    def visit_IndexUpdateNode(self, node):
+        """Search the grid indices of the new particle position once for each
+        set of coordinates used by the fields of the kernel"""
+        fields = self.field_args.values()
+        stmts = []
+        for names, members in self.coordinate_sets:
+            used = [f for f in fields if any(f is m for m in members)]
+            if len(used) == 0:
+                continue
+            # Fields without depth axis share the cell of fields with one
+            field = ([f for f in used if f.data.ndim == 4] + used)[0]
+            index = "&(particle->%s)" % names[node.axis]
+            if node.axis == 0:
+                search = "search_periodic_float(%s, %s->xdim, %s->lon, %s->lon_period, %s)" \
+                    % (node.position.ccode, field.name, field.name, field.name, index)
+            elif node.axis == 1:
+                search = "search_periodic_float(%s, %s->ydim, %s->lat, %s->lat_period, %s)" \
+                    % (node.position.ccode, field.name, field.name, field.name, index)
+            elif field.data.ndim == 4:
+                search = "search_depth(%s, %s->zdim, %s->depth, %s)" \
+                    % (node.position.ccode, field.name, field.name, index)
+            else:
+                continue
+            if node.check_bounds:
+                stmts += [c.Assign("err", search), c.Statement("CHECKERROR(err)")]
+            else:
+                stmts += [c.Statement(search)]
+        node.ccode = c.Collection(stmts)
+
     def visit_ConstNode(self, node):
         self.const_args[node.ccode] = node.obj
 
     def visit_FieldEvalNode(self, node):
         self.visit(node.field)
         self.visit(node.args)
-        ccode_eval = node.field.obj.ccode_eval(node.var, *node.args.ccode)
+        ccode_eval = node.field.obj.ccode_eval(node.var, *node.args.ccode,
+                                               index_vars=self.index_vars(node.field.obj))
         ccode_conv = node.field.obj.ccode_convert(*node.args.ccode)
         node.ccode = c.Block([c.Assign("err", ccode_eval),
                               c.Statement("%s *= %s" % (node.var, ccode_conv)),
                               c.Statement("CHECKERROR(err)")])
 
+    def visit_VectorFieldEvalNode(self, node):
+        self.visit(node.field)
+        self.visit(node.args)
+        vfield = node.field.obj
+        conv = [c.Statement("%s *= %s" % (node.var, vfield.U.ccode_convert(*node.args.ccode))),
+                c.Statement("%s *= %s" % (node.var2, vfield.V.ccode_convert(*node.args.ccode)))]
+        if vfield.fused:
+            # Sample both components with a single search and set of weights
+            ccode_eval = vfield.ccode_eval(node.var, node.var2, *node.args.ccode,
+                                           index_vars=self.index_vars(vfield.U))
+            node.ccode = c.Block([c.Assign("err", ccode_eval),
+                                  c.Statement("CHECKERROR(err)")] + conv)
+        else:
+            ccode_u = vfield.U.ccode_eval(node.var, *node.args.ccode,
+                                          index_vars=self.index_vars(vfield.U))
+            ccode_v = vfield.V.ccode_eval(node.var2, *node.args.ccode,
+                                          index_vars=self.index_vars(vfield.V))
+            node.ccode = c.Block([c.Assign("err", ccode_u),
+                                  c.Statement("CHECKERROR(err)"),
+                                  c.Assign("err", ccode_v),
+                                  c.Statement("CHECKERROR(err)")] + conv)
+
     def visit_Return(self, node):
         self.visit(node.value)
         node.ccode = c.Statement('return %s' % node.value.ccode)
@@ -514,30 +1066,49 @@ class KernelGenerator(ast.NodeVisitor):
 
 class LoopGenerator(object):
     """Code generator class that adds type definitions and the outer
-    loop around kernel functions to generate compilable C code."""
+    loop around kernel functions to generate compilable C code.
+
+    :param instrument: Compile counters of interpolations, index searches,
+                       loop iterations and returned error codes into the code"""
 
-    def __init__(self, grid, ptype=None):
+    def __init__(self, grid, ptype=None, instrument=False):
         self.grid = grid
         self.ptype = ptype
+        self.instrument = instrument
 
-    def generate(self, funcname, field_args, const_args, kernel_ast):
+    def generate(self, funcname, field_args, const_args, kernel_ast,
+                 recovery_ast=None, recovery=None):
+        """Generate the outer particle loop around a kernel function
+
+        :param recovery_ast: Dict of C code of recovery kernels by function name
+        :param recovery: Dict mapping :class:`ErrorCode` to the function names of
+                         recovery kernels to be dispatched inside the loop"""
         ccode = []
 
+        # Enable the counters in the Parcels header
+        if self.instrument:
+            ccode += [str(c.Define("PARCELS_INSTRUMENT", ""))]
+
         # Add include for Parcels and math header
         ccode += [str(c.Include("parcels.h", system=False))]
         ccode += [str(c.Include("math.h", system=False))]
+        ccode += [str(c.Include("string.h", system=False))]
 
         # Generate type definition for particle type
         vdecl = [c.POD(v.dtype, v.name) for v in self.ptype.variables]
         ccode += [str(c.Typedef(c.GenerableStruct("", vdecl, declname=self.ptype.name)))]
 
         # Insert kernel code
+        if recovery_ast is not None:
+            ccode += [str(rec_ast) for rec_ast in recovery_ast.values()]
         ccode += [str(kernel_ast)]
 
         # Generate outer loop for repeated kernel invocation
-        args = [c.Value("int", "num_particles"),
+        args = [c.Value("int", "num_particles"), c.Pointer(c.Value("int", "pindices")),
                 c.Pointer(c.Value(self.ptype.name, "particles")),
-                c.Value("double", "endtime"), c.Value("float", "dt")]
+                c.Pointer(c.Value("int", "deleted")), c.Pointer(c.Value("int", "errored")),
+                c.Pointer(c.Value("int", "counts")),
+                c.Value("double", "endtime"), c.Value("double", "dt")]
         for field, _ in field_args.items():
             args += [c.Pointer(c.Value("CField", "%s" % field))]
         for const, _ in const_args.items():
@@ -546,18 +1117,95 @@ class LoopGenerator(object):
         # Inner loop nest for forward runs
         sign = c.Assign("sign", "dt > 0. ? 1. : -1.")
         dt_pos = c.Assign("__dt", "fmin(fabs(particles[p].dt), fabs(endtime - particles[p].time))")
-        body = [c.Assign("res", "%s(&(particles[p]), %s)" % (funcname, fargs_str))]
+        # Count particle steps in counts[2], repeats in counts[3] and
+        # errors recovered inside the loop in counts[4]
+        body = [c.Assign("res", "%s(&(particles[p]), %s)" % (funcname, fargs_str)),
+                c.Statement("counts[2]++")]
+        if self.instrument:
+            body += [c.Statement("PARCELS_COUNT(iterations, 1)"),
+                     c.Statement("PARCELS_COUNT(errors[res], 1)")]
+        if recovery:
+            # Dispatch recovery kernels on the error code; after a successful
+            # recovery the interrupted timestep is repeated, which is only
+            # counted as a recovery
+            dispatch = None
+            repeat = c.Block([c.Assign("particles[p].state", "REPEAT"), dt_pos,
+                              c.Statement("continue")])
+            for code, rec_name in reversed(list(recovery.items())):
+                rec_call = c.Block([c.Assign("res", "%s(&(particles[p]), %s)" % (rec_name, fargs_str)),
+                                    c.Statement("counts[4]++"),
+                                    c.If("res == SUCCESS", repeat)])
+                dispatch = c.If("res == %s" % ErrorCodeNode.symbol_map[ErrorCode(code).name], rec_call, dispatch)
+            body += [dispatch]
         body += [c.Assign("particles[p].state", "res")]  # Store return code on particle
         body += [c.If("res == SUCCESS", c.Block([c.Statement("particles[p].time += sign * __dt"),
                                                  dt_pos, c.Statement("continue")]))]
-        body += [c.If("res == REPEAT", c.Block([dt_pos, c.Statement("continue")]),
+        body += [c.If("res == REPEAT", c.Block([c.Statement("counts[3]++"), dt_pos,
+                                                c.Statement("continue")]),
                       c.Statement("break"))]
 
         time_loop = c.While("__dt > __tol", c.Block(body))
-        part_loop = c.For("p = 0", "p < num_particles", "++p", c.Block([dt_pos, time_loop]))
-        fbody = c.Block([c.Value("int", "p"), c.Value("ErrorCode", "res"),
+        # Loop over all particles, or only over the given subset of indices
+        pidx = c.Assign("p", "pindices == NULL ? i : pindices[i]")
+        # Skip particles that have been removed from the ParticleSet
+        skip = c.If("particles[p].state == DELETE", c.Statement("continue"))
+        # Record indices of particles that signalled deletion or an error
+        flag = c.If("particles[p].state == DELETE",
+                    c.Statement("deleted[counts[0]++] = p"),
+                    c.If("particles[p].state != SUCCESS && particles[p].state != REPEAT",
+                         c.Statement("errored[counts[1]++] = p")))
+        part_body = [pidx, skip, dt_pos, time_loop, flag]
+        if self.instrument:
+            part_body.insert(2, c.Statement("PARCELS_COUNT(particles, 1)"))
+        part_loop = c.For("i = 0", "i < num_particles", "++i", c.Block(part_body))
+        fbody = c.Block([c.Value("int", "i, p"), c.Value("ErrorCode", "res"),
                          c.Value("double", "__dt, __tol, sign"), c.Assign("__tol", "1.e-6"),
+                         c.Assign("counts[0]", "0"), c.Assign("counts[1]", "0"),
                          sign, part_loop])
         fdecl = c.FunctionDeclaration(c.Value("void", "particle_loop"), args)
         ccode += [str(c.FunctionBody(fdecl, fbody))]
+
+        # Generate leap loop that advances particles through several output
+        # intervals, storing a snapshot of all particles after each leap.
+        # Deleted particles are skipped by later leaps and their indices
+        # accumulated in counts[0]. Returns early with the number of
+        # completed leaps as soon as any particle throws an error, which
+        # is recovered in Python.
+        largs = [c.Value("int", "num_leaps"), c.Value("double", "leaptime"),
+                 c.Value("double", "interval"), c.Value("int", "num_particles"),
+                 c.Pointer(c.Value(self.ptype.name, "particles")),
+                 c.Pointer(c.Value(self.ptype.name, "snapshots")),
+                 c.Pointer(c.Value("int", "deleted")), c.Pointer(c.Value("int", "errored")),
+                 c.Pointer(c.Value("int", "counts")), c.Value("double", "dt")]
+        largs += args[8:]
+        largs_str = ", ".join(["num_particles", "NULL", "particles", "&(deleted[ndeleted])", "errored",
+                               "counts", "leaptime", "dt"] + list(field_args.keys()) + list(const_args.keys()))
+        snapshot = c.If("snapshots != NULL",
+                        c.Statement("memcpy(&(snapshots[k * num_particles]), particles, "
+                                    "num_particles * sizeof(%s))" % self.ptype.name))
+        leap_body = [c.Statement("leaptime += interval"),
+                     c.Statement("particle_loop(%s)" % largs_str),
+                     c.Statement("ndeleted += counts[0]"),
+                     c.Assign("counts[0]", "ndeleted"),
+                     c.If("counts[1] > 0", c.Statement("return k")),
+                     snapshot]
+        leap_loop = c.For("k = 0", "k < num_leaps", "++k", c.Block(leap_body))
+        fbody = c.Block([c.Value("int", "k"), c.Value("int", "ndeleted = 0"),
+                         leap_loop, c.Statement("return num_leaps")])
+        fdecl = c.FunctionDeclaration(c.Value("int", "leap_loop"), largs)
+        ccode += [str(c.FunctionBody(fdecl, fbody))]
+
+        # Exported setter for the global seed of counter-based random streams
+        fdecl = c.FunctionDeclaration(c.Value("void", "set_stream_seed"), [c.Value("int", "seed")])
+        ccode += [str(c.FunctionBody(fdecl, c.Block([c.Statement("parcels_seed_streams(seed)")])))]
+
+        # Exported reset of the normal variate cached in this library, since
+        # reseeding the global generator only resets the copy of parcels.rng
+        fdecl = c.FunctionDeclaration(c.Value("void", "reset_normalvariate"), [])
+        ccode += [str(c.FunctionBody(fdecl, c.Block([c.Statement("parcels_reset_normalvariate()")])))]
+
+        # Exported accessor for the counters of instrumented kernels
+        if self.instrument:
+            fdecl = c.FunctionDeclaration(c.Pointer(c.Value("ParcelsStats", "get_stats")), [])
+            ccode += [str(c.FunctionBody(fdecl, c.Block([c.Statement("return &parcels_stats")])))]
         return "\n\n".join(ccode)
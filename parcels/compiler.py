@@ -1,5 +1,9 @@
+from collections import OrderedDict
+import atexit
+from hashlib import md5
+from multiprocessing import Pool, cpu_count
 import subprocess
-from os import path, environ, getuid, makedirs
+from os import path, environ, getuid, getpid, makedirs, rename
 from tempfile import gettempdir
 
 
@@ -14,6 +18,95 @@ def get_cache_dir():
     return directory
 
 
+def source_hash(ccode):
+    """Hash of C code and the Parcels header it includes"""
+    with open(path.join(get_package_dir(), 'include', 'parcels.h')) as f:
+        return md5((ccode + f.read()).encode('utf-8')).hexdigest()
+
+
+# Libraries compiled in the background by compile_libraries, by file name
+_pending = {}
+# Pools of background compilations, with the results of their jobs
+_pools = []
+
+
+def _reap_pools():
+    """Join the pools of background compilations that have finished"""
+    for pool, results in list(_pools):
+        if all(result.ready() for result in results):
+            pool.join()
+            _pools.remove((pool, results))
+
+
+@atexit.register
+def _terminate_pools():
+    """Stop background compilations that are still running at exit. Their
+    libraries are only renamed into place once complete."""
+    for pool, _ in _pools:
+        pool.terminate()
+        pool.join()
+    del _pools[:]
+
+
+def _build_library(compiler, ccode, src, obj, log):
+    """Write and compile `src` into a private file first, so that
+    concurrent processes never load an incomplete library"""
+    with open(src, 'w') as f:
+        f.write(ccode)
+    tmp = "%s.%d" % (obj, getpid())
+    compiler.compile(src, tmp, log)
+    rename(tmp, obj)
+
+
+def compile_library(compiler, ccode, src, obj, log):
+    """Compile `ccode` into the library `obj`, unless it exists already.
+    Library names are expected to be derived from :func:`source_hash`,
+    so that an existing library is built from the same source.
+
+    :rtype: True if the library was compiled by this call"""
+    if obj in _pending:
+        # Raises any error of the background compilation
+        _pending.pop(obj).get()
+    _reap_pools()
+    if path.exists(obj):
+        return False
+    _build_library(compiler, ccode, src, obj, log)
+    return True
+
+
+def _compile_job(job):
+    name, profile, ccode, src, obj, log = job
+    if not path.exists(obj):
+        _build_library(GNUCompiler(profile=profile), ccode, src, obj, log)
+        print("Compiled %s ==> %s" % (name, obj))
+
+
+def compile_libraries(jobs, processes=None, wait=True):
+    """Compile libraries in a pool of processes
+
+    :param jobs: List of (name, profile, ccode, src, obj, log) tuples
+    :param processes: Number of processes, by default one per CPU
+    :param wait: Whether to block until all libraries are compiled. Otherwise
+                 :func:`compile_library` waits for a library when it is needed."""
+    _reap_pools()
+    jobs = list(OrderedDict((job[4], job) for job in jobs
+                            if not path.exists(job[4]) and job[4] not in _pending).values())
+    if len(jobs) == 0:
+        return
+    pool = Pool(processes=min(processes or cpu_count(), len(jobs)))
+    for job in jobs:
+        _pending[job[4]] = pool.apply_async(_compile_job, (job, ))
+    pool.close()
+    if wait:
+        try:
+            for job in jobs:
+                _pending.pop(job[4]).get()
+        finally:
+            pool.join()
+    else:
+        _pools.append((pool, [_pending[job[4]] for job in jobs]))
+
+
 class Compiler(object):
     """A compiler object for creating and loading shared libraries.
 
@@ -32,21 +125,29 @@ class Compiler(object):
         self._ldargs = ldargs
 
     def compile(self, src, obj, log):
-        cc = [self._cc] + self._cppargs + ['-o', obj, src] + self._ldargs
+        self._run(self._commands(src, obj), src, log)
+
+    def _commands(self, src, obj):
+        """Command lines that build the library `obj` from `src`"""
+        return [[self._cc] + self._cppargs + ['-o', obj, src] + self._ldargs]
+
+    def _run(self, commands, src, log):
         with open(log, 'w') as logfile:
-            logfile.write("Compiling: %s\n" % " ".join(cc))
-            try:
-                subprocess.check_call(cc, stdout=logfile, stderr=logfile)
-            except OSError:
-                err = """OSError during compilation
+            for cc in commands:
+                logfile.write("Compiling: %s\n" % " ".join(cc))
+                logfile.flush()
+                try:
+                    subprocess.check_call(cc, stdout=logfile, stderr=logfile)
+                except OSError:
+                    err = """OSError during compilation
 Please check if compiler exists: %s""" % self._cc
-                raise RuntimeError(err)
-            except subprocess.CalledProcessError:
-                err = """Error during compilation:
+                    raise RuntimeError(err)
+                except subprocess.CalledProcessError:
+                    err = """Error during compilation:
 Compilation command: %s
 Source file: %s
 Log file: %s""" % (" ".join(cc), src, logfile.name)
-                raise RuntimeError(err)
+                    raise RuntimeError(err)
 
 
 class GNUCompiler(Compiler):
@@ -54,9 +155,52 @@ class GNUCompiler(Compiler):
 
     :arg cppargs: A list of arguments to pass to the C compiler
          (optional).
-    :arg ldargs: A list of arguments to pass to the linker (optional)."""
-    def __init__(self, cppargs=[], ldargs=[]):
-        opt_flags = ['-g', '-O3']
+    :arg ldargs: A list of arguments to pass to the linker (optional).
+    :arg profile: Compilation profile, one of
+
+         * ``portable``: Optimised code that runs on any CPU of the
+           host architecture (default)
+         * ``native``: Code tuned for the host CPU (``-march=native``),
+           with math functions that do not set ``errno``, so that they
+           can be inlined. Results are unchanged, since options that
+           reorder floating-point operations are not used.
+         * ``pgo``: Native code, rebuilt with profile data recorded by
+           a training run of a library built with :meth:`compile_training`
+    """
+
+    profiles = OrderedDict([('portable', ['-O3']),
+                            ('native', ['-O3', '-march=native', '-fno-math-errno',
+                                        '-fno-trapping-math']),
+                            ('pgo', ['-O3', '-march=native', '-fno-math-errno',
+                                     '-fno-trapping-math'])])
+
+    def __init__(self, cppargs=[], ldargs=[], profile='portable'):
+        if profile not in self.profiles:
+            raise RuntimeError("Unknown compilation profile '%s', choose one of %s"
+                               % (profile, ", ".join(self.profiles.keys())))
+        self.profile = profile
+        opt_flags = ['-g'] + self.profiles[profile]
         cppargs = ['-Wall', '-fPIC', '-I%s/include' % get_package_dir()] + opt_flags + cppargs
         ldargs = ['-shared'] + ldargs
         super(GNUCompiler, self).__init__("gcc", cppargs=cppargs, ldargs=ldargs)
+
+    def compile_training(self, src, obj, log):
+        """Build a library that records profile data for the ``pgo``
+        profile when the process that loaded it exits"""
+        self._run(self._pgo_commands(src, obj, training=True), src, log)
+
+    def _commands(self, src, obj):
+        if self.profile == 'pgo':
+            return self._pgo_commands(src, obj, training=False)
+        return super(GNUCompiler, self)._commands(src, obj)
+
+    def _pgo_commands(self, src, obj, training):
+        """Compile and link in separate steps, since GCC names profile data
+        after the object file, which is the same for training and final builds"""
+        base = path.splitext(src)[0]
+        if training:
+            pgo = ['-fprofile-generate=%s-pgo' % base]
+        else:
+            pgo = ['-fprofile-use=%s-pgo' % base, '-fprofile-correction', '-Wno-missing-profile']
+        return [[self._cc] + self._cppargs + pgo + ['-c', '-o', '%s.o' % base, src],
+                [self._cc, '-o', obj, '%s.o' % base] + self._ldargs + (pgo if training else [])]
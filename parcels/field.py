@@ -1,17 +1,17 @@
 from scipy.interpolate import RegularGridInterpolator
 from cachetools import cachedmethod, LRUCache
 from collections import Iterable
+from functools import reduce
 from py import path
 import numpy as np
 import xray
 import operator
 from ctypes import Structure, c_int, c_float, c_double, POINTER
 from netCDF4 import Dataset, num2date
-from math import cos, pi
 from datetime import timedelta
 
 
-__all__ = ['CentralDifferences', 'Field', 'Geographic', 'GeographicPolar']
+__all__ = ['CentralDifferences', 'Field', 'VectorField', 'Geographic', 'GeographicPolar']
 
 
 class FieldSamplingError(RuntimeError):
@@ -48,36 +48,101 @@ def CentralDifferences(field_data, lat, lon):
     :param lat: latitude vector
     :param lon: longitude vector
 
+    :rtype: gradient of data in zonal and meridional direction
+    """
+    dVdx, dVdy = central_differences(np.transpose(field_data), lat, lon)
+    return [np.transpose(dVdx), np.transpose(dVdy)]
+
+
+def central_differences(data, lat, lon):
+    """Gradients of data with (..., lat, lon) layout, such as a full
+    (time, lat, lon) field, using central differences in the interior
+    and one-sided differences at the edges
+
     :rtype: gradient of data in zonal and meridional direction
     """
     r = 6.371e6  # radius of the earth
     deg2rd = np.pi / 180
     dy = r * np.diff(lat) * deg2rd
     # calculate the width of each cell, dependent on lon spacing and latitude
-    dx = np.zeros([len(lon)-1, len(lat)], dtype=np.float32)
-    for x in range(len(lon))[1:]:
-        for y in range(len(lat)):
-            dx[x-1, y] = r * np.cos(lat[y] * deg2rd) * (lon[x]-lon[x-1]) * deg2rd
+    dx = (r * np.cos(lat * deg2rd)[:, np.newaxis] * np.diff(lon)[np.newaxis, :] * deg2rd).astype(np.float32)
     # calculate central differences for non-edge cells (with equal weighting)
-    dVdx = np.zeros(shape=np.shape(field_data), dtype=np.float32)
-    dVdy = np.zeros(shape=np.shape(field_data), dtype=np.float32)
-    for x in range(len(lon))[1:-1]:
-        for y in range(len(lat)):
-            dVdx[x, y] = (field_data[x+1, y] - field_data[x-1, y]) / (2 * dx[x-1, y])
-    for x in range(len(lon)):
-        for y in range(len(lat))[1:-1]:
-            dVdy[x, y] = (field_data[x, y+1] - field_data[x, y-1]) / (2 * dy[y-1])
+    dVdx = np.zeros(shape=np.shape(data), dtype=np.float32)
+    dVdy = np.zeros(shape=np.shape(data), dtype=np.float32)
+    dVdx[..., 1:-1] = (data[..., 2:] - data[..., :-2]) / (2 * dx[:, :-1])
+    dVdy[..., 1:-1, :] = (data[..., 2:, :] - data[..., :-2, :]) / (2 * dy[:-1, np.newaxis])
     # Forward and backward difference for edges
-    for x in range(len(lon)):
-        dVdy[x, 0] = (field_data[x, 1] - field_data[x, 0]) / dy[0]
-        dVdy[x, len(lat)-1] = (field_data[x, len(lat)-1] - field_data[x, len(lat)-2]) / dy[len(lat)-2]
-    for y in range(len(lat)):
-        dVdx[0, y] = (field_data[1, y] - field_data[0, y]) / dx[0, y]
-        dVdx[len(lon)-1, y] = (field_data[len(lon)-1, y] - field_data[len(lon)-2, y]) / dx[len(lon)-2, y]
-
+    dVdx[..., 0] = (data[..., 1] - data[..., 0]) / dx[:, 0]
+    dVdx[..., -1] = (data[..., -1] - data[..., -2]) / dx[:, -1]
+    dVdy[..., 0, :] = (data[..., 1, :] - data[..., 0, :]) / dy[0]
+    dVdy[..., -1, :] = (data[..., -1, :] - data[..., -2, :]) / dy[-1]
     return [dVdx, dVdy]
 
 
+class GradientSlices(object):
+    """Time slices of one gradient component of a field, computed when
+    they are first accessed
+
+    Only the most recently used slices are kept, so that gradients are
+    never stored for the whole time axis. Access to the full array,
+    which JIT kernels need, computes all slices once and keeps them.
+
+    :param field: Field to take the gradient of
+    :param component: 0 for the zonal, 1 for the meridional gradient
+    :param indices: Slices of the time, (depth,) lat and lon axes of `field`
+    :param cache: LRU cache of both gradient components by time index,
+                  shared by the two components
+    """
+
+    def __init__(self, field, component, indices, cache):
+        self.field = field
+        self.component = component
+        self.indices = indices
+        self.cache = cache
+        self.lat = field.lat[indices[-2]]
+        self.lon = field.lon[indices[-1]]
+        self.shape = (len(field.time[indices[0]]),) + field.data[(0,) + indices[1:]].shape
+        self.dtype = np.dtype(np.float32)
+        self.ndim = len(self.shape)
+        self._full = None
+
+    def _slice(self, t):
+        if self._full is not None:
+            return self._full[t]
+        if t < 0:
+            t += self.shape[0]
+        if t not in self.cache:
+            tidx = self.indices[0].start + t
+            self.cache[t] = central_differences(
+                self.field.data[(tidx,) + self.indices[1:]], self.lat, self.lon)
+        return self.cache[t][self.component]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple) and len(key) > 0 and isinstance(key[0], (int, np.integer)):
+            return self._slice(int(key[0]))[key[1:]]
+        if isinstance(key, (int, np.integer)):
+            return self._slice(int(key))
+        return np.asarray(self)[key]
+
+    def __array__(self, dtype=None):
+        if self._full is None:
+            print("WARNING: Computing gradient %s for all %d time slices"
+                  % (['dx', 'dy'][self.component], self.shape[0]))
+            self._full = central_differences(
+                self.field.data[self.indices], self.lat, self.lon)[self.component]
+        return self._full if dtype is None else self._full.astype(dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ctypes(self):
+        return np.asarray(self).ctypes
+
+    def reshape(self, *shape):
+        return np.asarray(self).reshape(*shape)
+
+
 class UnitConverter(object):
     """ Interface class for spatial unit conversion during field sampling
         that performs no conversion.
@@ -118,17 +183,28 @@ class GeographicPolar(UnitConverter):
     target_unit = 'degree'
 
     def to_target(self, value, x, y):
-        return value / 1000. / 1.852 / 60. / cos(y * pi / 180)
+        return value / 1000. / 1.852 / 60. / np.cos(y * np.pi / 180)
 
     def ccode_to_target(self, x, y):
         return "(1.0 / (1000. * 1.852 * 60. * cos(%s * M_PI / 180)))" % y
 
 
+class CField(Structure):
+    """Ctypes struct corresponding to the type definition in parcels.h"""
+    _fields_ = [('xdim', c_int), ('ydim', c_int), ('zdim', c_int),
+                ('tdim', c_int), ('tidx', c_int),
+                ('allow_time_extrapolation', c_int),
+                ('lon_period', c_double), ('lat_period', c_double),
+                ('lon', POINTER(c_float)), ('lat', POINTER(c_float)),
+                ('depth', POINTER(c_float)), ('time', POINTER(c_double)),
+                ('data', POINTER(POINTER(c_float)))]
+
+
 class Field(object):
     """Class that encapsulates access to field data.
 
     :param name: Name of the field
-    :param data: 2D array of field data
+    :param data: 2D array of field data, or 3D array with a depth axis
     :param lon: Longitude coordinates of the field
     :param lat: Latitude coordinates of the field
     :param depth: Depth coordinates of the field
@@ -156,13 +232,16 @@ class Field(object):
         self.time_origin = time_origin
         self.units = units if units is not None else UnitConverter()
         self.interp_method = interp_method
+        self.lon_period = 0.
+        self.lat_period = 0.
         if allow_time_extrapolation is None:
             self.allow_time_extrapolation = True if time is None else False
         else:
             self.allow_time_extrapolation = allow_time_extrapolation
 
         # Ensure that field data is the right data type
-        if not self.data.dtype == np.float32:
+        lazy = isinstance(self.data, GradientSlices)
+        if not lazy and not self.data.dtype == np.float32:
             print("WARNING: Casting field data to np.float32")
             self.data = self.data.astype(np.float32)
         if not self.lon.dtype == np.float32:
@@ -171,22 +250,31 @@ class Field(object):
         if not self.lat.dtype == np.float32:
             print("WARNING: Casting lat data to np.float32")
             self.lat = self.lat.astype(np.float32)
+        if not self.depth.dtype == np.float32:
+            print("WARNING: Casting depth data to np.float32")
+            self.depth = self.depth.astype(np.float32)
         if not self.time.dtype == np.float64:
             print("WARNING: Casting time data to np.float64")
             self.time = self.time.astype(np.float64)
-        if transpose:
-            # Make a copy of the transposed array to enforce
-            # C-contiguous memory layout for JIT mode.
-            self.data = np.transpose(self.data).copy()
-        self.data = self.data.reshape((self.time.size, self.lat.size, self.lon.size))
-
-        # Hack around the fact that NaN and ridiculously large values
-        # propagate in SciPy's interpolators
-        if vmin is not None:
-            self.data[self.data < vmin] = 0.
-        if vmax is not None:
-            self.data[self.data > vmax] = 0.
-        self.data[np.isnan(self.data)] = 0.
+        if not lazy:
+            if transpose:
+                # Make a copy of the transposed array to enforce
+                # C-contiguous memory layout for JIT mode.
+                self.data = np.transpose(self.data).copy()
+            # Fields with a depth axis are stored as data[time][depth][lat][lon],
+            # surface fields as data[time][lat][lon]
+            shape = (self.time.size, self.lat.size, self.lon.size)
+            if self.depth.size > 1:
+                shape = (self.time.size, self.depth.size) + shape[1:]
+            self.data = self.data.reshape(shape)
+
+            # Hack around the fact that NaN and ridiculously large values
+            # propagate in SciPy's interpolators
+            if vmin is not None:
+                self.data[self.data < vmin] = 0.
+            if vmax is not None:
+                self.data[self.data > vmax] = 0.
+            self.data[np.isnan(self.data)] = 0.
 
         # Variable names in JIT code
         self.ccode_data = self.name
@@ -195,6 +283,8 @@ class Field(object):
 
         self.interpolator_cache = LRUCache(maxsize=2)
         self.time_index_cache = LRUCache(maxsize=2)
+        self._cstruct = None
+        self._cstruct_key = None
 
     @classmethod
     def from_netcdf(cls, name, dimensions, filenames, indices={},
@@ -204,7 +294,9 @@ class Field(object):
         :param name: Name of the field to create
         :param dimensions: Variable names for the relevant dimensions
         :param filenames: Filenames of the field
-        :param indices: indices for each dimension to read from file
+        :param indices: indices for each dimension to read from file. Only the
+               selected depth levels are read, so that a depth range of a
+               3D field can be loaded without reading the whole water column
         :param allow_time_extrapolation: boolean whether to allow for extrapolation
         """
 
@@ -213,11 +305,10 @@ class Field(object):
         with FileBuffer(filenames[0], dimensions) as filebuffer:
             lon, indslon = filebuffer.read_dimension('lon', indices)
             lat, indslat = filebuffer.read_dimension('lat', indices)
+            depth, indsdepth = filebuffer.read_dimension('depth', indices)
             # Assign time_units if the time dimension has units and calendar
             time_units = filebuffer.time_units
             calendar = filebuffer.calendar
-        # Default depth to zeros until we implement 3D grids properly
-        depth = np.zeros(1, dtype=np.float32)
         # Concatenate time variable to determine overall dimension
         # across multiple files
         timeslices = []
@@ -232,13 +323,14 @@ class Field(object):
             time_origin = num2date(0, time_units, calendar)
 
         # Pre-allocate grid data before reading files into buffer
-        data = np.empty((time.size, 1, lat.size, lon.size), dtype=np.float32)
+        data = np.empty((time.size, depth.size, lat.size, lon.size), dtype=np.float32)
         tidx = 0
         for tslice, fname in zip(timeslices, filenames):
             with FileBuffer(fname, dimensions) as filebuffer:
                 filebuffer.indslat = indslat
                 filebuffer.indslon = indslon
-                data[tidx:(tidx+len(tslice)), 0, :, :] = filebuffer.data[:, :, :]
+                filebuffer.indsdepth = indsdepth
+                data[tidx:(tidx+len(tslice)), :, :, :] = filebuffer.data
             tidx += len(tslice)
         # Time indexing after the fact only
         if 'time' in indices:
@@ -250,48 +342,52 @@ class Field(object):
     def __getitem__(self, key):
         return self.eval(*key)
 
-    def gradient(self, timerange=None, lonrange=None, latrange=None, name=None):
-        """Method to create gradients of Field"""
+    def gradient(self, timerange=None, lonrange=None, latrange=None, name=None, lazy=False):
+        """Method to create gradients of Field
+
+        :param lazy: Compute the gradients of each time slice only when it is
+                     sampled, keeping the two most recently used time slices,
+                     instead of computing them for all times at once
+        """
         if name is None:
             name = 'd' + self.name
 
-        if timerange is None:
-            time_i = range(len(self.time))
-            time = self.time
-        else:
-            time_i = range(np.where(self.time >= timerange[0])[0][0], np.where(self.time <= timerange[1])[0][-1]+1)
-            time = self.time[time_i]
-        if lonrange is None:
-            lon_i = range(len(self.lon))
-            lon = self.lon
+        def index_range(values, valuerange):
+            if valuerange is None:
+                return slice(0, len(values))
+            return slice(np.where(values >= valuerange[0])[0][0],
+                         np.where(values <= valuerange[1])[0][-1]+1)
+
+        indices = (index_range(self.time, timerange), index_range(self.lat, latrange),
+                   index_range(self.lon, lonrange))
+        time, lat, lon = self.time[indices[0]], self.lat[indices[1]], self.lon[indices[2]]
+        if self.data.ndim == 4:
+            # Horizontal gradients on all depth levels
+            indices = indices[:1] + (slice(None),) + indices[1:]
+
+        if lazy:
+            cache = LRUCache(maxsize=2)
+            dVdx = GradientSlices(self, 0, indices, cache)
+            dVdy = GradientSlices(self, 1, indices, cache)
         else:
-            lon_i = range(np.where(self.lon >= lonrange[0])[0][0], np.where(self.lon <= lonrange[1])[0][-1]+1)
-            lon = self.lon[lon_i]
-        if latrange is None:
-            lat_i = range(len(self.lat))
-            lat = self.lat
-        else:
-            lat_i = range(np.where(self.lat >= latrange[0])[0][0], np.where(self.lat <= latrange[1])[0][-1]+1)
-            lat = self.lat[lat_i]
-
-        dVdx = np.zeros(shape=(time.size, lat.size, lon.size), dtype=np.float32)
-        dVdy = np.zeros(shape=(time.size, lat.size, lon.size), dtype=np.float32)
-        for t in np.nditer(np.int32(time_i)):
-            grad = CentralDifferences(np.transpose(self.data[t, :, :][np.ix_(lat_i, lon_i)]), lat, lon)
-            dVdx[t, :, :] = np.array(np.transpose(grad[0]))
-            dVdy[t, :, :] = np.array(np.transpose(grad[1]))
+            dVdx, dVdy = central_differences(self.data[indices], lat, lon)
 
         return([Field(name + '_dx', dVdx, lon, lat, self.depth, time),
                 Field(name + '_dy', dVdy, lon, lat, self.depth, time)])
 
     @cachedmethod(operator.attrgetter('interpolator_cache'))
-    def interpolator2D(self, t_idx):
-        """Provide a cached SciPy interpolator for spatial interpolation
+    def interpolator(self, t_idx):
+        """Provide a cached SciPy interpolator for spatial interpolation,
+        in (lat, lon) for surface fields and (depth, lat, lon) for fields
+        with a depth axis
 
         Note that the interpolator is configured to return NaN for
-        out-of-bounds coordinates.
+        out-of-bounds coordinates. Fields with periodic axes are sampled
+        via :meth:`cell_interpolation` instead.
         """
-        return RegularGridInterpolator((self.lat, self.lon), self.data[t_idx, :],
+        data = self.data[t_idx]
+        points = (self.depth, self.lat, self.lon) if data.ndim == 3 else (self.lat, self.lon)
+        return RegularGridInterpolator(points, data,
                                        bounds_error=False, fill_value=np.nan,
                                        method=self.interp_method)
 
@@ -309,9 +405,43 @@ class Field(object):
         f1 = self.data[tidx+1, :]
         return f0 + (f1 - f0) * ((time - t0) / (t1 - t0))
 
-    def spatial_interpolation(self, tidx, y, x):
-        """Interpolate horizontal field values using a SciPy interpolator"""
-        val = self.interpolator2D(tidx)((y, x))
+    def depth_coordinate(self, z):
+        """Depth `z` clamped to the top level, which is also used if `z`
+        is not given, so that particles at the default depth of 0 sample
+        fields whose first level is below the surface"""
+        return self.depth[0] if z is None else max(z, self.depth[0])
+
+    def cell_interpolation(self, tidx, y, x, z=None):
+        """Interpolate field values from the corners of the grid cell that
+        contains a position, or return NaN if it is out of bounds
+
+        The cell is found by :func:`axis_cell`, which connects the last
+        grid point of periodic axes to the first one, as the cell search
+        of JIT particles does. Unlike a SciPy interpolator on a closed
+        copy of the time slice, this does not copy any field data."""
+        cells = [axis_cell(self.lat, y, self.lat_period), axis_cell(self.lon, x, self.lon_period)]
+        if self.data.ndim == 4:
+            cells.insert(0, axis_cell(self.depth, self.depth_coordinate(z)))
+        if any(cell is None for cell in cells):
+            return np.nan
+        index = [[i0, i1] for i0, i1, _ in cells]
+        if self.interp_method == 'nearest':
+            weights = [[1., 0.] if w < .5 else [0., 1.] for _, _, w in cells]
+        else:
+            weights = [[1. - w, w] for _, _, w in cells]
+        weights = reduce(np.multiply.outer, [np.array(w) for w in weights])
+        return np.sum(self.data[tidx][np.ix_(*index)] * weights)
+
+    def spatial_interpolation(self, tidx, y, x, z=None):
+        """Interpolate field values using a SciPy interpolator, at the
+        first depth level if `z` is not given"""
+        xc, yc = self.periodic_coordinates(x, y)
+        if self.lon_period > 0 or self.lat_period > 0:
+            val = self.cell_interpolation(tidx, yc, xc, z)
+        elif self.data.ndim == 4:
+            val = self.interpolator(tidx)((self.depth_coordinate(z), yc, xc))
+        else:
+            val = self.interpolator(tidx)((yc, xc))
         if np.isnan(val):
             # Detect Out-of-bounds sampling and raise exception
             raise FieldSamplingError(x, y, field=self)
@@ -335,17 +465,53 @@ class Field(object):
         else:
             return time_index.argmin() - 1 if time_index.any() else 0
 
-    def eval(self, time, x, y):
+    def set_periodic(self, zonal=False, meridional=False):
+        """Treat the domain of the field as periodic, so that sampling wraps
+        around the domain boundaries without duplicating data in a halo
+
+        :param zonal: Zonally periodic domain. True to derive the period
+                      from the grid spacing, or the period in degrees or metres
+        :param meridional: Meridionally periodic domain. True to derive the period
+                           from the grid spacing, or the period in degrees or metres
+        """
+        def period(values, periodic):
+            if periodic is True:
+                return float(values[-1] - 2 * values[0] + values[1])
+            return float(periodic) if periodic else 0.
+
+        self.lon_period = period(self.lon, zonal)
+        self.lat_period = period(self.lat, meridional)
+        self.interpolator_cache.clear()
+
+    def cell_indices(self, x, y, z):
+        """Indices of the grid points below arrays of positions along the
+        lon, lat and depth axes, as cached by JIT particles"""
+        def search(values, v):
+            return np.clip(np.searchsorted(values, v, side='right') - 1, 0, values.size - 1)
+        x, y = self.periodic_coordinates(x, y)
+        return search(self.lon, x), search(self.lat, y), search(self.depth, z)
+
+    def periodic_coordinates(self, x, y):
+        """Map a position into the domain of the field along its periodic axes"""
+        if self.lon_period > 0:
+            x = self.lon[0] + np.mod(x - self.lon[0], self.lon_period)
+        if self.lat_period > 0:
+            y = self.lat[0] + np.mod(y - self.lat[0], self.lat_period)
+        return x, y
+
+    def eval(self, time, x, y, z=None):
         """Interpolate field values in space and time.
 
         We interpolate linearly in time and apply implicit unit
         conversion to the result. Note that we defer to
         scipy.interpolate to perform spatial interpolation.
+        Surface fields ignore the depth `z`, and fields with a depth
+        axis are sampled at their first level if `z` is not given.
         """
         t_idx = self.time_index(time)
         if t_idx < len(self.time)-1 and time > self.time[t_idx]:
-            f0 = self.spatial_interpolation(t_idx, y, x)
-            f1 = self.spatial_interpolation(t_idx + 1, y, x)
+            f0 = self.spatial_interpolation(t_idx, y, x, z)
+            f1 = self.spatial_interpolation(t_idx + 1, y, x, z)
             t0 = self.time[t_idx]
             t1 = self.time[t_idx + 1]
             value = f0 + (f1 - f0) * ((time - t0) / (t1 - t0))
@@ -353,42 +519,50 @@ class Field(object):
             # Skip temporal interpolation if time is outside
             # of the defined time range or if we have hit an
             # excat value in the time array.
-            value = self.spatial_interpolation(t_idx, y, x)
+            value = self.spatial_interpolation(t_idx, y, x, z)
 
         return self.units.to_target(value, x, y)
 
-    def ccode_eval(self, var, t, x, y):
+    def ccode_eval(self, var, t, x, y, z=None, index_vars=('xi', 'yi', 'zi')):
+        """C-code of the sampling call, starting the search of the grid cell
+        from the indices cached in the particle variables `index_vars`"""
         # Casting interp_methd to int as easier to pass on in C-code
-        return "temporal_interpolation_linear(%s, %s, %s, %s, %s, %s, &%s, %s)" \
-            % (x, y, "particle->xi", "particle->yi", t, self.name, var,
-               self.interp_method.upper())
+        if z is None:
+            z = "%s->depth[0]" % self.name
+        xi, yi, zi = ["particle->%s" % v for v in index_vars]
+        return "temporal_interpolation_linear(%s, %s, %s, %s, %s, %s, %s, %s, &%s, %s)" \
+            % (x, y, z, xi, yi, zi, t, self.name, var, self.interp_method.upper())
 
-    def ccode_convert(self, _, x, y):
+    def ccode_convert(self, _, x, y, z=None):
         return self.units.ccode_to_target(x, y)
 
     @property
     def ctypes_struct(self):
         """Returns a ctypes struct object containing all relevant
-        pointers and sizes for this field."""
-
-        # Ctypes struct corresponding to the type definition in parcels.h
-        class CField(Structure):
-            _fields_ = [('xdim', c_int), ('ydim', c_int),
-                        ('tdim', c_int), ('tidx', c_int),
-                        ('allow_time_extrapolation', c_int),
-                        ('lon', POINTER(c_float)), ('lat', POINTER(c_float)),
-                        ('time', POINTER(c_double)),
-                        ('data', POINTER(POINTER(c_float)))]
-
-        # Create and populate the c-struct object
+        pointers and sizes for this field.
+
+        The struct is cached and only re-created when the field arrays
+        have been replaced or resized, so that it can be passed to
+        compiled kernels repeatedly without re-marshaling."""
         allow_time_extrapolation = 1 if self.allow_time_extrapolation else 0
-        cstruct = CField(self.lon.size, self.lat.size, self.time.size, 0,
-                         allow_time_extrapolation,
-                         self.lon.ctypes.data_as(POINTER(c_float)),
-                         self.lat.ctypes.data_as(POINTER(c_float)),
-                         self.time.ctypes.data_as(POINTER(c_double)),
-                         self.data.ctypes.data_as(POINTER(POINTER(c_float))))
-        return cstruct
+        key = (self.lon.ctypes.data, self.lat.ctypes.data, self.depth.ctypes.data,
+               self.time.ctypes.data, self.data.ctypes.data,
+               self.lon.size, self.lat.size, self.depth.size, self.time.size,
+               allow_time_extrapolation, self.lon_period, self.lat_period)
+        if self._cstruct is None or key != self._cstruct_key:
+            # Create and populate the c-struct object; surface fields are
+            # passed with a single depth level
+            zdim = self.depth.size if self.data.ndim == 4 else 1
+            self._cstruct = CField(self.lon.size, self.lat.size, zdim, self.time.size, 0,
+                                   allow_time_extrapolation,
+                                   self.lon_period, self.lat_period,
+                                   self.lon.ctypes.data_as(POINTER(c_float)),
+                                   self.lat.ctypes.data_as(POINTER(c_float)),
+                                   self.depth.ctypes.data_as(POINTER(c_float)),
+                                   self.time.ctypes.data_as(POINTER(c_double)),
+                                   self.data.ctypes.data_as(POINTER(POINTER(c_float))))
+            self._cstruct_key = key
+        return self._cstruct
 
     def show(self, with_particles=False, animation=False, show_time=0, vmin=None, vmax=None):
         """Method to 'show' a :class:`Field` using matplotlib
@@ -449,14 +623,14 @@ class Field(object):
         """
         if zonal:
             lonshift = (self.lon[-1] - 2 * self.lon[0] + self.lon[1])
-            self.data = np.concatenate((self.data[:, :, -halosize:], self.data,
-                                        self.data[:, :, 0:halosize]), axis=len(self.data.shape)-1)
+            self.data = np.concatenate((self.data[..., -halosize:], self.data,
+                                        self.data[..., 0:halosize]), axis=len(self.data.shape)-1)
             self.lon = np.concatenate((self.lon[-halosize:] - lonshift,
                                        self.lon, self.lon[0:halosize] + lonshift))
         if meridional:
             latshift = (self.lat[-1] - 2 * self.lat[0] + self.lat[1])
-            self.data = np.concatenate((self.data[:, -halosize:, :], self.data,
-                                        self.data[:, 0:halosize, :]), axis=len(self.data.shape)-2)
+            self.data = np.concatenate((self.data[..., -halosize:, :], self.data,
+                                        self.data[..., 0:halosize, :]), axis=len(self.data.shape)-2)
             self.lat = np.concatenate((self.lat[-halosize:] - latshift,
                                        self.lat, self.lat[0:halosize] + latshift))
 
@@ -488,6 +662,94 @@ class Field(object):
         dset.to_netcdf(filepath)
 
 
+def axis_cell(values, x, period=0.):
+    """Corner indices and linear interpolation weight of the cell that
+    contains `x` along a grid axis, or None if `x` is out of bounds
+
+    On periodic axes, `x` is expected in [values[0], values[0] + period)
+    and the last cell connects the last grid point to the first one.
+    """
+    if period > 0:
+        i = np.searchsorted(values, x, side='right') - 1
+        if i == values.size - 1:
+            return i, 0, (x - values[i]) / (values[0] + period - values[i])
+    elif values[0] <= x <= values[-1]:
+        i = min(max(np.searchsorted(values, x, side='right') - 1, 0), values.size - 2)
+    else:
+        return None
+    return i, i + 1, (x - values[i]) / (values[i+1] - values[i])
+
+
+class VectorField(object):
+    """Pair of :class:`Field` objects for the zonal and meridional
+    components of a vector, that are sampled together.
+
+    If both components share the same coordinates and interpolation
+    method, sampling searches the grid cell and computes the
+    interpolation weights only once for both components.
+
+    :param name: Name of the vector field
+    :param U: :class:`Field` of the zonal component
+    :param V: :class:`Field` of the meridional component
+    """
+
+    def __init__(self, name, U, V):
+        self.name = name
+        self.U = U
+        self.V = V
+        self.fused = (U.interp_method == V.interp_method
+                      and U.lon_period == V.lon_period and U.lat_period == V.lat_period
+                      and all(a is b or (a.shape == b.shape and np.all(a == b))
+                              for a, b in [(U.lon, V.lon), (U.lat, V.lat), (U.time, V.time)])
+                      and U.data.ndim == V.data.ndim
+                      and (U.data.ndim == 3 or np.array_equal(U.depth, V.depth)))
+
+    def __getitem__(self, key):
+        return self.eval(*key)
+
+    def eval(self, time, x, y, z=None):
+        """Interpolate both components in space and time
+
+        :rtype: Tuple of the zonal and meridional components"""
+        if not self.fused or self.U.interp_method != 'linear':
+            return self.U.eval(time, x, y, z), self.V.eval(time, x, y, z)
+        xc, yc = self.U.periodic_coordinates(x, y)
+        xcell = axis_cell(self.U.lon, xc, self.U.lon_period)
+        ycell = axis_cell(self.U.lat, yc, self.U.lat_period)
+        if xcell is None or ycell is None:
+            raise FieldSamplingError(x, y, field=self)
+        (i0, i1, wx), (j0, j1, wy) = xcell, ycell
+        index = [[j0, j1], [i0, i1]]
+        weights = np.array([[(1 - wx) * (1 - wy), wx * (1 - wy)],
+                            [(1 - wx) * wy, wx * wy]])
+        if self.U.data.ndim == 4:
+            zcell = axis_cell(self.U.depth, self.U.depth_coordinate(z))
+            if zcell is None:
+                raise FieldSamplingError(x, y, field=self)
+            k0, k1, wz = zcell
+            index = [[k0, k1]] + index
+            weights = np.array([weights * (1 - wz), weights * wz])
+        cell = np.ix_(*index)
+
+        t_idx = self.U.time_index(time)
+        u = np.sum(self.U.data[t_idx][cell] * weights)
+        v = np.sum(self.V.data[t_idx][cell] * weights)
+        if t_idx < len(self.U.time)-1 and time > self.U.time[t_idx]:
+            tw = (time - self.U.time[t_idx]) / (self.U.time[t_idx+1] - self.U.time[t_idx])
+            u += (np.sum(self.U.data[t_idx+1][cell] * weights) - u) * tw
+            v += (np.sum(self.V.data[t_idx+1][cell] * weights) - v) * tw
+        return self.U.units.to_target(u, x, y), self.V.units.to_target(v, x, y)
+
+    def ccode_eval(self, varu, varv, t, x, y, z=None, index_vars=('xi', 'yi', 'zi')):
+        """Fused sampling call, only valid if the components are :attr:`fused`"""
+        if z is None:
+            z = "%s->depth[0]" % self.U.name
+        xi, yi, zi = ["particle->%s" % v for v in index_vars]
+        return "temporal_interpolation_linear_uv(%s, %s, %s, %s, %s, %s, %s, %s, %s, &%s, &%s, %s)" \
+            % (x, y, z, xi, yi, zi, t, self.U.name, self.V.name,
+               varu, varv, self.U.interp_method.upper())
+
+
 class FileBuffer(object):
     """ Class that encapsulates and manages deferred access to file data. """
 
@@ -521,12 +783,26 @@ class FileBuffer(object):
         lat = self.dataset[self.dimensions['lat']]
         return lat[:, 0] if len(lat.shape) > 1 else lat[:]
 
+    @property
+    def depth(self):
+        """Depth levels, or a single level at 0 for files without depth axis"""
+        name = self.dimensions.get('depth')
+        var = self.dataset[self.dimensions['data']]
+        if name not in self.dataset.variables and len(var.shape) == 4:
+            # NEMO names the depth axis of each variable differently (depthu, depthv, ...)
+            name = var.dimensions[1]
+        if name not in self.dataset.variables:
+            return np.zeros(1, dtype=np.float32)
+        return self.dataset[name][:]
+
     @property
     def data(self):
-        if len(self.dataset[self.dimensions['data']].shape) == 3:
-            return self.dataset[self.dimensions['data']][:, self.indslat, self.indslon]
+        """Data of the selected depth levels, with (time, depth, lat, lon) layout"""
+        var = self.dataset[self.dimensions['data']]
+        if len(var.shape) == 3:
+            return var[:, self.indslat, self.indslon][:, np.newaxis, :, :]
         else:
-            return self.dataset[self.dimensions['data']][:, 0, self.indslat, self.indslon]
+            return var[:, self.indsdepth, self.indslat, self.indslon]
 
     @property
     def time(self):
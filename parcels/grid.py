@@ -1,4 +1,4 @@
-from parcels.field import Field, UnitConverter, Geographic, GeographicPolar
+from parcels.field import Field, VectorField, UnitConverter, Geographic, GeographicPolar
 import numpy as np
 from py import path
 from glob import glob
@@ -31,15 +31,42 @@ class Grid(object):
     :param V: :class:`parcels.field.Field` object for meridional velocity component
     :param allow_time_extrapolation: boolean whether to allow for extrapolation
     :param fields: Dictionary of additional :class:`parcels.field.Field` objects
+
+    The settings of the adaptive :func:`AdvectionDOPRI5` kernel, `dopri_tol`,
+    `dopri_dtmin` and `dopri_dtmax`, are class attributes shared by all grids.
+    Change them by assigning to a grid instance, e.g. ``grid.dopri_tol = 10.``,
+    which only affects that grid. Assigning to ``Grid.dopri_tol`` changes the
+    default of every grid.
     """
+    # Default settings of the adaptive AdvectionDOPRI5 kernel: local error
+    # tolerance in metres and the bounds of the adaptive sub-step in seconds
+    dopri_tol = 1.
+    dopri_dtmin = 1.
+    dopri_dtmax = 86400.
+
     def __init__(self, U, V, allow_time_extrapolation=False, fields={}):
         self.U = U
         self.V = V
+        self._uv = None
 
         # Add additional fields as attributes
         for name, field in fields.items():
             setattr(self, name, field)
 
+    @property
+    def UV(self):
+        """:class:`parcels.field.VectorField` of the U and V velocity fields,
+        to sample both components at once via ``u, v = grid.UV[time, lon, lat]``"""
+        if self._uv is None or self._uv.U is not self.U or self._uv.V is not self.V:
+            self._uv = VectorField('UV', self.U, self.V)
+        return self._uv
+
+    @property
+    def spherical(self):
+        """Whether the grid coordinates are in degrees, as determined by the
+        unit conversion of the V field"""
+        return isinstance(self.V.units, Geographic)
+
     @classmethod
     def from_data(cls, data_u, lon_u, lat_u, data_v, lon_v, lat_v,
                   depth=None, time=None, field_data={}, transpose=True,
@@ -54,7 +81,10 @@ class Grid(object):
         :param lat_v: Latitude coordinates of the V data
         :param depth: Depth coordinates of all :class:`Field` objects on the grid
         :param time: Time coordinates of all :class:`Field` objects on the grid
-        :param field_data: Dictionary of extra fields (name, data)
+        :param field_data: Dictionary of extra fields (name, data). Fields
+               on their own coordinates, such as coarser forcing fields, are
+               given as (name, (data, lon, lat)). Otherwise, the fields are
+               defined on the longitudes of V and the latitudes of U.
         :param transpose: Boolean whether to transpose data on read-in
         :param mesh: String indicating the type of mesh coordinates and
                units used during velocity interpolation:
@@ -78,7 +108,10 @@ class Grid(object):
         # Create additional data fields
         fields = {}
         for name, data in field_data.items():
-            fields[name] = Field(name, data, lon_v, lat_u, depth=depth,
+            lon, lat = lon_v, lat_u
+            if isinstance(data, tuple):
+                data, lon, lat = data
+            fields[name] = Field(name, data, lon, lat, depth=depth,
                                  time=time, transpose=transpose,
                                  allow_time_extrapolation=allow_time_extrapolation, **kwargs)
         return cls(ufield, vfield, fields=fields)
@@ -155,6 +188,41 @@ class Grid(object):
         associated with this grid"""
         return [v for v in self.__dict__.values() if isinstance(v, Field)]
 
+    @property
+    def coordinate_sets(self):
+        """Groups of the :class:`parcels.field.Field` objects on this grid
+        that are defined on the same coordinates, as a list of tuples of
+        index variable names and fields.
+
+        JIT particles cache their grid indices for each group, so that
+        fields on staggered or coarser grids are sampled without searching
+        from stale indices, while fields on the same coordinates share one
+        search. The indices of the group of U are held in ``xi``, ``yi``
+        and ``zi``, those of further groups in ``xi_<n>``, ``yi_<n>`` and
+        ``zi_<n>``. Fields without depth axis join groups with one."""
+        def same(a, b):
+            return a is b or (a.shape == b.shape and np.all(a == b))
+
+        others = sorted([f for f in self.fields if f is not self.U and f is not self.V],
+                        key=lambda f: f.name)
+        sets = []
+        for field in [self.U, self.V] + others:
+            for _, fields in sets:
+                if any(f is field for f in fields):
+                    break
+                first = fields[0]
+                depths = [f.depth for f in fields if f.data.ndim == 4]
+                if same(first.lon, field.lon) and same(first.lat, field.lat) \
+                   and first.lon_period == field.lon_period and first.lat_period == field.lat_period \
+                   and (field.data.ndim == 3 or len(depths) == 0 or same(depths[0], field.depth)):
+                    fields.append(field)
+                    break
+            else:
+                suffix = '' if len(sets) == 0 else '_%d' % len(sets)
+                names = tuple('%s%s' % (i, suffix) for i in ('xi', 'yi', 'zi'))
+                sets.append((names, [field]))
+        return sets
+
     def add_field(self, field):
         """Add a :class:`parcels.field.Field` object to the grid
 
@@ -194,6 +262,23 @@ class Grid(object):
             if isinstance(value, Field):
                 value.add_periodic_halo(zonal, meridional, halosize)
 
+    def set_periodic(self, zonal=False, meridional=False):
+        """Make all :class:`parcels.field.Field` objects on a grid periodic,
+        so that particles and sampling wrap around the domain boundaries.
+        Unlike :meth:`add_periodic_halo`, this does not copy any field data
+        and does not require a kernel to move particles back into the domain.
+
+        Note that particle positions are not wrapped, so that zonally
+        periodic trajectories keep increasing longitudes.
+
+        :param zonal: Periodic in zonal direction (boolean, or the period)
+        :param meridional: Periodic in meridional direction (boolean, or the period)
+        """
+        for attr, value in self.__dict__.iteritems():
+            if isinstance(value, Field):
+                value.set_periodic(zonal, meridional)
+        self._uv = None
+
     def eval(self, x, y):
         """Evaluate the zonal and meridional velocities (u,v) at a point (x,y)
 
@@ -1,24 +1,73 @@
 from parcels.codegenerator import KernelGenerator, LoopGenerator
-from parcels.compiler import get_cache_dir
+from parcels.compiler import (get_cache_dir, source_hash, compile_library, compile_libraries,
+                              GNUCompiler)
 from parcels.kernels.error import ErrorCode, recovery_map as recovery_base_map
-from parcels.field import FieldSamplingError
+from parcels.field import FieldSamplingError, CField, Field
+from parcels.profiling import Profile
 from os import path
+from shutil import copyfile
+import os
+import sys
+import traceback
+import json
+import numpy as np
 import numpy.ctypeslib as npct
-from ctypes import c_int, c_float, c_double, c_void_p, byref
+from ctypes import (CDLL, Structure, c_int, c_float, c_double, c_longlong, c_void_p,
+                    byref, POINTER, memset, sizeof)
 from ast import parse, FunctionDef, Module
 import inspect
 from copy import deepcopy
+from collections import OrderedDict
 import re
-from hashlib import md5
+import parcels.rng
 import math  # noqa
 import random  # noqa
 
 
-__all__ = ['Kernel']
+__all__ = ['Kernel', 'compile_kernels']
 
 
 re_indent = re.compile(r"^(\s+)")
 
+# Recovery kernels that have been reported to execute in Python
+_python_recovery = set()
+
+
+class CStats(Structure):
+    """Ctypes struct corresponding to ParcelsStats in parcels.h"""
+    _fields_ = [('particles', c_longlong), ('iterations', c_longlong),
+                ('interpolations', c_longlong), ('searches', c_longlong),
+                ('search_steps', c_longlong), ('errors', c_longlong * len(ErrorCode))]
+
+
+def compile_kernels(kernels, processes=None, wait=True):
+    """Compile JIT kernels ahead of time in a pool of processes
+
+    Libraries are cached on disk, so that :meth:`ParticleSet.execute`
+    loads them without compiling. The random number library is compiled
+    along, if needed. Kernels with the ``pgo`` compilation profile are
+    skipped, since they are trained on the particles they execute.
+
+    :param kernels: List of :class:`Kernel` objects
+    :param processes: Number of compiler processes, by default one per CPU
+    :param wait: Whether to block until all kernels are compiled. Otherwise
+                 compilation continues in the background, so that it
+                 overlaps with other setup work, and each kernel waits for
+                 its library when it is executed.
+    """
+    rng = parcels.rng.parcels_random
+    jobs = [('random', 'portable', rng.ccode, rng.src_file, rng.lib_file, rng.log_file)]
+    for kernel in kernels:
+        if not kernel.ptype.uses_jit:
+            continue
+        if kernel.compiler_profile == 'pgo':
+            print("Warning: Kernel %s uses profile-guided optimisation and is compiled when executed"
+                  % kernel.name)
+            continue
+        jobs.append((kernel.name, kernel.compiler_profile, kernel.ccode, kernel.src_file,
+                     kernel.lib_file, kernel.log_file))
+    compile_libraries(jobs, processes=processes, wait=wait)
+
 
 def fix_indentation(string):
     """Fix indentation to allow in-lined kernel definitions"""
@@ -34,6 +83,20 @@ class Kernel(object):
 
     :arg grid: Grid object providing the field information
     :arg ptype: PType object for the kernel particle
+    :arg recovery: Dictionary mapping :class:`parcels.kernels.error.ErrorCode`
+                   to recovery kernels. In JIT mode, recovery kernels written in
+                   the kernel language are compiled into the core loop, all others
+                   are executed in Python.
+    :arg random_streams: Draw random numbers in the kernel from counter-based
+                         streams keyed on the global seed, the particle ID and
+                         the time, which makes results independent of the order
+                         of particles. SciPy kernels need to use :mod:`parcels.rng`
+                         (imported as ``from parcels import random``).
+    :arg instrument: Compile counters of particles, loop iterations, field
+                     interpolations, index search steps and returned error
+                     codes into a JIT kernel, available via :meth:`stats`.
+    :arg compiler_profile: Compilation profile of JIT kernels, see
+                           :class:`parcels.compiler.GNUCompiler`
 
     Note: A Kernel is either created from a compiled <function ...> object
     or the necessary information (funcname, funccode, funcvars) is provided.
@@ -42,9 +105,15 @@ class Kernel(object):
     """
 
     def __init__(self, grid, ptype, pyfunc=None, funcname=None,
-                 funccode=None, py_ast=None, funcvars=None):
+                 funccode=None, py_ast=None, funcvars=None, recovery=None,
+                 random_streams=False, instrument=False, compiler_profile='portable'):
         self.grid = grid
         self.ptype = ptype
+        self.bundle = None
+        self.random_streams = random_streams
+        self.instrument = instrument
+        self.compiler_profile = compiler_profile
+        self.recovery = dict(recovery) if recovery is not None else {}
 
         # Derive meta information from pyfunc, if not given
         self.funcname = funcname or pyfunc.__name__
@@ -75,15 +144,33 @@ class Kernel(object):
 
         # Generate the kernel function and add the outer loop
         if self.ptype.uses_jit:
-            kernelgen = KernelGenerator(grid, ptype)
+            kernelgen = KernelGenerator(grid, ptype, self.random_streams)
             self.field_args = kernelgen.field_args
             kernel_ccode = kernelgen.generate(deepcopy(self.py_ast),
                                               self.funcvars)
+            self.recovery_jit = self._translatable_recovery()
+            recovery_ccode = OrderedDict()
+            if len(self.recovery_jit) > 0:
+                # Recovery kernels are called with the same arguments as the
+                # main kernel, so generate all functions again once the union
+                # of fields and constants they use is known
+                rec_funcs = OrderedDict((f.__name__, f) for f in self.recovery_jit.values())
+                for func in rec_funcs.values():
+                    kernelgen.generate(self._recovery_ast(func), list(func.__code__.co_varnames),
+                                       check_bounds=False)
+                kernel_ccode = kernelgen.generate(deepcopy(self.py_ast), self.funcvars)
+                for name, func in rec_funcs.items():
+                    recovery_ccode[name] = kernelgen.generate(self._recovery_ast(func),
+                                                              list(func.__code__.co_varnames),
+                                                              check_bounds=False)
             self.field_args = kernelgen.field_args
+            self.vector_args = kernelgen.vector_args
             self.const_args = kernelgen.const_args
-            loopgen = LoopGenerator(grid, ptype)
+            loopgen = LoopGenerator(grid, ptype, self.instrument)
             self.ccode = loopgen.generate(self.funcname, self.field_args, self.const_args,
-                                          kernel_ccode)
+                                          kernel_ccode, recovery_ccode,
+                                          OrderedDict((code, f.__name__) for code, f
+                                                      in self.recovery_jit.items()))
 
             basename = path.join(get_cache_dir(), self._cache_key)
             self.src_file = "%s.c" % basename
@@ -95,35 +182,419 @@ class Kernel(object):
     def _cache_key(self):
         field_keys = "-".join(["%s:%s" % (name, field.units.__class__.__name__)
                                for name, field in self.field_args.items()])
-        key = self.name + self.ptype._cache_key + field_keys
-        return md5(key.encode('utf-8')).hexdigest()
-
-    def compile(self, compiler):
-        """ Writes kernel code to file and compiles it."""
-        with open(self.src_file, 'w') as f:
-            f.write(self.ccode)
-        compiler.compile(self.src_file, self.lib_file, self.log_file)
-        print("Compiled %s ==> %s" % (self.name, self.lib_file))
-
-    def load_lib(self):
-        self._lib = npct.load_library(self.lib_file, '.')
+        # Vector fields generate different code depending on whether their components are fused
+        field_keys += "".join(["-%s:%s" % (name, 'fused' if vfield.fused else 'split')
+                               for name, vfield in self.vector_args.items()])
+        recovery_keys = "-".join(["%s:%s" % (code, func.__name__)
+                                  for code, func in self.recovery_jit.items()])
+        key = self.name + self.ptype._cache_key + field_keys + recovery_keys
+        if self.random_streams:
+            key += "-streams"
+        if self.instrument:
+            key += "-instrument"
+        key += "-%s" % self.compiler_profile
+        # Libraries are only compiled if missing, so the key covers the full source
+        return source_hash(key + self.ccode)
+
+    @staticmethod
+    def _recovery_ast(func):
+        try:
+            py_ast = parse(fix_indentation(inspect.getsource(func.__code__))).body[0]
+        except (IOError, TypeError, SyntaxError):
+            raise NotImplementedError("Source code of %s is not available" % func.__name__)
+        if not isinstance(py_ast, FunctionDef):
+            raise NotImplementedError("%s is not defined by a function definition" % func.__name__)
+        return py_ast
+
+    def _translatable_recovery(self):
+        """Select the recovery kernels that can be translated to C. All
+        others are executed in Python, which is reported once per kernel."""
+        recovery_jit = OrderedDict()
+        for code in sorted(self.recovery.keys()):
+            func = self.recovery[code]
+            try:
+                KernelGenerator(self.grid, self.ptype, self.random_streams).generate(
+                    self._recovery_ast(func), list(func.__code__.co_varnames),
+                    check_bounds=False)
+            except NotImplementedError as e:
+                if func.__code__ not in _python_recovery:
+                    _python_recovery.add(func.__code__)
+                    print("Warning: Recovery kernel %s for %s is executed in Python (%s)"
+                          % (func.__name__, ErrorCode(code).name, e))
+                continue
+            recovery_jit[code] = func
+        return recovery_jit
+
+    def _require_source(self, action):
+        if self.bundle is not None:
+            raise RuntimeError("Kernel %s was loaded from bundle %s, so it cannot %s"
+                               % (self.name, self.bundle, action))
+
+    def with_recovery(self, recovery):
+        """Create a copy of this kernel with different recovery kernels"""
+        self._require_source("change its recovery kernels")
+        return Kernel(self.grid, self.ptype, pyfunc=self.pyfunc, funcname=self.funcname,
+                      funccode=self.funccode, py_ast=self.py_ast, funcvars=self.funcvars,
+                      recovery=recovery, random_streams=self.random_streams,
+                      instrument=self.instrument, compiler_profile=self.compiler_profile)
+
+    def with_compiler_profile(self, compiler_profile):
+        """Create a copy of this kernel with a different compilation profile"""
+        self._require_source("change its compilation profile")
+        return Kernel(self.grid, self.ptype, pyfunc=self.pyfunc, funcname=self.funcname,
+                      funccode=self.funccode, py_ast=self.py_ast, funcvars=self.funcvars,
+                      recovery=self.recovery, random_streams=self.random_streams,
+                      instrument=self.instrument, compiler_profile=compiler_profile)
+
+    def compile(self, compiler, pset=None, endtime=None, dt=None):
+        """ Writes kernel code to file and compiles it, unless the library
+        is cached already or being compiled by :func:`compile_kernels`.
+
+        With the ``pgo`` compilation profile, an instrumented build is first
+        trained on a copy of the particles in `pset`, which are advanced
+        towards `endtime` by at most :attr:`pgo_steps` timesteps of `dt`."""
+        if self.bundle is not None:
+            if not path.exists(self.lib_file):
+                raise IOError("Library of kernel bundle %s not found: %s"
+                              % (self.bundle, self.lib_file))
+            return
+        if getattr(compiler, 'profile', None) == 'pgo' and pset is not None \
+           and not path.exists(self.lib_file):
+            with open(self.src_file, 'w') as f:
+                f.write(self.ccode)
+            self._train(compiler, pset, endtime, dt)
+        if compile_library(compiler, self.ccode, self.src_file, self.lib_file, self.log_file):
+            print("Compiled %s ==> %s" % (self.name, self.lib_file))
+
+    # Number of timesteps of the training run for profile-guided optimisation
+    pgo_steps = 20
+
+    # Format version of kernel bundles
+    bundle_version = 1
+
+    def export_bundle(self, name):
+        """Export the compiled library of a JIT kernel with its metadata,
+        so that it can be loaded via :meth:`from_bundle` on machines
+        without a C compiler
+
+        A bundle consists of the library ``name.so`` and a JSON header
+        ``name.json`` describing the particle variables, the order of
+        field and constant arguments and the recovery kernels compiled
+        into the core loop. The kernel is compiled first if needed.
+
+        :param name: Basename of the bundle files
+        """
+        if not self.ptype.uses_jit:
+            raise RuntimeError("Only JIT kernels can be exported as bundles")
+        if not path.exists(self.lib_file):
+            self.compile(GNUCompiler(profile=self.compiler_profile))
+        header = {'version': self.bundle_version,
+                  'name': self.name,
+                  'funcname': self.funcname,
+                  'library': path.basename("%s.so" % name),
+                  'parcels_h': source_hash(''),
+                  'ptype': self.ptype._cache_key,
+                  'fields': [[fname, field.units.__class__.__name__]
+                             for fname, field in self.field_args.items()],
+                  'vector_fields': [[vname, 'fused' if vfield.fused else 'split']
+                                    for vname, vfield in self.vector_args.items()],
+                  'constants': list(self.const_args.keys()),
+                  'recovery': [[int(code), func.__name__]
+                               for code, func in self.recovery_jit.items()],
+                  'random_streams': self.random_streams,
+                  'instrument': self.instrument,
+                  'compiler_profile': self.compiler_profile}
+        copyfile(self.lib_file, "%s.so" % name)
+        with open("%s.json" % name, 'w') as f:
+            json.dump(header, f, indent=2)
+
+    @classmethod
+    def from_bundle(cls, name, grid, ptype, recovery=None):
+        """Load a JIT kernel exported by :meth:`export_bundle` without
+        generating or compiling code
+
+        :param name: Basename of the bundle files
+        :param grid: Grid providing the fields and constants of the kernel
+        :param ptype: PType object of the particles, which has to match the
+                      particle type the bundle was exported for
+        :param recovery: Dictionary of recovery kernels. Those compiled into
+                         the bundle have to be given again, since the
+                         ParticleSet re-generates kernels whose recovery
+                         kernels change.
+        """
+        filename = "%s.json" % name
+        if not path.exists(filename):
+            raise IOError("Kernel bundle not found: %s" % filename)
+        with open(filename) as f:
+            header = json.load(f)
+        if header.get('version') != cls.bundle_version:
+            raise IOError("Unsupported kernel bundle version %s" % header.get('version'))
+        if header['parcels_h'] != source_hash(''):
+            raise RuntimeError("Kernel bundle %s was built for a different version of Parcels"
+                               % name)
+        if header['ptype'] != ptype._cache_key:
+            raise RuntimeError("Kernel bundle %s was built for particle variables %s, not %s"
+                               % (name, header['ptype'], ptype._cache_key))
+        field_args = OrderedDict()
+        for fname, units in header['fields']:
+            field = getattr(grid, fname, None)
+            if not isinstance(field, Field) or field.units.__class__.__name__ != units:
+                raise RuntimeError("Kernel bundle %s requires field %s with %s units"
+                                   % (name, fname, units))
+            field_args[fname] = field
+        vector_args = OrderedDict()
+        for vname, mode in header['vector_fields']:
+            vfield = getattr(grid, vname, None)
+            if not hasattr(vfield, 'fused') or ('fused' if vfield.fused else 'split') != mode:
+                raise RuntimeError("Kernel bundle %s requires %s vector field %s"
+                                   % (name, mode, vname))
+            vector_args[vname] = vfield
+        const_args = OrderedDict()
+        for cname in header['constants']:
+            if not hasattr(grid, cname):
+                raise RuntimeError("Kernel bundle %s requires grid constant %s" % (name, cname))
+            const_args[cname] = getattr(grid, cname)
+        recovery = dict(recovery) if recovery is not None else {}
+        recovery_jit = OrderedDict()
+        for code, fname in header['recovery']:
+            func = recovery.get(code, None)
+            if func is None or func.__name__ != fname:
+                raise RuntimeError("Kernel bundle %s was built with recovery kernel %s for %s"
+                                   % (name, fname, ErrorCode(code).name))
+            recovery_jit[ErrorCode(code)] = func
+
+        kernel = cls.__new__(cls)
+        kernel.grid = grid
+        kernel.ptype = ptype
+        kernel.bundle = name
+        kernel.random_streams = header['random_streams']
+        kernel.instrument = header['instrument']
+        kernel.compiler_profile = header['compiler_profile']
+        kernel.recovery = recovery
+        kernel.recovery_jit = recovery_jit
+        kernel.funcname = header['funcname']
+        kernel.name = header['name']
+        kernel.pyfunc = kernel.funccode = kernel.py_ast = kernel.ccode = None
+        kernel.funcvars = []
+        kernel.field_args = field_args
+        kernel.vector_args = vector_args
+        kernel.const_args = const_args
+        kernel.lib_file = path.join(path.dirname(path.abspath(filename)), header['library'])
+        kernel.src_file = kernel.log_file = None
+        kernel._lib = None
+        return kernel
+
+    def _train(self, compiler, pset, endtime, dt):
+        """Record profile data with an instrumented build of the kernel.
+        Training runs on a copy of the particles in a forked process, which
+        writes the profile data when it exits, so that the state of this
+        process, including the global random number generator, is unchanged."""
+        if not hasattr(os, 'fork'):
+            print("Warning: Kernel %s is compiled without profile data, since training "
+                  "requires os.fork" % self.name)
+            return
+        train_file = "%s-train.so" % path.splitext(self.lib_file)[0]
+        compiler.compile_training(self.src_file, train_file, self.log_file)
+        particles = pset._particle_data[:pset._nslots].copy()
+        particles['dt'] = dt
+        if dt > 0:
+            endtime = min(endtime, np.max(particles['time']) + self.pgo_steps * dt)
+        else:
+            endtime = max(endtime, np.min(particles['time']) + self.pgo_steps * dt)
+        # Flush buffered output, which the forked process would write again
+        libc = CDLL(None)
+        sys.stdout.flush()
+        libc.fflush(None)
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                self.load_lib(train_file)
+                deleted, errored, counts = self._flagged_buffers(particles.size)
+                self._function(particles.size, None, particles.ctypes.data, deleted.ctypes.data,
+                               errored.ctypes.data, counts.ctypes.data, endtime, dt,
+                               *self._ctypes_args())
+                status = 0
+            except BaseException:
+                traceback.print_exc()
+                sys.stderr.flush()
+            finally:
+                # Exit through the C library, which runs the destructor of the
+                # instrumented library that writes the profile data
+                libc.exit(status)
+        _, status = os.waitpid(pid, 0)
+        if status != 0:
+            raise RuntimeError("Training run of kernel %s failed" % self.name)
+
+    def load_lib(self, lib_file=None):
+        self._lib = npct.load_library(lib_file or self.lib_file, '.')
         self._function = self._lib.particle_loop
-
-    def execute_jit(self, pset, endtime, dt):
-        """Invokes JIT engine to perform the core update loop"""
-        fargs = [byref(f.ctypes_struct) for f in self.field_args.values()]
-        fargs += [c_float(f) for f in self.const_args.values()]
-        particle_data = pset._particle_data.ctypes.data_as(c_void_p)
-        self._function(c_int(len(pset)), particle_data,
-                       c_double(endtime), c_float(dt), *fargs)
-
-    def execute_python(self, pset, endtime, dt):
-        """Performs the core update loop via Python"""
+        # Bind argument types once, so that calls need no conversion objects
+        self._function.restype = None
+        self._function.argtypes = ([c_int, c_void_p, c_void_p, c_void_p, c_void_p,
+                                    c_void_p, c_double, c_double]
+                                   + [POINTER(CField)] * len(self.field_args)
+                                   + [c_float] * len(self.const_args))
+        self._leap_function = self._lib.leap_loop
+        self._leap_function.restype = c_int
+        self._leap_function.argtypes = ([c_int, c_double, c_double, c_int, c_void_p,
+                                         c_void_p, c_void_p, c_void_p, c_void_p, c_double]
+                                        + self._function.argtypes[8:])
+        self._fstructs = None
+        self._fargs = None
+        self._flagged = np.empty((3, 0), dtype=np.int32)
+        self._rng_generation = parcels.rng.parcels_random.generation
+        if self.instrument:
+            self._lib.get_stats.restype = POINTER(CStats)
+            self._lib.get_stats.argtypes = []
+
+    def _stats_struct(self):
+        if not self.ptype.uses_jit or not self.instrument:
+            raise RuntimeError("Kernel statistics require a JIT kernel with instrument=True")
+        if self._lib is None:
+            raise RuntimeError("Kernel %s has not been compiled yet" % self.name)
+        return self._lib.get_stats().contents
+
+    def stats(self):
+        """Counters collected by an instrumented JIT kernel since it was
+        loaded or since the last call to :meth:`reset_stats`
+
+        :rtype: OrderedDict of counters, with error codes returned by the
+                kernel function counted by :class:`ErrorCode` name"""
+        cstats = self._stats_struct()
+        stats = OrderedDict((name, int(getattr(cstats, name))) for name, _ in CStats._fields_
+                            if name != 'errors')
+        stats['errors'] = OrderedDict((code.name, int(cstats.errors[code])) for code in ErrorCode)
+        return stats
+
+    def reset_stats(self):
+        """Reset the counters of an instrumented JIT kernel"""
+        cstats = self._stats_struct()
+        memset(byref(cstats), 0, sizeof(cstats))
+
+    def _count_loop_events(self, profile, counts):
+        """Add the event counters of the compiled loop to a profile"""
+        profile.count('particle_steps', counts[2])
+        profile.count('repeats', counts[3])
+        profile.count('loop_recoveries', counts[4])
+
+    def _ctypes_args(self):
+        """Field and constant arguments of the compiled kernel, which are
+        only marshaled again when the underlying field arrays change"""
+        fstructs = [f.ctypes_struct for f in self.field_args.values()]
+        if self._fargs is None or any(new is not old for new, old
+                                      in zip(fstructs, self._fstructs)):
+            self._fstructs = fstructs
+            self._fargs = tuple([byref(f) for f in fstructs]
+                                + [float(f) for f in self.const_args.values()])
+        return self._fargs
+
+    def execute_jit(self, pset, endtime, dt, pindices=None, profile=None):
+        """Invokes JIT engine to perform the core update loop
+
+        :param pindices: Optional array of store slots to restrict the loop to
+        :param profile: Optional :class:`parcels.profiling.Profile` to record events
+        :rtype: Tuple of arrays with the store slots of particles
+                that signalled deletion and that threw errors"""
+        if pindices is None:
+            num_particles = pset._nslots
+            pindices_ptr = None
+        else:
+            pindices = np.ascontiguousarray(pindices, dtype=np.int32)
+            num_particles = pindices.size
+            pindices_ptr = pindices.ctypes.data
+        deleted, errored, counts = self._flagged_buffers(num_particles)
+        counts[2:5] = 0
+        self._sync_rng()
+        self._function(num_particles, pindices_ptr, pset._particle_data.ctypes.data,
+                       deleted.ctypes.data, errored.ctypes.data, counts.ctypes.data,
+                       endtime, dt, *self._ctypes_args())
+        if profile is not None:
+            self._count_loop_events(profile, counts)
+        return deleted[:counts[0]].copy(), errored[:counts[1]].copy()
+
+    def _sync_rng(self):
+        """Propagate the seed set via :func:`parcels.rng.seed` to the kernel"""
+        seed = parcels.rng.get_state()['seed']
+        if self.random_streams and seed is not None:
+            self._lib.set_stream_seed(seed)
+        generation = parcels.rng.parcels_random.generation
+        if self._rng_generation != generation:
+            # Drop the normal variate the kernel cached before reseeding
+            self._lib.reset_normalvariate()
+            self._rng_generation = generation
+
+    def _flagged_buffers(self, num_particles):
+        """Re-usable buffers for the indices of deleted and errored particles
+        and for the counters of the compiled loop"""
+        if self._flagged.shape[1] < max(num_particles, 5):
+            self._flagged = np.empty((3, max(num_particles, 5)), dtype=np.int32)
+        return self._flagged
+
+    def execute_leaps(self, pset, starttime, interval, nleaps, dt,
+                      recovery=None, snapshots=None, profile=None):
+        """Advance a ParticleSet through several leaps of `interval` with a
+        single call into the JIT-compiled code
+
+        Particles that signal deletion are skipped by the following leaps,
+        and removed from the ParticleSet afterwards. The compiled leap loop
+        stops after the first leap in which particles threw errors, which
+        is then completed via the usual recovery in :meth:`execute`.
+
+        :param snapshots: Optional contiguous array of shape (nleaps, nslots)
+                          of the particle dtype, into which the particle data
+                          is copied after each completed leap
+        :param profile: Optional :class:`parcels.profiling.Profile` to record
+                        timers and events
+        :rtype: Tuple of the number of leaps performed and the number of
+                snapshots stored"""
+        if snapshots is not None:
+            assert snapshots.flags.c_contiguous and snapshots.shape[1] == pset._nslots
+        if profile is None:
+            profile = Profile(enabled=False)
+        deleted, errored, counts = self._flagged_buffers(pset._nslots)
+        counts[2:5] = 0
+        self._sync_rng()
+        with profile.timer('kernel'):
+            nsnapshots = self._leap_function(nleaps, starttime, interval, pset._nslots,
+                                             pset._particle_data.ctypes.data,
+                                             None if snapshots is None else snapshots.ctypes.data,
+                                             deleted.ctypes.data, errored.ctypes.data,
+                                             counts.ctypes.data, dt, *self._ctypes_args())
+        self._count_loop_events(profile, counts)
+
+        # Complete an interrupted leap with error handling in Python,
+        # and remove the particles deleted during all leaps
+        leapsdone = nleaps if nsnapshots == nleaps else nsnapshots + 1
+        leaptime = starttime
+        for _ in range(leapsdone):
+            leaptime += interval
+        self._recover(pset, leaptime, dt, recovery,
+                      deleted[:counts[0]].copy(), errored[:counts[1]].copy(), profile)
+        return leapsdone, nsnapshots
+
+    def execute_python(self, pset, endtime, dt, pindices=None, profile=None):
+        """Performs the core update loop via Python
+
+        :param pindices: Optional array of store slots to restrict the loop to
+        :param profile: Optional :class:`parcels.profiling.Profile` to record events
+        :rtype: Tuple of arrays with the store slots of particles
+                that signalled deletion and that threw errors"""
         sign = 1. if dt > 0. else -1.
-        for p in pset.particles:
+        deleted = []
+        errored = []
+        steps = 0
+        repeats = 0
+        if pindices is None:
+            pindices = pset._live_slots()
+        for i in pindices:
+            p = pset._particles[i]
             # Compute min/max dt for first timestep
             dt_pos = min(abs(p.dt), abs(endtime - p.time))
             while dt_pos > 0:
+                if self.random_streams:
+                    parcels.rng._stream = parcels.rng.RandomStream(p.id, p.time)
+                steps += 1
                 try:
                     res = self.pyfunc(p, pset.grid, p.time, sign * dt_pos)
                 except FieldSamplingError as fse:
@@ -132,6 +603,8 @@ class Kernel(object):
                 except Exception as e:
                     res = ErrorCode.Error
                     p.exception = e
+                finally:
+                    parcels.rng._stream = None
 
                 # Update particle state for explicit returns
                 if res is not None:
@@ -145,71 +618,105 @@ class Kernel(object):
                     continue
                 elif res == ErrorCode.Repeat:
                     # Try again without time update
+                    repeats += 1
                     dt_pos = min(abs(p.dt), abs(endtime - p.time))
                     continue
                 else:
                     break  # Failure - stop time loop
 
-    def execute(self, pset, endtime, dt, recovery=None):
-        """Execute this Kernel over a ParticleSet for several timesteps"""
-
-        def remove_deleted(pset):
-            """Utility to remove all particles that signalled deletion"""
-            indices = [i for i, p in enumerate(pset.particles)
-                       if p.state in [ErrorCode.Delete]]
-            pset.remove(indices)
+            # Record particles that signalled deletion or an error
+            if p.state == ErrorCode.Delete:
+                deleted.append(i)
+            elif p.state not in [ErrorCode.Success, ErrorCode.Repeat]:
+                errored.append(i)
+        if profile is not None:
+            profile.count('particle_steps', steps)
+            profile.count('repeats', repeats)
+        return np.array(deleted, dtype=np.int32), np.array(errored, dtype=np.int32)
+
+    def execute(self, pset, endtime, dt, recovery=None, profile=None):
+        """Execute this Kernel over a ParticleSet for several timesteps
+
+        The core loop reports the particles that signalled deletion or
+        threw errors, so that recovery and re-execution only touch those.
+
+        :param profile: Optional :class:`parcels.profiling.Profile` to record
+                        timers and events"""
+        if profile is None:
+            profile = Profile(enabled=False)
+        # Execute the kernel over the particle set
+        with profile.timer('kernel'):
+            if self.ptype.uses_jit:
+                deleted, errored = self.execute_jit(pset, endtime, dt, profile=profile)
+            else:
+                deleted, errored = self.execute_python(pset, endtime, dt, profile=profile)
+        self._recover(pset, endtime, dt, recovery, deleted, errored, profile)
 
+    def _recover(self, pset, endtime, dt, recovery, deleted, errored, profile):
+        """Apply recovery kernels to errored particles, continue them
+        up to `endtime` and remove all particles that signalled deletion"""
         if recovery is None:
             recovery = {}
         recovery_map = recovery_base_map.copy()
+        recovery_map.update(self.recovery)
         recovery_map.update(recovery)
-
-        # Execute the kernel over the particle set
-        if self.ptype.uses_jit:
-            self.execute_jit(pset, endtime, dt)
-        else:
-            self.execute_python(pset, endtime, dt)
+        removed = [deleted]
+
+        with profile.timer('recovery'):
+            while len(errored) > 0:
+                # Apply recovery kernel to particles that threw errors
+                for i in errored:
+                    p = pset._particles[i]
+                    profile.count_error(p.state)
+                    recovery_kernel = recovery_map[p.state]
+                    p.state = ErrorCode.Success
+                    recovery_kernel(p)
+
+                # Collect particles that signalled deletion during recovery
+                recovered = np.array([q.state != ErrorCode.Delete
+                                      for q in pset._particles[errored]], dtype=bool)
+                removed.append(errored[~recovered])
+
+                # Execute core loop again to continue interrupted particles
+                if self.ptype.uses_jit:
+                    deleted, errored = self.execute_jit(pset, endtime, dt, errored[recovered],
+                                                        profile=profile)
+                else:
+                    deleted, errored = self.execute_python(pset, endtime, dt, errored[recovered],
+                                                           profile=profile)
+                removed.append(deleted)
 
         # Remove all particles that signalled deletion
-        remove_deleted(pset)
-
-        # Idenitify particles that threw errors
-        error_particles = [p for p in pset.particles
-                           if p.state not in [ErrorCode.Success, ErrorCode.Repeat]]
-        while len(error_particles) > 0:
-            # Apply recovery kernel
-            for p in error_particles:
-                recovery_kernel = recovery_map[p.state]
-                p.state = ErrorCode.Success
-                recovery_kernel(p)
-
-            # Remove all particles that signalled deletion
-            remove_deleted(pset)
-
-            # Execute core loop again to continue interrupted particles
-            if self.ptype.uses_jit:
-                self.execute_jit(pset, endtime, dt)
-            else:
-                self.execute_python(pset, endtime, dt)
-
-            error_particles = [p for p in pset.particles
-                               if p.state not in [ErrorCode.Success, ErrorCode.Repeat]]
+        removed = np.concatenate(removed)
+        profile.count('deletions', removed.size)
+        if removed.size > 0:
+            with profile.timer('deletion'):
+                pset._remove_slots(removed)
 
     def merge(self, kernel):
+        self._require_source("be concatenated")
+        kernel._require_source("be concatenated")
         funcname = self.funcname + kernel.funcname
         func_ast = FunctionDef(name=funcname, args=self.py_ast.args,
                                body=self.py_ast.body + kernel.py_ast.body,
                                decorator_list=[], lineno=1, col_offset=0)
         return Kernel(self.grid, self.ptype, pyfunc=None,
                       funcname=funcname, funccode=self.funccode + kernel.funccode,
-                      py_ast=func_ast, funcvars=self.funcvars + kernel.funcvars)
+                      py_ast=func_ast, funcvars=self.funcvars + kernel.funcvars,
+                      random_streams=self.random_streams or kernel.random_streams,
+                      instrument=self.instrument or kernel.instrument,
+                      compiler_profile=self.compiler_profile)
 
     def __add__(self, kernel):
         if not isinstance(kernel, Kernel):
-            kernel = Kernel(self.grid, self.ptype, pyfunc=kernel)
+            kernel = Kernel(self.grid, self.ptype, pyfunc=kernel,
+                            random_streams=self.random_streams, instrument=self.instrument,
+                            compiler_profile=self.compiler_profile)
         return self.merge(kernel)
 
     def __radd__(self, kernel):
         if not isinstance(kernel, Kernel):
-            kernel = Kernel(self.grid, self.ptype, pyfunc=kernel)
+            kernel = Kernel(self.grid, self.ptype, pyfunc=kernel,
+                            random_streams=self.random_streams, instrument=self.instrument,
+                            compiler_profile=self.compiler_profile)
         return kernel.merge(self)
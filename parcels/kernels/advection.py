@@ -3,21 +3,20 @@ from parcels.kernels.error import ErrorCode
 import math
 
 
-__all__ = ['AdvectionRK4', 'AdvectionEE', 'AdvectionRK45']
+__all__ = ['AdvectionRK4', 'AdvectionEE', 'AdvectionRK45', 'AdvectionDOPRI5']
 
 
 def AdvectionRK4(particle, grid, time, dt):
     """Advection of particles using fourth-order Runge-Kutta integration.
 
     Function needs to be converted to Kernel object before execution"""
-    u1 = grid.U[time, particle.lon, particle.lat]
-    v1 = grid.V[time, particle.lon, particle.lat]
+    u1, v1 = grid.UV[time, particle.lon, particle.lat, particle.depth]
     lon1, lat1 = (particle.lon + u1*.5*dt, particle.lat + v1*.5*dt)
-    u2, v2 = (grid.U[time + .5 * dt, lon1, lat1], grid.V[time + .5 * dt, lon1, lat1])
+    u2, v2 = grid.UV[time + .5 * dt, lon1, lat1, particle.depth]
     lon2, lat2 = (particle.lon + u2*.5*dt, particle.lat + v2*.5*dt)
-    u3, v3 = (grid.U[time + .5 * dt, lon2, lat2], grid.V[time + .5 * dt, lon2, lat2])
+    u3, v3 = grid.UV[time + .5 * dt, lon2, lat2, particle.depth]
     lon3, lat3 = (particle.lon + u3*dt, particle.lat + v3*dt)
-    u4, v4 = (grid.U[time + dt, lon3, lat3], grid.V[time + dt, lon3, lat3])
+    u4, v4 = grid.UV[time + dt, lon3, lat3, particle.depth]
     particle.lon += (u1 + 2*u2 + 2*u3 + u4) / 6. * dt
     particle.lat += (v1 + 2*v2 + 2*v3 + v4) / 6. * dt
 
@@ -26,8 +25,7 @@ def AdvectionEE(particle, grid, time, dt):
     """Advection of particles using Explicit Euler (aka Euler Forward) integration.
 
     Function needs to be converted to Kernel object before execution"""
-    u1 = grid.U[time, particle.lon, particle.lat]
-    v1 = grid.V[time, particle.lon, particle.lat]
+    u1, v1 = grid.UV[time, particle.lon, particle.lat, particle.depth]
     particle.lon += u1 * dt
     particle.lat += v1 * dt
 
@@ -48,28 +46,22 @@ def AdvectionRK45(particle, grid, time, dt):
     b4 = [25./216., 0., 1408./2565., 2197./4104., -1./5.]
     b5 = [16./135., 0., 6656./12825., 28561./56430., -9./50., 2./55.]
 
-    u1 = grid.U[time, particle.lon, particle.lat]
-    v1 = grid.V[time, particle.lon, particle.lat]
+    u1, v1 = grid.UV[time, particle.lon, particle.lat, particle.depth]
     lon1, lat1 = (particle.lon + u1 * A[0][0] * dt,
                   particle.lat + v1 * A[0][0] * dt)
-    u2, v2 = (grid.U[time + c[0] * dt, lon1, lat1],
-              grid.V[time + c[0] * dt, lon1, lat1])
+    u2, v2 = grid.UV[time + c[0] * dt, lon1, lat1, particle.depth]
     lon2, lat2 = (particle.lon + (u1 * A[1][0] + u2 * A[1][1]) * dt,
                   particle.lat + (v1 * A[1][0] + v2 * A[1][1]) * dt)
-    u3, v3 = (grid.U[time + c[1] * dt, lon2, lat2],
-              grid.V[time + c[1] * dt, lon2, lat2])
+    u3, v3 = grid.UV[time + c[1] * dt, lon2, lat2, particle.depth]
     lon3, lat3 = (particle.lon + (u1 * A[2][0] + u2 * A[2][1] + u3 * A[2][2]) * dt,
                   particle.lat + (v1 * A[2][0] + v2 * A[2][1] + v3 * A[2][2]) * dt)
-    u4, v4 = (grid.U[time + c[2] * dt, lon3, lat3],
-              grid.V[time + c[2] * dt, lon3, lat3])
+    u4, v4 = grid.UV[time + c[2] * dt, lon3, lat3, particle.depth]
     lon4, lat4 = (particle.lon + (u1 * A[3][0] + u2 * A[3][1] + u3 * A[3][2] + u4 * A[3][3]) * dt,
                   particle.lat + (v1 * A[3][0] + v2 * A[3][1] + v3 * A[3][2] + v4 * A[3][3]) * dt)
-    u5, v5 = (grid.U[time + c[3] * dt, lon4, lat4],
-              grid.V[time + c[3] * dt, lon4, lat4])
+    u5, v5 = grid.UV[time + c[3] * dt, lon4, lat4, particle.depth]
     lon5, lat5 = (particle.lon + (u1 * A[4][0] + u2 * A[4][1] + u3 * A[4][2] + u4 * A[4][3] + u5 * A[4][4]) * dt,
                   particle.lat + (v1 * A[4][0] + v2 * A[4][1] + v3 * A[4][2] + v4 * A[4][3] + v5 * A[4][4]) * dt)
-    u6, v6 = (grid.U[time + c[4] * dt, lon5, lat5],
-              grid.V[time + c[4] * dt, lon5, lat5])
+    u6, v6 = grid.UV[time + c[4] * dt, lon5, lat5, particle.depth]
 
     lon_4th = particle.lon + (u1 * b4[0] + u2 * b4[1] + u3 * b4[2] + u4 * b4[3] + u5 * b4[4]) * dt
     lat_4th = particle.lat + (v1 * b4[0] + v2 * b4[1] + v3 * b4[2] + v4 * b4[3] + v5 * b4[4]) * dt
@@ -85,3 +77,91 @@ def AdvectionRK45(particle, grid, time, dt):
     else:
         particle.dt /= 2
         return ErrorCode.Repeat
+
+
+def AdvectionDOPRI5(particle, grid, time, dt):
+    """Advection of particles using adaptive Dormand-Prince 5(4) integration.
+
+    Each call advances the particle over the full timestep dt in adaptive
+    sub-steps, with rejected sub-steps retried inside the kernel rather than
+    via ErrorCode.Repeat. The last stage of an accepted sub-step is re-used
+    as the first stage of the next one (FSAL) within a call, but not across
+    calls, since particles have no storage for it. A sub-step thus samples
+    the velocity 6 times, and each call once more, so a call that is not
+    sub-divided costs about 7/4 of an AdvectionRK4 step. The kernel pays off
+    when dt is set as large as the output interval, so that the sub-steps
+    adapt to the flow. The local error is measured in metres and kept
+    below `grid.dopri_tol`, with sub-steps between `grid.dopri_dtmin` and
+    `grid.dopri_dtmax` seconds."""
+    lon = particle.lon
+    lat = particle.lat
+    t = 0.
+    h = dt
+    if h > grid.dopri_dtmax:
+        h = grid.dopri_dtmax
+    if h < -grid.dopri_dtmax:
+        h = -grid.dopri_dtmax
+    u1, v1 = grid.UV[time, lon, lat, particle.depth]
+    while True:
+        last = 0
+        if math.fabs(dt - t) <= math.fabs(h):
+            h = dt - t
+            last = 1
+        lon2, lat2 = (lon + h * u1 / 5., lat + h * v1 / 5.)
+        u2, v2 = grid.UV[time + t + h / 5., lon2, lat2, particle.depth]
+        lon3, lat3 = (lon + h * (3. * u1 + 9. * u2) / 40.,
+                      lat + h * (3. * v1 + 9. * v2) / 40.)
+        u3, v3 = grid.UV[time + t + .3 * h, lon3, lat3, particle.depth]
+        lon4, lat4 = (lon + h * (44. / 45. * u1 - 56. / 15. * u2 + 32. / 9. * u3),
+                      lat + h * (44. / 45. * v1 - 56. / 15. * v2 + 32. / 9. * v3))
+        u4, v4 = grid.UV[time + t + .8 * h, lon4, lat4, particle.depth]
+        lon5 = lon + h * (19372. / 6561. * u1 - 25360. / 2187. * u2
+                          + 64448. / 6561. * u3 - 212. / 729. * u4)
+        lat5 = lat + h * (19372. / 6561. * v1 - 25360. / 2187. * v2
+                          + 64448. / 6561. * v3 - 212. / 729. * v4)
+        u5, v5 = grid.UV[time + t + 8. / 9. * h, lon5, lat5, particle.depth]
+        lon6 = lon + h * (9017. / 3168. * u1 - 355. / 33. * u2 + 46732. / 5247. * u3
+                          + 49. / 176. * u4 - 5103. / 18656. * u5)
+        lat6 = lat + h * (9017. / 3168. * v1 - 355. / 33. * v2 + 46732. / 5247. * v3
+                          + 49. / 176. * v4 - 5103. / 18656. * v5)
+        u6, v6 = grid.UV[time + t + h, lon6, lat6, particle.depth]
+        lon7 = lon + h * (35. / 384. * u1 + 500. / 1113. * u3 + 125. / 192. * u4
+                          - 2187. / 6784. * u5 + 11. / 84. * u6)
+        lat7 = lat + h * (35. / 384. * v1 + 500. / 1113. * v3 + 125. / 192. * v4
+                          - 2187. / 6784. * v5 + 11. / 84. * v6)
+        u7, v7 = grid.UV[time + t + h, lon7, lat7, particle.depth]
+
+        # Difference between the 5th and embedded 4th order solutions in metres
+        err_lon = h * (71. / 57600. * u1 - 71. / 16695. * u3 + 71. / 1920. * u4
+                       - 17253. / 339200. * u5 + 22. / 525. * u6 - 1. / 40. * u7)
+        err_lat = h * (71. / 57600. * v1 - 71. / 16695. * v3 + 71. / 1920. * v4
+                       - 17253. / 339200. * v5 + 22. / 525. * v6 - 1. / 40. * v7)
+        if grid.spherical:
+            err_lon *= 1852. * 60. * math.cos(lat * math.pi / 180.)
+            err_lat *= 1852. * 60.
+        err_norm = math.sqrt(err_lon * err_lon + err_lat * err_lat)
+
+        if err_norm <= grid.dopri_tol or math.fabs(h) <= grid.dopri_dtmin:
+            # Accept sub-step and re-use the last stage as the next first stage
+            lon = lon7
+            lat = lat7
+            t += h
+            u1 = u7
+            v1 = v7
+            if last:
+                break
+        # Standard step size control with safety factor and bounded change
+        fac = 5.
+        if err_norm > 0.:
+            fac = .9 * math.pow(grid.dopri_tol / err_norm, .2)
+        if fac > 5.:
+            fac = 5.
+        if fac < .2:
+            fac = .2
+        h *= fac
+        if math.fabs(h) < grid.dopri_dtmin:
+            h = grid.dopri_dtmin * h / math.fabs(h)
+        if math.fabs(h) > grid.dopri_dtmax:
+            h = grid.dopri_dtmax * h / math.fabs(h)
+    particle.lon = lon
+    particle.lat = lat
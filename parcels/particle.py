@@ -122,23 +122,26 @@ class ScipyParticle(_Particle):
     :param grid: :mod:`parcels.grid.Grid` object to track this particle on
     :param dt: Execution timestep for this particle
     :param time: Current time of the particle
+    :param depth: Initial depth of particle
 
     Additional Variables can be added via the :Class Variable: objects
     """
 
     lon = Variable('lon', dtype=np.float32)
     lat = Variable('lat', dtype=np.float32)
+    depth = Variable('depth', dtype=np.float32)
     time = Variable('time', dtype=np.float64)
     id = Variable('id', dtype=np.int32)
     dt = Variable('dt', dtype=np.float32, to_write=False)
     state = Variable('state', dtype=np.int32, initial=ErrorCode.Success, to_write=False)
 
-    def __init__(self, lon, lat, grid, dt=1., time=0., cptr=None):
+    def __init__(self, lon, lat, grid, dt=1., time=0., cptr=None, depth=0.):
         global lastID
 
         # Enforce default values through Variable descriptor
         type(self).lon.initial = lon
         type(self).lat.initial = lat
+        type(self).depth.initial = depth
         type(self).time.initial = time
         type(self).id.initial = lastID
         lastID += 1
@@ -160,6 +163,7 @@ class JITParticle(ScipyParticle):
     :param grid: :mod:`parcels.grid.Grid` object to track this particle on
     :param dt: Execution timestep for this particle
     :param time: Current time of the particle
+    :param depth: Initial depth of particle
 
     Additional Variables can be added via the :Class Variable: objects
 
@@ -169,6 +173,7 @@ class JITParticle(ScipyParticle):
 
     xi = Variable('xi', dtype=np.int32, to_write=False)
     yi = Variable('yi', dtype=np.int32, to_write=False)
+    zi = Variable('zi', dtype=np.int32, to_write=False)
 
     def __init__(self, *args, **kwargs):
         self._cptr = kwargs.pop('cptr', None)
@@ -179,8 +184,10 @@ class JITParticle(ScipyParticle):
         super(JITParticle, self).__init__(*args, **kwargs)
 
         grid = kwargs.get('grid')
-        self.xi = np.where(self.lon >= grid.U.lon)[0][-1]
-        self.yi = np.where(self.lat >= grid.U.lat)[0][-1]
+        lon, lat = grid.U.periodic_coordinates(self.lon, self.lat)
+        self.xi = np.where(lon >= grid.U.lon)[0][-1]
+        self.yi = np.where(lat >= grid.U.lat)[0][-1]
+        self.zi = max(np.searchsorted(grid.U.depth, self.depth, side='right') - 1, 0)
 
     def __repr__(self):
         return "P(%f, %f, %f)[%d, %d]" % (self.lon, self.lat, self.time,
@@ -1,6 +1,7 @@
 """Module controlling the writing of ParticleSets to NetCDF file"""
 import numpy as np
 import netCDF4
+from parcels.kernels.error import ErrorCode
 from datetime import timedelta as delta
 
 
@@ -88,7 +89,7 @@ class ParticleFile(object):
 
         self.user_vars = []
         for v in particleset.ptype.variables:
-            if v.name in ['time', 'lat', 'lon', 'z', 'id']:
+            if v.name in ['time', 'lat', 'lon', 'depth', 'z', 'id']:
                 continue
             if v.to_write is True:
                 setattr(self, v.name, self.dataset.createVariable(v.name, "f4", coords, fill_value=0.))
@@ -107,26 +108,61 @@ class ParticleFile(object):
         if isinstance(time, delta):
             time = time.total_seconds()
         if self.lasttime_written != time:  # only write if 'time' hasn't been written yet
-            self.lasttime_written = time
-            if self.type is 'array':
-                if len(pset) != self.lon.shape[0]:
-                    raise RuntimeError("Number of particles appears to change. Use type='indexed' for ParticleFile")
-                self.time[:, self.idx] = time
-                self.lat[:, self.idx] = np.array([p.lat for p in pset])
-                self.lon[:, self.idx] = np.array([p.lon for p in pset])
-                self.z[:, self.idx] = np.zeros(pset.size, dtype=np.float32)
-                for var in self.user_vars:
-                    getattr(self, var)[:, self.idx] = np.array([getattr(p, var) for p in pset])
-
-                self.idx += 1
-            elif self.type is 'indexed':
-                ind = np.arange(pset.size) + self.idx
-                self.id[ind] = np.array([p.id for p in pset])
-                self.time[ind] = time
-                self.lat[ind] = np.array([p.lat for p in pset])
-                self.lon[ind] = np.array([p.lon for p in pset])
-                self.z[ind] = np.zeros(pset.size, dtype=np.float32)
-                for var in self.user_vars:
-                    getattr(self, var)[ind] = np.array([getattr(p, var) for p in pset])
-
-                self.idx += pset.size
+            data = dict((var, np.array([getattr(p, var) for p in pset]))
+                        for var in ['id', 'lat', 'lon', 'depth'] + self.user_vars)
+            self._write(data, pset.size, [time])
+
+    def write_data(self, data, times):
+        """Write a series of snapshots of particle data to file
+
+        :param data: Structured array of shape (len(times), nparticles) with
+                     the particle data as stored by JIT particles. Particles
+                     are skipped in the snapshots in which they are deleted.
+        :param times: Times of the snapshots
+        """
+        times = list(times)
+        if len(times) > 0 and self.lasttime_written == times[0]:
+            data = data[1:]
+            times = times[1:]
+        if len(times) == 0:
+            return
+        variables = ['id', 'lat', 'lon', 'depth'] + self.user_vars
+        alive = data['state'] != ErrorCode.Delete
+        data, alive = data[:, alive.any(axis=0)], alive[:, alive.any(axis=0)]
+        if alive.all():
+            self._write(dict((var, data[var].T) for var in variables), data.shape[1], times)
+        else:
+            # Particles were deleted between snapshots
+            for row, time in enumerate(times):
+                snapshot = data[row, alive[row]]
+                self._write(dict((var, snapshot[var]) for var in variables), snapshot.size, [time])
+
+    def _write(self, data, size, times):
+        """Write arrays of particle variables of shape (size, len(times)), or
+        (size,) for a single time, to file"""
+        ntimes = len(times)
+        self.lasttime_written = times[-1]
+        if self.type is 'array':
+            if size != self.lon.shape[0]:
+                raise RuntimeError("Number of particles appears to change. Use type='indexed' for ParticleFile")
+            obs = slice(self.idx, self.idx + ntimes)
+            self.time[:, obs] = np.tile(times, (size, 1))
+            self.lat[:, obs] = data['lat'].reshape(size, ntimes)
+            self.lon[:, obs] = data['lon'].reshape(size, ntimes)
+            self.z[:, obs] = data['depth'].reshape(size, ntimes)
+            for var in self.user_vars:
+                getattr(self, var)[:, obs] = data[var].reshape(size, ntimes)
+
+            self.idx += ntimes
+        elif self.type is 'indexed':
+            # Write observations ordered by time, then by particle
+            ind = np.arange(size * ntimes) + self.idx
+            self.id[ind] = data['id'].reshape(size, ntimes).T.ravel()
+            self.time[ind] = np.repeat(times, size)
+            self.lat[ind] = data['lat'].reshape(size, ntimes).T.ravel()
+            self.lon[ind] = data['lon'].reshape(size, ntimes).T.ravel()
+            self.z[ind] = data['depth'].reshape(size, ntimes).T.ravel()
+            for var in self.user_vars:
+                getattr(self, var)[ind] = data[var].reshape(size, ntimes).T.ravel()
+
+            self.idx += size * ntimes
@@ -1,9 +1,14 @@
 from parcels.kernel import Kernel
+from parcels.kernels.error import ErrorCode
 from parcels.field import Field, UnitConverter
-from parcels.particle import JITParticle
+from parcels.particle import JITParticle, Variable
 from parcels.compiler import GNUCompiler
 from parcels.kernels.advection import AdvectionRK4
 from parcels.particlefile import ParticleFile
+from parcels.checkpoint import ParticleCheckpoint
+from parcels.profiling import Profile
+import parcels.particle
+import parcels.rng
 import numpy as np
 import bisect
 from collections import Iterable
@@ -24,34 +29,61 @@ def nearest_index(array, value):
         return y
 
 
+def nearest_indices(array, values):
+    """returns indices of the nearest values in a sorted array for an array of values,
+    ties going to the lower index like :func:`nearest_index`"""
+    array = np.asarray(array, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    if array.size < 2:
+        return np.zeros(values.shape, dtype=np.intp)
+    step = (array[-1] - array[0]) / (array.size - 1)
+    if np.allclose(np.diff(array), step, rtol=1e-4, atol=0):
+        # Regularly spaced coordinates map onto indices without searching
+        indices = np.ceil((values - array[0]) / step - 0.5)
+        return np.clip(indices, 0, array.size - 1).astype(np.intp)
+    return np.searchsorted(0.5 * (array[1:] + array[:-1]), values)
+
+
 class ParticleSet(object):
     """Container class for storing particle and executing kernel over them.
 
-    Please note that this currently only supports fixed size particle sets.
+    Particles are held in a capacity-managed store that grows geometrically,
+    so that adding particles is amortized O(1). Removed particles are
+    tombstoned in place and skipped during kernel execution, until enough
+    tombstones have accumulated to compact the store.
 
     :param grid: :mod:`parcels.grid.Grid` object from which to sample velocity
     :param pclass: Optional :mod:`parcels.particle.JITParticle` or
                  :mod:`parcels.particle.ScipyParticle` object that defines custom particle
     :param lon: List of initial longitude values for particles
     :param lat: List of initial latitude values for particles
+    :param depth: Optional list of initial depth values for particles, default 0
     """
 
-    def __init__(self, grid, pclass=JITParticle, lon=None, lat=None):
+    def __init__(self, grid, pclass=JITParticle, lon=None, lat=None, depth=None):
         # Convert numpy arrays to one-dimensional lists
         lon = lon.flatten() if isinstance(lon, np.ndarray) else lon
         lat = lat.flatten() if isinstance(lat, np.ndarray) else lat
         assert len(lon) == len(lat)
+        if depth is None:
+            depth = np.zeros(len(lon), dtype=np.float32)
+        depth = depth.flatten() if isinstance(depth, np.ndarray) else depth
+        assert len(depth) == len(lon)
         size = len(lon)
         self.grid = grid
-        self.particles = np.empty(size, dtype=pclass)
         self.ptype = pclass.getPType()
+        self._coordinate_sets = grid.coordinate_sets if self.ptype.uses_jit else []
+        for names, _ in self._coordinate_sets[1:]:
+            # Cache grid indices for fields that are not on the coordinates of U
+            self.ptype.variables += [Variable(name, dtype=np.int32, to_write=False)
+                                     for name in names]
         self.kernel = None
         self.time_origin = grid.U.time_origin
+        self.restart = None
+        self.profile = None
+        self._allocate(size)
 
         if self.ptype.uses_jit:
-            # Allocate underlying data for C-allocated particles
-            self._particle_data = np.empty(size, dtype=self.ptype.dtype)
-
             def cptr(i):
                 return self._particle_data[i]
         else:
@@ -63,19 +95,101 @@ class ParticleSet(object):
             assert(size == len(lon) and size == len(lat))
 
             for i in range(size):
-                self.particles[i] = pclass(lon[i], lat[i], grid=grid, cptr=cptr(i), time=grid.U.time[0])
+                self._particles[i] = pclass(lon[i], lat[i], grid=grid, cptr=cptr(i),
+                                            time=grid.U.time[0], depth=depth[i])
+            self._init_indices(np.arange(size))
         else:
             raise ValueError("Latitude and longitude required for generating ParticleSet")
 
+    def _allocate(self, size, capacity=None):
+        """Allocate an empty particle store with `size` used slots"""
+        capacity = max(size, capacity or 0)
+        self._particles = np.empty(capacity, dtype=object)
+        self._tombstones = np.zeros(capacity, dtype=np.bool_)
+        self._nslots = size
+        self._ndeleted = 0
+        self._live = None
+        if self.ptype.uses_jit:
+            # Allocate underlying data for C-allocated particles
+            self._particle_data = np.empty(capacity, dtype=self.ptype.dtype)
+
+    def _reserve(self, nadd):
+        """Ensure that the particle store can hold `nadd` additional particles,
+        compacting tombstoned slots or growing the store geometrically"""
+        n = self._nslots
+        capacity = self._particles.size
+        if n + nadd <= capacity:
+            return
+        if 4 * self._ndeleted >= capacity:
+            self._compact()
+            if self._nslots + nadd <= capacity:
+                return
+        n = self._nslots
+        capacity = max(n + nadd, 2 * capacity, 8)
+        particles = self._particles
+        self._particles = np.empty(capacity, dtype=object)
+        self._particles[:n] = particles[:n]
+        tombstones = self._tombstones
+        self._tombstones = np.zeros(capacity, dtype=np.bool_)
+        self._tombstones[:n] = tombstones[:n]
+        if self.ptype.uses_jit:
+            particle_data = self._particle_data
+            self._particle_data = np.empty(capacity, dtype=self.ptype.dtype)
+            self._particle_data[:n] = particle_data[:n]
+            # Update C-pointer on particles
+            for i in self._live_slots():
+                self._particles[i]._cptr = self._particle_data[i]
+
+    def _compact(self):
+        """Squeeze out all tombstoned slots, preserving particle order"""
+        if self._ndeleted == 0:
+            return
+        n = self._nslots
+        live = self._live_slots()
+        m = live.size
+        first = np.argmax(self._tombstones[:n])
+        self._particles[:m] = self._particles[live]
+        self._particles[m:n] = None
+        self._tombstones[:n] = False
+        if self.ptype.uses_jit:
+            self._particle_data[:m] = self._particle_data[live]
+            # Update C-pointer on particles that moved
+            for i in range(first, m):
+                self._particles[i]._cptr = self._particle_data[i]
+        self._nslots = m
+        self._ndeleted = 0
+        self._live = None
+
+    def _init_indices(self, slots):
+        """Initialise the grid indices that JIT particles in `slots` cache
+        for fields that are not on the coordinates of U"""
+        for names, fields in self._coordinate_sets[1:]:
+            field = ([f for f in fields if f.data.ndim == 4] + fields)[0]
+            data = self._particle_data[slots]
+            indices = field.cell_indices(data['lon'], data['lat'], data['depth'])
+            for name, index in zip(names, indices):
+                self._particle_data[name][slots] = index
+
+    def _live_slots(self):
+        """Returns the slot indices of all particles that are not tombstoned,
+        which are cached until particles are added, removed or compacted"""
+        if self._live is None:
+            if self._ndeleted == 0:
+                self._live = np.arange(self._nslots)
+            else:
+                self._live = np.flatnonzero(~self._tombstones[:self._nslots])
+        return self._live
+
     @classmethod
-    def from_list(cls, grid, pclass, lon, lat):
+    def from_list(cls, grid, pclass, lon, lat, depth=None):
         """Initialise the ParticleSet from lists of lon and lat
 
         :param grid: :mod:`parcels.grid.Grid` object from which to sample velocity
         :param pclass: mod:`parcels.particle.JITParticle` or :mod:`parcels.particle.ScipyParticle`
                  object that defines custom particle
+        :param depth: Optional list of depths
         """
-        return cls(grid=grid, pclass=pclass, lon=lon, lat=lat)
+        return cls(grid=grid, pclass=pclass, lon=lon, lat=lat, depth=depth)
 
     @classmethod
     def from_line(cls, grid, pclass, start, finish, size):
@@ -103,38 +217,106 @@ class ParticleSet(object):
                  object that defines custom particle
         :param start_field: Field for initialising particles stochastically according to the presented density field.
         :param size: Initial size of particle set
-        :param mode: Type of random sampling. Currently only 'monte_carlo' is implemented
+        :param mode: Type of random sampling: 'monte_carlo' draws cells independently,
+                 'stratified' draws one cell from each of `size` equal-probability strata of
+                 the cumulative distribution, which spreads particles more evenly
         """
-        total = np.sum(start_field.data[0, :, :])
-        start_field.data[0, :, :] = start_field.data[0, :, :] / total
+        data = np.asarray(start_field.data[0, :, :], dtype=np.float64)
+        cdf = np.cumsum(data.ravel())
+        if not cdf[-1] > 0:
+            raise RuntimeError("Field %s has no positive density to draw particles from"
+                               % start_field.name)
+        if mode == 'monte_carlo':
+            probs = np.random.uniform(size=size)
+        elif mode == 'stratified':
+            probs = (np.arange(size) + np.random.uniform(size=size)) / size
+        else:
+            raise NotImplementedError('Mode %s not implemented. Please use "monte_carlo" or '
+                                      '"stratified" instead.' % mode)
+        # Inverse of the cumulative distribution, without normalising the field itself
+        cells = np.minimum(np.searchsorted(cdf, probs * cdf[-1], side='right'), cdf.size - 1)
+        cell_lat, cell_lon = np.unravel_index(cells, data.shape)
         lonwidth = (start_field.lon[1] - start_field.lon[0]) / 2
         latwidth = (start_field.lat[1] - start_field.lat[0]) / 2
 
         def add_jitter(pos, width, min, max):
-            value = pos + np.random.uniform(-width, width)
-            while not (min <= value <= max):
-                value = pos + np.random.uniform(-width, width)
+            value = pos + np.random.uniform(-width, width, size=pos.size)
+            outside = (value < min) | (value > max)
+            while outside.any():
+                value[outside] = pos[outside] + np.random.uniform(-width, width, size=outside.sum())
+                outside = (value < min) | (value > max)
             return value
 
-        if mode == 'monte_carlo':
-            probs = np.random.uniform(size=size)
-            lon = []
-            lat = []
-            for p in probs:
-                cell = np.unravel_index(np.where([p < i for i in np.cumsum(start_field.data[0, :, :])])[0][0],
-                                        np.shape(start_field.data[0, :, :]))
-                lon.append(add_jitter(start_field.lon[cell[1]], lonwidth,
-                                      start_field.lon.min(), start_field.lon.max()))
-                lat.append(add_jitter(start_field.lat[cell[0]], latwidth,
-                                      start_field.lat.min(), start_field.lat.max()))
-        else:
-            raise NotImplementedError('Mode %s not implemented. Please use "monte carlo" algorithm instead.' % mode)
+        lon = add_jitter(start_field.lon[cell_lon], lonwidth,
+                         start_field.lon.min(), start_field.lon.max())
+        lat = add_jitter(start_field.lat[cell_lat], latwidth,
+                         start_field.lat.min(), start_field.lat.max())
 
         return cls(grid=grid, pclass=pclass, lon=lon, lat=lat)
 
+    @classmethod
+    def from_checkpoint(cls, grid, pclass, checkpoint):
+        """Restore a ParticleSet from a binary checkpoint written during
+        :meth:`ParticleSet.execute`.
+
+        The particle data is memory-mapped from the checkpoint file, and
+        the global particle ID counter and RNG state are restored. The
+        time up to which particles had been advanced and the `endtime`,
+        `dt` and `interval` of the interrupted run are stored in
+        `pset.restart`, and are used as defaults of the next call to
+        :meth:`ParticleSet.execute`.
+
+        Note that only the seed of the global random number generator is
+        restored, since the C library does not expose its position. Resumed
+        runs that draw from it therefore differ from an uninterrupted run,
+        whereas runs with `random_streams` reproduce it exactly.
+
+        :param grid: :mod:`parcels.grid.Grid` object from which to sample velocity
+        :param pclass: mod:`parcels.particle.JITParticle` or :mod:`parcels.particle.ScipyParticle`
+                 object that defines custom particle
+        :param checkpoint: :mod:`parcels.checkpoint.ParticleCheckpoint` object,
+                 or basename of the checkpoint file
+        """
+        if not isinstance(checkpoint, ParticleCheckpoint):
+            checkpoint = ParticleCheckpoint(checkpoint)
+        header, data = checkpoint.read()
+        pset = cls(grid=grid, pclass=pclass, lon=[], lat=[])
+        if header['ptype'] != pset.ptype._cache_key:
+            raise RuntimeError("Checkpoint %s was written for a different particle type:\n%s"
+                               % (checkpoint.filename, header['ptype']))
+
+        # Re-create particle objects without re-initialising their variables
+        pset._allocate(data.size)
+        if pset.ptype.uses_jit:
+            pset._particle_data = data
+            for i in range(data.size):
+                p = pclass.__new__(pclass)
+                p._cptr = data[i]
+                p.exception = None
+                pset._particles[i] = p
+        else:
+            for i in range(data.size):
+                p = pclass.__new__(pclass)
+                for v in pset.ptype.variables:
+                    setattr(p, v.name, v.dtype(data[v.name][i]))
+                p.exception = None
+                pset._particles[i] = p
+
+        parcels.particle.lastID = max(parcels.particle.lastID, header['lastID'])
+        parcels.rng.set_state(header['rng'])
+        pset.restart = header
+        return pset
+
+    @property
+    def particles(self):
+        """Array of all particles in the ParticleSet"""
+        if self._ndeleted == 0:
+            return self._particles[:self._nslots]
+        return self._particles[self._live_slots()]
+
     @property
     def size(self):
-        return self.particles.size
+        return self._nslots - self._ndeleted
 
     def __repr__(self):
         return "\n".join([str(p) for p in self])
@@ -142,11 +324,14 @@ class ParticleSet(object):
     def __len__(self):
         return self.size
 
+    def __iter__(self):
+        return iter(self.particles)
+
     def __getitem__(self, key):
-        return self.particles[key]
+        return self._particles[self._live_slots()[key]]
 
     def __setitem__(self, key, value):
-        self.particles[key] = value
+        self._particles[self._live_slots()[key]] = value
 
     def __iadd__(self, particles):
         self.add(particles)
@@ -158,31 +343,52 @@ class ParticleSet(object):
             particles = particles.particles
         if not isinstance(particles, Iterable):
             particles = [particles]
-        self.particles = np.append(self.particles, particles)
+        self._reserve(len(particles))
+        n = self._nslots
+        for i, p in enumerate(particles):
+            self._particles[n + i] = p
+            if self.ptype.uses_jit:
+                # Copy particle data into the store and update C-pointer
+                if p._cptr.dtype == self._particle_data.dtype:
+                    self._particle_data[n + i] = p._cptr
+                else:
+                    for name in p._cptr.dtype.names:
+                        self._particle_data[name][n + i] = p._cptr[name]
+                p._cptr = self._particle_data[n + i]
+        self._nslots = n + len(particles)
+        self._live = None
         if self.ptype.uses_jit:
-            particles_data = [p._cptr for p in particles]
-            self._particle_data = np.append(self._particle_data, particles_data)
-            # Update C-pointer on particles
-            for p, pdata in zip(self.particles, self._particle_data):
-                p._cptr = pdata
+            self._init_indices(np.arange(n, self._nslots))
 
     def remove(self, indices):
         """Method to remove particles from the ParticleSet, based on their `indices`"""
+        slots = self._live_slots()[indices]
         if isinstance(indices, Iterable):
-            particles = [self.particles[i] for i in indices]
+            particles = [self._particles[i] for i in slots]
         else:
-            particles = self.particles[indices]
-        if self.ptype.uses_jit:
-            self._particle_data = np.delete(self._particle_data, indices)
-            # Update C-pointer on particles
-            for p, pdata in zip(self.particles, self._particle_data):
-                p._cptr = pdata
-        self.particles = np.delete(self.particles, indices)
+            particles = self._particles[slots]
+        self._remove_slots(np.atleast_1d(slots))
         return particles
 
-    def execute(self, pyfunc=AdvectionRK4, starttime=None, endtime=None, dt=1.,
+    def _remove_slots(self, slots):
+        """Tombstone the particles in the given store slots"""
+        slots = np.unique(slots)
+        if self.ptype.uses_jit:
+            # Detach removed particles from the store, so that they retain
+            # their data when the slot is overwritten
+            for i in slots:
+                self._particles[i]._cptr = self._particles[i]._cptr.copy()
+            self._particle_data['state'][slots] = ErrorCode.Delete
+        self._tombstones[slots] = True
+        self._ndeleted += slots.size
+        self._live = None
+        if 2 * self._ndeleted > self._nslots:
+            self._compact()
+
+    def execute(self, pyfunc=AdvectionRK4, starttime=None, endtime=None, dt=None,
                 runtime=None, interval=None, recovery=None, output_file=None,
-                show_movie=False):
+                checkpoint=None, show_movie=False, leap_buffer=None, profile=False,
+                compiler_profile=None):
         """Execute a given kernel function over the particle set for
         multiple timesteps. Optionally also provide sub-timestepping
         for particle output.
@@ -193,25 +399,55 @@ class ParticleSet(object):
         :param starttime: Starting time for the timestepping loop. Defaults to 0.0.
         :param endtime: End time for the timestepping loop
         :param runtime: Length of the timestepping loop. Use instead of endtime.
-        :param dt: Timestep interval to be passed to the kernel
+        :param dt: Timestep interval to be passed to the kernel. Defaults to 1 second.
         :param interval: Interval for inner sub-timestepping (leap), which dictates
                          the update frequency of file output and animation.
+
+        After :meth:`from_checkpoint`, `starttime`, `endtime`, `dt` and `interval`
+        default to the values of the interrupted run, so that it is resumed by
+        calling `execute` without arguments.
         :param output_file: :mod:`parcels.particlefile.ParticleFile` object for particle output
+        :param checkpoint: :mod:`parcels.checkpoint.ParticleCheckpoint` object to periodically
+                           store the ParticleSet for restarts via :meth:`from_checkpoint`
         :param recovery: Dictionary with additional `:mod:parcels.kernels.error`
                          recovery kernels to allow custom recovery behaviour in case of
-                         kernel errors.
+                         kernel errors. In JIT mode, recovery kernels written in the
+                         kernel language are executed inside the compiled core loop.
         :param show_movie: True shows particles; name of field plots that field as background
+        :param leap_buffer: Number of leaps to advance in a single call into the compiled
+                            code (JIT only). Output is buffered in memory as one snapshot
+                            of the particles per leap and written to file in bulk.
+        :param profile: Collect timers and event counters of the execution loop in a
+                        :class:`parcels.profiling.Profile`, available as `pset.profile`.
+                        Kernels created with ``instrument=True`` also add their
+                        internal counters to the profile.
+        :param compiler_profile: Compilation profile of JIT kernels, one of 'portable',
+                                 'native' or 'pgo' (see :class:`parcels.compiler.GNUCompiler`).
+                                 Defaults to the profile of the kernel, 'portable' by default.
         """
+        self.profile = Profile(enabled=profile)
+        with self.profile.timer('total'):
+            self._execute(pyfunc, starttime, endtime, dt, runtime, interval, recovery,
+                          output_file, checkpoint, show_movie, leap_buffer, compiler_profile)
+
+    def _execute(self, pyfunc, starttime, endtime, dt, runtime, interval, recovery,
+                 output_file, checkpoint, show_movie, leap_buffer, compiler_profile):
+        """Time loop of :meth:`execute`"""
+        profile = self.profile
         if self.kernel is None:
             # Generate and store Kernel
             if isinstance(pyfunc, Kernel):
                 self.kernel = pyfunc
             else:
-                self.kernel = self.Kernel(pyfunc)
-            # Prepare JIT kernel execution
-            if self.ptype.uses_jit:
-                self.kernel.compile(compiler=GNUCompiler())
-                self.kernel.load_lib()
+                self.kernel = self.Kernel(pyfunc, recovery=recovery)
+        instrumented = False
+        if self.ptype.uses_jit:
+            # Recovery kernels are compiled into the core loop,
+            # so the kernel needs to be re-generated if they change
+            if (recovery or {}) != self.kernel.recovery:
+                self.kernel = self.kernel.with_recovery(recovery)
+            if compiler_profile is not None and compiler_profile != self.kernel.compiler_profile:
+                self.kernel = self.kernel.with_compiler_profile(compiler_profile)
 
         # Convert all time variables to seconds
         if isinstance(starttime, delta):
@@ -232,6 +468,18 @@ class ParticleSet(object):
         # Derive starttime, endtime and interval from arguments or grid defaults
         if runtime is not None and endtime is not None:
             raise RuntimeError('Only one of (endtime, runtime) can be specified')
+        if self.restart is not None:
+            # Resume the interrupted run, unless parameters are overridden
+            if starttime is None:
+                starttime = self.restart['time']
+            if endtime is None and runtime is None:
+                endtime = self.restart['endtime']
+            if dt is None:
+                dt = self.restart['dt']
+            if interval is None:
+                interval = self.restart['interval']
+        if dt is None:
+            dt = 1.
         if starttime is None:
             starttime = self.grid.U.time[0] if dt > 0 else self.grid.U.time[-1]
         if runtime is not None:
@@ -259,25 +507,92 @@ class ParticleSet(object):
                 print("negating interval because running in time-backward mode")
 
         # Initialise particle timestepping
-        for p in self:
-            p.time = starttime
-            p.dt = dt
+        if self.ptype.uses_jit:
+            self._particle_data['time'][:self._nslots] = starttime
+            self._particle_data['dt'][:self._nslots] = dt
+        else:
+            for p in self:
+                p.time = starttime
+                p.dt = dt
+
+        # Prepare JIT kernel execution; the particle times are needed for
+        # the training run of profile-guided optimisation
+        if self.ptype.uses_jit:
+            if self.kernel._lib is None:
+                with profile.timer('compile'):
+                    compiler = GNUCompiler(profile=self.kernel.compiler_profile)
+                    self.kernel.compile(compiler, pset=self, endtime=endtime, dt=dt)
+                    self.kernel.load_lib()
+            # Collect the counters of instrumented kernels for this call only
+            instrumented = profile.enabled and self.kernel.instrument
+            if instrumented:
+                self.kernel.reset_stats()
+
         # Execute time loop in sub-steps (timeleaps)
         timeleaps = int((endtime - starttime) / interval)
         assert(timeleaps >= 0)
         leaptime = starttime
+        if leap_buffer is not None and self.ptype.uses_jit and not show_movie:
+            leaptime = self._execute_buffered(timeleaps, leap_buffer, leaptime, endtime,
+                                              interval, dt, recovery, output_file, checkpoint)
+            timeleaps = 0
         for _ in range(timeleaps):
             # First write output_file, because particles could have been added
             if output_file:
-                output_file.write(self, leaptime)
+                with profile.timer('output'):
+                    output_file.write(self, leaptime)
             if show_movie:
                 self.show(field=show_movie, show_time=leaptime)
             leaptime += interval
             self.kernel.execute(self, endtime=leaptime, dt=dt,
-                                recovery=recovery)
+                                recovery=recovery, profile=profile)
+            if checkpoint and checkpoint.due(leaptime):
+                with profile.timer('checkpoint'):
+                    checkpoint.write(self, leaptime, endtime, dt, interval)
         # Write out a final output_file
         if output_file:
-            output_file.write(self, leaptime)
+            with profile.timer('output'):
+                output_file.write(self, leaptime)
+        if checkpoint and checkpoint.lasttime_written != leaptime:
+            with profile.timer('checkpoint'):
+                checkpoint.write(self, leaptime, endtime, dt, interval)
+        if instrumented:
+            profile.kernel_stats = self.kernel.stats()
+        self.restart = None
+
+    def _execute_buffered(self, timeleaps, leap_buffer, leaptime, endtime,
+                          interval, dt, recovery, output_file, checkpoint):
+        """Time loop that advances particles through up to `leap_buffer`
+        leaps per call into the compiled kernel
+
+        :rtype: Time reached after all leaps"""
+        profile = self.profile
+        snapshots = None
+        while timeleaps > 0:
+            nleaps = min(leap_buffer, timeleaps)
+            buf = None
+            if output_file:
+                with profile.timer('output'):
+                    output_file.write(self, leaptime)
+                # Preallocated buffer for particle snapshots, re-used across calls
+                if snapshots is None or snapshots.size < nleaps * self._nslots:
+                    snapshots = np.empty(leap_buffer * self._nslots, dtype=self.ptype.dtype)
+                buf = snapshots[:nleaps * self._nslots].reshape(nleaps, self._nslots)
+            leapsdone, nsnapshots = self.kernel.execute_leaps(self, leaptime, interval, nleaps,
+                                                              dt, recovery, buf, profile)
+            times = []
+            for _ in range(leapsdone):
+                leaptime += interval
+                times.append(leaptime)
+            if output_file:
+                # Drain the buffered snapshots in bulk
+                with profile.timer('output'):
+                    output_file.write_data(buf[:nsnapshots], times[:nsnapshots])
+            timeleaps -= leapsdone
+            if checkpoint and checkpoint.due(leaptime):
+                with profile.timer('checkpoint'):
+                    checkpoint.write(self, leaptime, endtime, dt, interval)
+        return leaptime
 
     def show(self, particles=True, show_time=None, field=True, domain=None,
              land=False, vmin=None, vmax=None, savefile=None):
@@ -416,64 +731,70 @@ class ParticleSet(object):
             print('Plot saved to '+savefile+'.png')
             plt.close()
 
-    def density(self, field=None, particle_val=None, relative=False, area_scale=True):
+    def _variable(self, name):
+        """Array of the values of variable `name` of all particles"""
+        if self.ptype.uses_jit:
+            if self._ndeleted == 0:
+                return self._particle_data[name][:self._nslots]
+            return self._particle_data[name][self._live_slots()]
+        return np.array([getattr(p, name) for p in self.particles])
+
+    def density(self, field=None, particle_val=None, relative=False, area_scale=True,
+                accumulate=None):
         """Method to calculate the density of particles in a ParticleSet from their locations,
         through a 2D histogram
 
         :param field: Optional :mod:`parcels.field.Field` object to calculate the histogram
                     on. Default is `grid.U`
-        :param particle_val: Optional list of values to weigh each particlewith
+        :param particle_val: Optional name of a particle variable to weigh each particle with
         :param relative: Boolean to control whether the density is scaled by the total
                     number of particles
         :param area_scale: Boolean to control whether the density is scaled by the area
-                    (in m^2) of each grid cell"""
-        lons = [p.lon for p in self.particles]
-        lats = [p.lat for p in self.particles]
-        # Code for finding nearest vertex for each particle is currently very inefficient
-        # once cell tracking is implemented for SciPy particles, the below use of np.min/max
-        # will be replaced (see PR #111)
+                    (in m^2) of each grid cell
+        :param accumulate: Optional array returned by a previous call, to which the density
+                    is added in place, e.g. to accumulate the density over output leaps"""
+        lons = self._variable('lon')
+        lats = self._variable('lat')
         if field is not None:
             # Kick out particles that are not within the limits of our density field
             half_lon = (field.lon[1] - field.lon[0])/2
             half_lat = (field.lat[1] - field.lat[0])/2
-            dparticles = (lons > (np.min(field.lon)-half_lon)) * (lons < (np.max(field.lon)+half_lon)) * \
-                         (lats > (np.min(field.lat)-half_lat)) * (lats < (np.max(field.lat)+half_lat))
-            dparticles = np.where(dparticles)[0]
+            inside = (lons > (np.min(field.lon)-half_lon)) & (lons < (np.max(field.lon)+half_lon)) & \
+                     (lats > (np.min(field.lat)-half_lat)) & (lats < (np.max(field.lat)+half_lat))
+            lons = lons[inside]
+            lats = lats[inside]
         else:
             field = self.grid.U
-            dparticles = range(len(self.particles))
-        Density = np.zeros((field.lon.size, field.lat.size), dtype=np.float32)
-
-        # For each particle, find closest vertex in x and y and add 1 or val to the count
-        if particle_val is not None:
-            for p in dparticles:
-                Density[np.argmin(np.abs(lons[p] - field.lon)), np.argmin(np.abs(lats[p] - field.lat))] \
-                    += getattr(self.particles[p], particle_val)
-        else:
-            for p in dparticles:
-                nearest_lon = np.argmin(np.abs(lons[p] - field.lon))
-                nearest_lat = np.argmin(np.abs(lats[p] - field.lat))
-                Density[nearest_lon, nearest_lat] += 1
-            if relative:
-                Density /= len(dparticles)
+            inside = slice(None)
+        weights = self._variable(particle_val)[inside] if particle_val is not None else None
+
+        # Histogram of the closest vertex in x and y of each particle
+        cells = nearest_indices(field.lon, lons) * field.lat.size + nearest_indices(field.lat, lats)
+        Density = np.bincount(cells, weights=weights, minlength=field.lon.size * field.lat.size)
+        Density = Density.reshape(field.lon.size, field.lat.size).astype(np.float32)
+        if relative and lons.size > 0:
+            Density /= lons.size
 
         if area_scale:
-            area = np.zeros(np.shape(field.data[0, :, :]), dtype=np.float32)
             U = self.grid.U
             V = self.grid.V
             dy = (V.lon[1] - V.lon[0])/V.units.to_target(1, V.lon[0], V.lat[0])
-            for y in range(len(U.lat)):
-                dx = (U.lon[1] - U.lon[0])/U.units.to_target(1, U.lon[0], U.lat[y])
-                area[y, :] = dy * dx
+            dx = (U.lon[1] - U.lon[0])/U.units.to_target(1, U.lon[0], U.lat)
             # Scale by cell area
-            Density /= np.transpose(area)
+            Density /= (dy * dx * np.ones(U.lat.size)).astype(np.float32)[np.newaxis, :]
 
+        if accumulate is not None:
+            accumulate += Density
+            return accumulate
         return Density
 
-    def Kernel(self, pyfunc):
+    def Kernel(self, pyfunc, recovery=None, random_streams=False, instrument=False,
+               compiler_profile='portable'):
         """Wrapper method to convert a `pyfunc` into a :class:`parcels.kernel.Kernel` object
         based on `grid` and `ptype` of the ParticleSet"""
-        return Kernel(self.grid, self.ptype, pyfunc=pyfunc)
+        return Kernel(self.grid, self.ptype, pyfunc=pyfunc, recovery=recovery,
+                      random_streams=random_streams, instrument=instrument,
+                      compiler_profile=compiler_profile)
 
     def ParticleFile(self, *args, **kwargs):
         """Wrapper method to initialise a :class:`parcels.particlefile.ParticleFile`
@@ -0,0 +1,90 @@
+"""Module collecting timers and counters during the execution of kernels"""
+from collections import OrderedDict
+from contextlib import contextmanager
+from timeit import default_timer
+from parcels.kernels.error import ErrorCode
+
+
+__all__ = ['Profile']
+
+
+class Profile(object):
+    """Wall-clock timers and event counters collected during
+    :meth:`parcels.particleset.ParticleSet.execute` with ``profile=True``
+
+    Timers are accumulated per phase of the execution loop:
+
+    * ``compile``: Code generation and compilation of JIT kernels
+    * ``kernel``: Core loop over particles, in C or Python
+    * ``recovery``: Recovery kernels and re-execution of interrupted particles
+    * ``deletion``: Removal of deleted particles from the ParticleSet
+    * ``output``: Writing of the ParticleFile
+    * ``checkpoint``: Writing of checkpoints
+    * ``total``: The whole call to execute
+
+    Counters record particle steps (kernel invocations), ``REPEAT``
+    retries, particles that signalled deletion, errors by error code
+    and errors recovered inside the compiled loop. JIT kernels created
+    with ``instrument=True`` add their internal counters as ``kernel_stats``
+    (see :meth:`parcels.kernel.Kernel.stats`).
+
+    :param enabled: Disabled profiles ignore all timers and counters
+    """
+
+    phases = ['compile', 'kernel', 'recovery', 'deletion', 'output', 'checkpoint', 'total']
+    events = ['particle_steps', 'repeats', 'deletions', 'loop_recoveries']
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.timers = OrderedDict((phase, 0.) for phase in self.phases)
+        self.counters = OrderedDict((event, 0) for event in self.events)
+        self.errors = OrderedDict()
+        self.kernel_stats = None
+
+    @contextmanager
+    def timer(self, phase):
+        """Context manager that adds the time spent in its body to `phase`"""
+        if not self.enabled:
+            yield
+            return
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.timers[phase] += default_timer() - start
+
+    def count(self, event, n=1):
+        """Add `n` occurences of `event`"""
+        if self.enabled:
+            self.counters[event] = self.counters.get(event, 0) + int(n)
+
+    def count_error(self, code, n=1):
+        """Add `n` errors with the given :class:`parcels.kernels.error.ErrorCode`"""
+        if self.enabled:
+            name = ErrorCode(code).name
+            self.errors[name] = self.errors.get(name, 0) + int(n)
+
+    @property
+    def throughput(self):
+        """Particle steps per second of time spent in the core loop"""
+        if self.timers['kernel'] > 0.:
+            return self.counters['particle_steps'] / self.timers['kernel']
+        return 0.
+
+    def report(self):
+        """Structured report of all timers and counters as a dict"""
+        return {'timers': dict(self.timers),
+                'counters': dict(self.counters),
+                'errors': dict(self.errors),
+                'kernel_stats': self.kernel_stats,
+                'throughput': self.throughput}
+
+    def __str__(self):
+        lines = ["%-16s %12.6f s" % (phase, t) for phase, t in self.timers.items()]
+        lines += ["%-16s %12d" % (event, n) for event, n in self.counters.items()]
+        lines += ["%-16s %12d" % (code, n) for code, n in self.errors.items()]
+        lines += ["%-16s %12.1f steps/s" % ('throughput', self.throughput)]
+        if self.kernel_stats is not None:
+            lines += ["%-16s %12d" % (name, n) for name, n in self.kernel_stats.items()
+                      if name != 'errors']
+        return "\n".join(lines)
@@ -1,10 +1,12 @@
-from parcels.compiler import get_cache_dir, GNUCompiler
+from parcels.compiler import get_cache_dir, source_hash, compile_library, GNUCompiler
 from os import path
+import numpy as np
 import numpy.ctypeslib as npct
-from ctypes import c_int, c_float
+from ctypes import Structure, addressof, c_int, c_float, c_double, c_uint32, c_void_p
 
 
-__all__ = ['seed', 'random', 'uniform', 'randint']
+__all__ = ['seed', 'random', 'uniform', 'randint', 'get_state', 'set_state',
+           'RandomStream']
 
 
 class Random(object):
@@ -33,62 +35,223 @@ extern int pcls_randint(int low, int high){
 extern float pcls_normalvariate(float loc, float scale){
   return parcels_normalvariate(loc, scale);
 }
+"""
+    fnct_streams = """
+extern void pcls_seed_streams(int seed){
+  parcels_seed_streams(seed);
+}
+
+extern void pcls_stream_init(parcels_rng_stream *s, int id, double time){
+  parcels_stream_init(s, id, time);
+}
+
+extern float pcls_stream_random(parcels_rng_stream *s){
+  return parcels_stream_random(s);
+}
+
+extern float pcls_stream_uniform(parcels_rng_stream *s, float low, float high){
+  return parcels_stream_uniform(s, low, high);
+}
+
+extern int pcls_stream_randint(parcels_rng_stream *s, int low, int high){
+  return parcels_stream_randint(s, low, high);
+}
+
+extern float pcls_stream_normalvariate(parcels_rng_stream *s, float loc, float scale){
+  return parcels_stream_normalvariate(s, loc, scale);
+}
+"""
+    fnct_arrays = """
+extern void pcls_random_array(float *out, int n){
+  int i;
+  for (i = 0; i < n; ++i) out[i] = parcels_random();
+}
+
+extern void pcls_uniform_array(float *out, int n, float low, float high){
+  int i;
+  for (i = 0; i < n; ++i) out[i] = parcels_uniform(low, high);
+}
+
+extern void pcls_randint_array(int *out, int n, int low, int high){
+  int i;
+  for (i = 0; i < n; ++i) out[i] = parcels_randint(low, high);
+}
+
+extern void pcls_normalvariate_array(float *out, int n, float loc, float scale){
+  int i;
+  for (i = 0; i < n; ++i) out[i] = parcels_normalvariate(loc, scale);
+}
 """
     ccode = stmt_import + fnct_seed
     ccode += fnct_random + fnct_uniform + fnct_randint + fnct_normalvariate
-    src_file = path.join(get_cache_dir(), "random.c")
-    lib_file = path.join(get_cache_dir(), "random.so")
-    log_file = path.join(get_cache_dir(), "random.log")
+    ccode += fnct_streams + fnct_arrays
+
+    # The library is cached across processes, keyed on its source and the header
+    basename = "random_%s" % source_hash(ccode)
+    src_file = path.join(get_cache_dir(), "%s.c" % basename)
+    lib_file = path.join(get_cache_dir(), "%s.so" % basename)
+    log_file = path.join(get_cache_dir(), "%s.log" % basename)
 
     def __init__(self):
         self._lib = None
+        self._seed = None
+        # Number of calls to seed, to reset the state cached in JIT kernels
+        self.generation = 0
 
     @property
     def lib(self, compiler=GNUCompiler()):
         if self._lib is None:
-            with open(self.src_file, 'w') as f:
-                f.write(self.ccode)
-            compiler.compile(self.src_file, self.lib_file, self.log_file)
-            print("Compiled %s ==> %s" % ("random", self.lib_file))
+            if compile_library(compiler, self.ccode, self.src_file, self.lib_file,
+                               self.log_file):
+                print("Compiled %s ==> %s" % ("random", self.lib_file))
             self._lib = npct.load_library(self.lib_file, '.')
+            self._bind(self._lib)
         return self._lib
 
+    @staticmethod
+    def _bind(lib):
+        """Set argument and return types of all library functions once"""
+        signatures = {'pcls_seed': (None, [c_int]),
+                      'pcls_random': (c_float, []),
+                      'pcls_uniform': (c_float, [c_float, c_float]),
+                      'pcls_randint': (c_int, [c_int, c_int]),
+                      'pcls_normalvariate': (c_float, [c_float, c_float]),
+                      'pcls_seed_streams': (None, [c_int]),
+                      'pcls_stream_init': (None, [c_void_p, c_int, c_double]),
+                      'pcls_stream_random': (c_float, [c_void_p]),
+                      'pcls_stream_uniform': (c_float, [c_void_p, c_float, c_float]),
+                      'pcls_stream_randint': (c_int, [c_void_p, c_int, c_int]),
+                      'pcls_stream_normalvariate': (c_float, [c_void_p, c_float, c_float]),
+                      'pcls_random_array': (None, [c_void_p, c_int]),
+                      'pcls_uniform_array': (None, [c_void_p, c_int, c_float, c_float]),
+                      'pcls_randint_array': (None, [c_void_p, c_int, c_int, c_int]),
+                      'pcls_normalvariate_array': (None, [c_void_p, c_int, c_float, c_float])}
+        for name, (restype, argtypes) in signatures.items():
+            func = getattr(lib, name)
+            func.restype = restype
+            func.argtypes = argtypes
+
 
 parcels_random = Random()
 
+# Stream of the particle currently executed by a SciPy kernel
+_stream = None
+
+
+class CStream(Structure):
+    """Ctypes struct corresponding to parcels_rng_stream in parcels.h"""
+    _fields_ = [('key', c_uint32 * 2), ('ctr', c_uint32 * 4),
+                ('buf', c_uint32 * 4), ('nbuf', c_int), ('has_spare', c_int),
+                ('spare', c_float)]
+
+
+class RandomStream(object):
+    """Counter-based random number stream of a single particle
+
+    Draws are determined by the global seed, the particle ID and the
+    time, so they do not depend on the order in which particles are
+    processed. Streams produce the same numbers as the kernel language
+    in JIT kernels created with ``random_streams=True``.
+
+    :param id: ID of the particle
+    :param time: Time of the current timestep
+    """
+
+    def __init__(self, id, time):
+        self._cstream = CStream()
+        self._ptr = addressof(self._cstream)
+        parcels_random.lib.pcls_stream_init(self._ptr, id, time)
+
+    def random(self):
+        """Returns a random float between 0. and 1."""
+        return parcels_random.lib.pcls_stream_random(self._ptr)
+
+    def uniform(self, low, high):
+        """Returns a random float between `low` and `high`"""
+        return parcels_random.lib.pcls_stream_uniform(self._ptr, low, high)
+
+    def randint(self, low, high):
+        """Returns a random int between `low` and `high`"""
+        return parcels_random.lib.pcls_stream_randint(self._ptr, low, high)
+
+    def normalvariate(self, loc, scale):
+        """Returns a random float on normal distribution with mean `loc` and width `scale`"""
+        return parcels_random.lib.pcls_stream_normalvariate(self._ptr, loc, scale)
+
 
 def seed(seed):
-    """Sets the seed for parcels internal RNG"""
-    parcels_random.lib.pcls_seed(c_int(seed))
+    """Sets the seed for parcels internal RNG and for random streams"""
+    parcels_random.lib.pcls_seed(seed)
+    parcels_random.lib.pcls_seed_streams(seed)
+    parcels_random._seed = seed
+    parcels_random.generation += 1
+
+
+def get_state():
+    """Returns the state of parcels internal RNG as a dict
+
+    Note that the underlying C library does not expose its internal
+    position, so only the last seed set via :func:`seed` is captured.
+    Counter-based random streams are fully determined by the seed."""
+    return {'seed': parcels_random._seed}
+
+
+def set_state(state):
+    """Restores the state of parcels internal RNG from :func:`get_state`"""
+    if state['seed'] is not None:
+        seed(state['seed'])
+
+
+def _array(func, size, dtype, *args):
+    """Fill an array of random numbers in a single call to the C library"""
+    out = np.empty(size, dtype=dtype)
+    if _stream is not None:
+        draw = getattr(_stream, func)
+        out.flat[:] = [draw(*args) for _ in range(out.size)]
+    else:
+        getattr(parcels_random.lib, 'pcls_%s_array' % func)(out.ctypes.data, out.size, *args)
+    return out
+
+
+def random(size=None):
+    """Returns a random float between 0. and 1.
+
+    :param size: Optional shape of an array of random numbers to return"""
+    if size is not None:
+        return _array('random', size, np.float32)
+    if _stream is not None:
+        return _stream.random()
+    return parcels_random.lib.pcls_random()
+
 
+def uniform(low, high, size=None):
+    """Returns a random float between `low` and `high`
 
-def random():
-    """Returns a random float between 0. and 1."""
-    rnd = parcels_random.lib.pcls_random
-    rnd.argtype = []
-    rnd.restype = c_float
-    return rnd()
+    :param size: Optional shape of an array of random numbers to return"""
+    if size is not None:
+        return _array('uniform', size, np.float32, low, high)
+    if _stream is not None:
+        return _stream.uniform(low, high)
+    return parcels_random.lib.pcls_uniform(low, high)
 
 
-def uniform(low, high):
-    """Returns a random float between `low` and `high`"""
-    rnd = parcels_random.lib.pcls_uniform
-    rnd.argtype = [c_float, c_float]
-    rnd.restype = c_float
-    return rnd(c_float(low), c_float(high))
+def randint(low, high, size=None):
+    """Returns a random int between `low` and `high`
 
+    :param size: Optional shape of an array of random numbers to return"""
+    if size is not None:
+        return _array('randint', size, np.int32, low, high)
+    if _stream is not None:
+        return _stream.randint(low, high)
+    return parcels_random.lib.pcls_randint(low, high)
 
-def randint(low, high):
-    """Returns a random int between `low` and `high`"""
-    rnd = parcels_random.lib.pcls_randint
-    rnd.argtype = [c_int, c_int]
-    rnd.restype = c_int
-    return rnd(c_int(low), c_int(high))
 
+def normalvariate(loc, scale, size=None):
+    """Returns a random float on normal distribution with mean `loc` and width `scale`
 
-def normalvariate(loc, scale):
-    """Returns a random float on normal distribution with mean `loc` and width `scale`"""
-    rnd = parcels_random.lib.pcls_normalvariate
-    rnd.argtype = [c_float, c_float]
-    rnd.restype = c_float
-    return rnd(c_float(loc), c_float(scale))
+    :param size: Optional shape of an array of random numbers to return"""
+    if size is not None:
+        return _array('normalvariate', size, np.float32, loc, scale)
+    if _stream is not None:
+        return _stream.normalvariate(loc, scale)
+    return parcels_random.lib.pcls_normalvariate(loc, scale)
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""Performance benchmarks of Parcels built on the example scenarios
+
+Every benchmark runs in a fresh Python process on synthetic grids, so no
+data downloads are needed. Results are written as JSON and can be compared
+between commits:
+
+    python scripts/benchmark.py -s stommel peninsula -p 100 1000 -o new.json
+    python scripts/benchmark.py --compare old.json new.json
+"""
+from argparse import ArgumentParser, SUPPRESS
+from datetime import timedelta as delta
+from os import path
+import json
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+examples_dir = path.join(path.dirname(path.dirname(path.abspath(__file__))), 'examples')
+
+
+def moving_eddies_scenario(grid_dims, npart, pclass):
+    from example_moving_eddies import moving_eddies_grid
+    from parcels import ParticleSet, AdvectionRK4
+    grid = moving_eddies_grid(*grid_dims)
+    pset = ParticleSet.from_line(grid, size=npart, pclass=pclass,
+                                 start=(3.3, 46.), finish=(3.3, 47.8))
+    return pset, AdvectionRK4, delta(days=21), delta(minutes=5), delta(hours=1)
+
+
+def stommel_scenario(grid_dims, npart, pclass):
+    from example_stommel import stommel_grid, UpdateP
+    from parcels import ParticleSet, AdvectionRK4, Variable
+
+    class StommelParticle(pclass):
+        p = Variable('p', dtype=np.float32, initial=0.)
+
+    grid = stommel_grid(*grid_dims)
+    pset = ParticleSet.from_line(grid, size=npart, pclass=StommelParticle,
+                                 start=(100, 5000), finish=(200, 5000))
+    kernel = pset.Kernel(AdvectionRK4) + pset.Kernel(UpdateP)
+    return pset, kernel, delta(days=50), delta(minutes=5), delta(hours=12)
+
+
+def peninsula_scenario(grid_dims, npart, pclass):
+    from example_peninsula import peninsula_grid, UpdateP
+    from parcels import ParticleSet, AdvectionRK4, Variable
+
+    class PeninsulaParticle(pclass):
+        p = Variable('p', dtype=np.float32, initial=0.)
+
+    grid = peninsula_grid(*grid_dims)
+    x = 3. * (1. / 1.852 / 60)  # 3 km offset from boundary
+    pset = ParticleSet.from_line(grid, size=npart, pclass=PeninsulaParticle,
+                                 start=(x, grid.U.lat[0] + x), finish=(x, grid.U.lat[-1] - x))
+    kernel = pset.Kernel(AdvectionRK4) + pset.Kernel(UpdateP)
+    return pset, kernel, delta(hours=24), delta(minutes=5), delta(hours=1)
+
+
+def brownian_scenario(grid_dims, npart, pclass):
+    from example_brownian import brownian_grid, two_dim_brownian_flat
+    from parcels import ParticleSet
+    grid = brownian_grid(*grid_dims)
+    grid.Kh_meridional = 100.
+    grid.Kh_zonal = 100.
+    grid.seedval = 123456
+    pset = ParticleSet.from_line(grid, size=npart, pclass=pclass,
+                                 start=(300000., 300000.), finish=(300000., 300000.))
+    kernel = pset.Kernel(two_dim_brownian_flat, random_streams=True)
+    return pset, kernel, delta(days=1), delta(minutes=5), delta(hours=1)
+
+
+def globcurrent_scenario(grid_dims, npart, pclass):
+    """Daily eddying flow on the GlobCurrent domain around South Africa"""
+    from parcels import Grid, ParticleSet, AdvectionRK4
+    lon = np.linspace(15., 35., grid_dims[0], dtype=np.float32)
+    lat = np.linspace(-45., -25., grid_dims[1], dtype=np.float32)
+    times = np.arange(0., 30. * 86400., 86400., dtype=np.float64)
+    x, y, t = np.meshgrid(np.radians(lon * 4.), np.radians(lat * 4.), times / 86400., indexing='ij')
+    U = (0.5 * np.cos(x + 0.1 * t) * np.sin(y)).astype(np.float32)
+    V = (-0.5 * np.sin(x + 0.1 * t) * np.cos(y)).astype(np.float32)
+    grid = Grid.from_data(U, lon, lat, V, lon, lat, time=times)
+    pset = ParticleSet.from_line(grid, size=npart, pclass=pclass,
+                                 start=(20., -40.), finish=(30., -30.))
+    return pset, AdvectionRK4, delta(days=10), delta(minutes=5), delta(hours=1)
+
+
+scenarios = {'moving_eddies': (moving_eddies_scenario, (200, 350)),
+             'stommel': (stommel_scenario, (200, 200)),
+             'peninsula': (peninsula_scenario, (100, 50)),
+             'brownian': (brownian_scenario, (200, 200)),
+             'globcurrent': (globcurrent_scenario, (81, 41))}
+
+
+def run_single(config):
+    """Run one benchmark in the current process and return its metrics"""
+    sys.path.insert(0, examples_dir)
+    from parcels import ScipyParticle, JITParticle
+    pclass = {'scipy': ScipyParticle, 'jit': JITParticle}[config['mode']]
+    scenario, default_dims = scenarios[config['scenario']]
+    grid_dims = config['grid'] or default_dims
+
+    workdir = tempfile.mkdtemp(prefix='parcels-benchmark-')
+    try:
+        setup_start = time.time()
+        pset, kernel, runtime, dt, interval = scenario(grid_dims, config['particles'], pclass)
+        setup = time.time() - setup_start
+        if config['timesteps'] is not None:
+            runtime = dt * config['timesteps']
+            interval = min(interval, runtime)
+        output_file = None
+        if config['output']:
+            output_file = pset.ParticleFile(name=path.join(workdir, 'BenchmarkParticle'))
+        pset.execute(kernel, runtime=runtime, dt=dt, interval=interval,
+                     output_file=output_file, leap_buffer=config['leap_buffer'],
+                     profile=True)
+    finally:
+        shutil.rmtree(workdir)
+
+    profile = pset.profile
+    total = profile.timers['total']
+    result = dict(config, grid=list(grid_dims))
+    result.update({'setup_time': setup,
+                   'total_time': total,
+                   'compile_time': profile.timers['compile'],
+                   'kernel_time': profile.timers['kernel'],
+                   'recovery_time': profile.timers['recovery'],
+                   'output_time': profile.timers['output'],
+                   'particle_steps': profile.counters['particle_steps'],
+                   'kernel_throughput': profile.throughput,
+                   'throughput': profile.counters['particle_steps'] / total if total > 0. else 0.,
+                   # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+                   'peak_memory_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                   / (1024. ** 2 if sys.platform == 'darwin' else 1024.)})
+    return result
+
+
+def run_benchmark(config, repeat=1):
+    """Run a benchmark `repeat` times in fresh processes and keep the fastest run"""
+    best = None
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, path.abspath(__file__),
+                                          '--single', json.dumps(config)])
+        # Parcels prints compilation messages, the result is on the last line
+        result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        if best is None or result['total_time'] < best['total_time']:
+            best = result
+    return best
+
+
+def environment():
+    """Information on the code version and machine used for benchmarks"""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=examples_dir,
+                                         stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except (subprocess.CalledProcessError, OSError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(),
+            'numpy': np.__version__, 'machine': platform.machine(),
+            'node': platform.node(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def result_key(result):
+    return (result['scenario'], result['mode'], result['particles'], tuple(result['grid']),
+            result['timesteps'], result['output'], result['leap_buffer'])
+
+
+def print_results(results):
+    print("%-14s %-5s %8s %10s %12s %12s %10s %10s %10s" % (
+        'scenario', 'mode', 'npart', 'grid', 'steps/s', 'kernel st/s',
+        'compile s', 'output s', 'memory MB'))
+    for r in results:
+        print("%-14s %-5s %8d %10s %12.4g %12.4g %10.3f %10.3f %10.1f" % (
+            r['scenario'], r['mode'], r['particles'], "%dx%d" % tuple(r['grid']),
+            r['throughput'], r['kernel_throughput'], r['compile_time'],
+            r['output_time'], r['peak_memory_mb']))
+
+
+def compare(old_file, new_file, threshold=0.1):
+    """Compare the throughput of two result files
+
+    :rtype: Number of benchmarks that slowed down by more than `threshold`"""
+    with open(old_file) as f:
+        old = dict((result_key(r), r) for r in json.load(f)['results'])
+    with open(new_file) as f:
+        new = json.load(f)['results']
+    print("%-14s %-5s %8s %10s %12s %12s %8s" % (
+        'scenario', 'mode', 'npart', 'grid', 'old steps/s', 'new steps/s', 'ratio'))
+    regressions = 0
+    for r in new:
+        if result_key(r) not in old:
+            continue
+        o = old[result_key(r)]
+        ratio = r['throughput'] / o['throughput'] if o['throughput'] > 0. else float('nan')
+        flag = ''
+        if ratio < 1. - threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print("%-14s %-5s %8d %10s %12.4g %12.4g %8.3f%s" % (
+            r['scenario'], r['mode'], r['particles'], "%dx%d" % tuple(r['grid']),
+            o['throughput'], r['throughput'], ratio, flag))
+    return regressions
+
+
+if __name__ == "__main__":
+    p = ArgumentParser(description="""
+Benchmark particle throughput, compilation, output cost and memory on synthetic example scenarios""")
+    p.add_argument('-s', '--scenarios', nargs='+', choices=sorted(scenarios.keys()),
+                   default=sorted(scenarios.keys()), help='Scenarios to benchmark')
+    p.add_argument('-m', '--modes', nargs='+', choices=('scipy', 'jit'), default=['jit'],
+                   help='Execution modes to benchmark')
+    p.add_argument('-p', '--particles', type=int, nargs='+', default=[100],
+                   help='Numbers of particles to benchmark')
+    p.add_argument('-g', '--grid', type=int, nargs=2, default=None,
+                   help='Grid dimensions, instead of the defaults of each scenario')
+    p.add_argument('-t', '--timesteps', type=int, default=None,
+                   help='Number of timesteps, instead of the runtime of each scenario')
+    p.add_argument('-n', '--nooutput', action='store_true', default=False,
+                   help='Run without trajectory output')
+    p.add_argument('-b', '--leap-buffer', type=int, default=None,
+                   help='Number of leaps per call into compiled code (JIT only)')
+    p.add_argument('-r', '--repeat', type=int, default=1,
+                   help='Number of repetitions, of which the fastest is reported')
+    p.add_argument('-o', '--output', default=None,
+                   help='JSON file to write the results to')
+    p.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), default=None,
+                   help='Compare two result files instead of running benchmarks')
+    p.add_argument('--threshold', type=float, default=0.1,
+                   help='Relative slowdown reported as regression by --compare')
+    p.add_argument('--single', default=None, help=SUPPRESS)
+    args = p.parse_args()
+
+    if args.single is not None:
+        print(json.dumps(run_single(json.loads(args.single))))
+    elif args.compare is not None:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold) > 0 else 0)
+    else:
+        results = []
+        for scenario in args.scenarios:
+            for mode in args.modes:
+                for npart in args.particles:
+                    config = {'scenario': scenario, 'mode': mode, 'particles': npart,
+                              'grid': args.grid, 'timesteps': args.timesteps,
+                              'output': not args.nooutput, 'leap_buffer': args.leap_buffer}
+                    results.append(run_benchmark(config, args.repeat))
+                    print("%s %s %d particles: %.4g steps/s"
+                          % (scenario, mode, npart, results[-1]['throughput']))
+        print("")
+        print_results(results)
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump({'environment': environment(), 'results': results}, f, indent=2)
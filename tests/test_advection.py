@@ -1,5 +1,5 @@
-from parcels import Grid, ParticleSet, ScipyParticle, JITParticle
-from parcels import AdvectionEE, AdvectionRK4, AdvectionRK45
+from parcels import Grid, ParticleSet, ScipyParticle, JITParticle, Variable
+from parcels import AdvectionEE, AdvectionRK4, AdvectionRK45, AdvectionDOPRI5
 import numpy as np
 import pytest
 import math
@@ -8,7 +8,8 @@ from argparse import ArgumentParser
 
 
 ptype = {'scipy': ScipyParticle, 'jit': JITParticle}
-kernel = {'EE': AdvectionEE, 'RK4': AdvectionRK4, 'RK45': AdvectionRK45}
+kernel = {'EE': AdvectionEE, 'RK4': AdvectionRK4, 'RK45': AdvectionRK45,
+          'DOPRI5': AdvectionDOPRI5}
 
 # Some constants
 f = 1.e-4
@@ -112,6 +113,42 @@ def test_advection_periodic_zonal_meridional(mode, xdim=100, ydim=100):
     assert abs(pset[0].lat - 0.15) < 0.1
 
 
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+def test_advection_periodic_no_halo(mode, xdim=100, ydim=100):
+    grid = periodicgrid(xdim, ydim, uvel=1., vvel=1.)
+    grid.set_periodic(zonal=True, meridional=True)
+    assert len(grid.U.lon) == xdim and len(grid.U.lat) == ydim
+    assert np.isclose(grid.U.lon_period, 1.) and np.isclose(grid.U.lat_period, 1.)
+
+    pset = ParticleSet(grid, pclass=ptype[mode], lon=[0.4], lat=[0.5])
+    pset.execute(AdvectionRK4, endtime=delta(hours=20), dt=delta(seconds=30))
+    assert abs(math.fmod(pset[0].lon, 1) - 0.05) < 0.1
+    assert abs(math.fmod(pset[0].lat, 1) - 0.15) < 0.1
+
+
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+def test_sampling_periodic_boundary(mode, xdim=10, ydim=10):
+    """Sample a zonally varying field in the cell across the periodic boundary"""
+    lon = np.linspace(0., 1., xdim+1, dtype=np.float32)[:-1]
+    lat = np.linspace(0., 1., ydim, dtype=np.float32)
+    U = np.tile(np.arange(xdim, dtype=np.float32)[:, None], (1, ydim))
+    grid = Grid.from_data(U, lon, lat, np.zeros_like(U), lon, lat, mesh='flat')
+    grid.set_periodic(zonal=True)
+
+    class SampleParticle(ptype[mode]):
+        u = Variable('u', dtype=np.float32, initial=0.)
+
+    def SampleU(particle, grid, time, dt):
+        particle.u = grid.U[time, particle.lon, particle.lat]
+
+    xs = np.array([0.25, 0.95, 1.25, -0.05, 2.95], dtype=np.float32)
+    pset = ParticleSet(grid, pclass=SampleParticle, lon=xs, lat=0.5 * np.ones(xs.size))
+    pset.execute(SampleU, starttime=0., endtime=1., dt=1.)
+    assert np.allclose([p.u for p in pset], [2.5, 4.5, 2.5, 4.5, 4.5], rtol=1e-5)
+    # The last cell is closed without an interpolator on a copy of the data
+    assert len(grid.U.interpolator_cache) == 0
+
+
 def truth_stationary(x_0, y_0, t):
     lat = y_0 - u_0 / f * (1 - math.cos(f * t))
     lon = x_0 + u_0 / f * math.sin(f * t)
@@ -139,7 +176,8 @@ def grid_stationary(xdim=100, ydim=100, maxtime=delta(hours=6)):
 @pytest.mark.parametrize('method, rtol', [
     ('EE', 1e-2),
     ('RK4', 1e-5),
-    ('RK45', 1e-5)])
+    ('RK45', 1e-5),
+    ('DOPRI5', 1e-5)])
 def test_stationary_eddy(grid_stationary, mode, method, rtol, npart=1):
     grid = grid_stationary
     lon = np.linspace(12000, 21000, npart, dtype=np.float32)
@@ -180,7 +218,8 @@ def grid_moving(xdim=100, ydim=100, maxtime=delta(hours=6)):
 @pytest.mark.parametrize('method, rtol', [
     ('EE', 1e-2),
     ('RK4', 1e-5),
-    ('RK45', 1e-5)])
+    ('RK45', 1e-5),
+    ('DOPRI5', 1e-5)])
 def test_moving_eddy(grid_moving, mode, method, rtol, npart=1):
     grid = grid_moving
     lon = np.linspace(12000, 21000, npart, dtype=np.float32)
@@ -194,6 +233,23 @@ def test_moving_eddy(grid_moving, mode, method, rtol, npart=1):
     assert np.allclose(np.array([p.lat for p in pset]), exp_lat, rtol=rtol)
 
 
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+def test_dopri5_substeps(grid_moving, mode, npart=1):
+    """Adaptive sub-stepping within a single timestep over the whole run"""
+    grid = grid_moving
+    grid.dopri_tol = 1.e-2
+    lon = np.linspace(12000, 21000, npart, dtype=np.float32)
+    lat = np.linspace(12500, 12500, npart, dtype=np.float32)
+    pset = ParticleSet(grid, pclass=ptype[mode], lon=lon, lat=lat)
+    endtime = delta(hours=6).total_seconds()
+    pset.execute(AdvectionDOPRI5, dt=endtime, endtime=endtime, profile=True)
+    assert pset.profile.counters['particle_steps'] == npart
+    exp_lon = [truth_moving(x, y, endtime)[0] for x, y, in zip(lon, lat)]
+    exp_lat = [truth_moving(x, y, endtime)[1] for x, y, in zip(lon, lat)]
+    assert np.allclose(np.array([p.lon for p in pset]), exp_lon, rtol=1e-5)
+    assert np.allclose(np.array([p.lat for p in pset]), exp_lat, rtol=1e-5)
+
+
 def truth_decaying(x_0, y_0, t):
     lat = y_0 - ((u_0 - u_g) * f / (f ** 2 + gamma ** 2) *
                  (1 - np.exp(-gamma * t) * (np.cos(f * t) + gamma / f * np.sin(f * t))))
@@ -227,7 +283,8 @@ def grid_decaying(xdim=100, ydim=100, maxtime=delta(hours=6)):
 @pytest.mark.parametrize('method, rtol', [
     ('EE', 1e-2),
     ('RK4', 1e-5),
-    ('RK45', 1e-5)])
+    ('RK45', 1e-5),
+    ('DOPRI5', 1e-5)])
 def test_decaying_eddy(grid_decaying, mode, method, rtol, npart=1):
     grid = grid_decaying
     lon = np.linspace(12000, 21000, npart, dtype=np.float32)
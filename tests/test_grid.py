@@ -26,7 +26,7 @@ def test_grid_from_data(xdim, ydim):
     grid = Grid.from_data(u, lon, lat, v, lon, lat, depth, time)
     u_t = np.transpose(u).reshape((lat.size, lon.size))
     v_t = np.transpose(v).reshape((lat.size, lon.size))
-    assert len(grid.U.data.shape) == 3  # Will be 4 once we use depth
+    assert len(grid.U.data.shape) == 3  # Surface fields have no depth axis
     assert len(grid.V.data.shape) == 3
     assert np.allclose(grid.U.data[0, :], u_t, rtol=1e-12)
     assert np.allclose(grid.V.data[0, :], v_t, rtol=1e-12)
@@ -43,7 +43,7 @@ def test_grid_from_nemo(xdim, ydim, tmpdir, filename='test_nemo'):
     grid = Grid.from_nemo(filepath)
     u_t = np.transpose(u).reshape((lat.size, lon.size))
     v_t = np.transpose(v).reshape((lat.size, lon.size))
-    assert len(grid.U.data.shape) == 3  # Will be 4 once we use depth
+    assert len(grid.U.data.shape) == 3  # Surface fields have no depth axis
     assert len(grid.V.data.shape) == 3
     assert np.allclose(grid.U.data[0, :], u_t, rtol=1e-12)
     assert np.allclose(grid.V.data[0, :], v_t, rtol=1e-12)
@@ -69,6 +69,35 @@ def test_grid_from_file_subsets(indslon, indslat, tmpdir, filename='test_subsets
     assert np.allclose(gridsub.V.data, gridfull.V.data[ixgrid])
 
 
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+def test_grid_from_file_depth_subset(mode, tmpdir, filename='test_depth'):
+    """Read a depth range of a 3D grid and write particle depths to file"""
+    lon = np.linspace(0., 1., 10, dtype=np.float32)
+    lat = np.linspace(0., 1., 12, dtype=np.float32)
+    depth = np.array([0., 10., 20., 40., 80.], dtype=np.float32)
+    x, y, z = np.meshgrid(lon, lat, depth, indexing='ij')
+    gridfull = Grid.from_data(x + z, lon, lat, y - z, lon, lat, depth=depth)
+    filepath = tmpdir.join(filename)
+    gridfull.write(filepath)
+
+    indsdepth = [1, 2, 3]
+    gridsub = Grid.from_nemo(filepath, indices={'depth': indsdepth})
+    assert np.allclose(gridsub.U.depth, depth[indsdepth])
+    assert gridsub.U.data.shape == (1, len(indsdepth), lat.size, lon.size)
+    assert np.allclose(gridsub.U.data, gridfull.U.data[:, indsdepth])
+    assert np.allclose(gridsub.V.data, gridfull.V.data[:, indsdepth])
+
+    def Sink(particle, grid, time, dt):
+        particle.depth += 5. * dt
+
+    pdepth = np.array([15., 30.], dtype=np.float32)
+    pset = ParticleSet(gridsub, pclass=ptype[mode], lon=[0.5, 0.5], lat=[0.5, 0.5], depth=pdepth)
+    output_file = pset.ParticleFile(name=tmpdir.join('pset_depth').strpath)
+    pset.execute(Sink, starttime=0., endtime=2., dt=1., interval=1., output_file=output_file)
+    output_file.dataset.sync()
+    assert np.allclose(output_file.dataset.variables['z'][:], pdepth[:, None] + [0., 5., 10.])
+
+
 @pytest.mark.parametrize('indstime', [range(10, 20), [4]])
 def test_moving_eddies_file_subsettime(indstime, gridfile='examples/MovingEddies_data/moving_eddies'):
     gridfull = Grid.from_nemo(gridfile, extra_vars={'P': 'P'})
@@ -122,6 +151,35 @@ def test_grid_gradient():
                        rtol=1e-2)  # Field gradient dy.
 
 
+def test_grid_gradient_timerange_lazy():
+    lon = np.linspace(0, 10, 21, dtype=np.float32)
+    lat = np.linspace(-20, 20, 17, dtype=np.float32)
+    time = np.arange(5, dtype=np.float64)
+    data = (time[:, None, None] + 1) * (lon[None, None, :] ** 2 + lat[None, :, None] * lon[None, None, :])
+    field = Field('T', data.astype(np.float32), lon=lon, lat=lat, time=time)
+    dx, dy = field.gradient(timerange=(2., 4.))
+    assert dx.data.shape == (3, lat.size, lon.size)
+    assert np.allclose(dx.time, [2., 3., 4.])
+
+    # Reference gradients on the spherical mesh
+    r = 6.371e6
+    deg2rd = np.pi / 180.
+    for i, t in enumerate([2, 3, 4]):
+        ref_dy = np.gradient(field.data[t], r * (lat[1] - lat[0]) * deg2rd, axis=0)
+        assert np.allclose(dy.data[i], ref_dy, rtol=1e-5)
+        for j in range(lat.size):
+            ref_dx = np.gradient(field.data[t, j], r * np.cos(lat[j] * deg2rd) * (lon[1] - lon[0]) * deg2rd)
+            assert np.allclose(dx.data[i, j], ref_dx, rtol=1e-5)
+
+    # Lazy gradients give the same values, whether sampled slice by slice or as a whole
+    dx_lazy, dy_lazy = field.gradient(timerange=(2., 4.), lazy=True)
+    assert np.allclose(dx_lazy.eval(3.5, 5.2, 3.1), dx.eval(3.5, 5.2, 3.1))
+    assert np.allclose(dy_lazy.eval(2., 1.3, -7.5), dy.eval(2., 1.3, -7.5))
+    assert len(dx_lazy.data.cache) == 2
+    assert np.allclose(dx_lazy.data[1, :, :], dx.data[1])
+    assert np.allclose(np.asarray(dy_lazy.data), dy.data)
+
+
 def addConst(particle, grid, time, dt):
     particle.lon = particle.lon + grid.movewest + grid.moveeast
 
@@ -291,3 +291,149 @@ def test_sampling_out_of_bounds_time(mode, allow_time_extrapolation, k_sample_p,
     else:
         with pytest.raises(RuntimeError):
             pset.execute(k_sample_p, starttime=2.0, endtime=2.1, dt=0.1)
+
+
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+def test_sampling_replaced_field_data(mode, k_sample_p, xdim=10, ydim=10):
+    """Sampling test that ensures repeated executions pick up
+    field data that has been replaced in between."""
+    lon = np.linspace(0., 1., xdim, dtype=np.float32)
+    lat = np.linspace(0., 1., ydim, dtype=np.float32)
+    U = np.zeros((xdim, ydim), dtype=np.float32)
+    V = np.zeros((xdim, ydim), dtype=np.float32)
+    P = np.ones((xdim, ydim), dtype=np.float32)
+    grid = Grid.from_data(U, lon, lat, V, lon, lat, mesh='flat',
+                          field_data={'P': P})
+    pset = ParticleSet.from_line(grid, size=5, pclass=pclass(mode),
+                                 start=(0.1, 0.1), finish=(0.9, 0.9))
+    for value in [1., 2., 3.]:
+        grid.P.data = np.ones_like(grid.P.data) * value
+        grid.P.interpolator_cache.clear()
+        pset.execute(k_sample_p, starttime=0., endtime=1., dt=1.)
+        assert np.allclose(np.array([p.p for p in pset]), value, rtol=1e-5)
+
+
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+@pytest.mark.parametrize('shift', [0., 0.5])
+def test_sampling_vector_field(mode, shift, npart=10):
+    """Sample both velocity components at once on a spherical mesh with two
+    snapshots in time, with U and V on the same or on different grids"""
+    lon = np.linspace(-180, 180, 200, dtype=np.float32)
+    lat = np.linspace(-80, 80, 100, dtype=np.float32)
+    time = np.array([0., 86400.], dtype=np.float64)
+    U = np.random.rand(lon.size, lat.size, time.size).astype(np.float32)
+    V = np.random.rand(lon.size, lat.size, time.size).astype(np.float32)
+    grid = Grid.from_data(U, lon, lat, V, lon + shift, lat, time=time)
+    assert grid.UV.fused == (shift == 0.)
+
+    def SampleVectorUV(particle, grid, time, dt):
+        particle.u, particle.v = grid.UV[time, particle.lon, particle.lat]
+
+    pset = ParticleSet(grid, pclass=pclass(mode),
+                       lon=np.linspace(-170, 170, npart, dtype=np.float32),
+                       lat=np.linspace(-70, 70, npart, dtype=np.float32))
+    t0 = 0.3 * 86400.
+    pset.execute(pset.Kernel(SampleVectorUV), starttime=t0, endtime=t0 + 1., dt=1.)
+    assert np.allclose([p.u for p in pset], [grid.U[t0, p.lon, p.lat] for p in pset], rtol=1e-5)
+    assert np.allclose([p.v for p in pset], [grid.V[t0, p.lon, p.lat] for p in pset], rtol=1e-5)
+
+
+def grid_3D(xdim=11, ydim=11, depth=(0., 10., 50., 100.)):
+    """Grid with P = lon + 2 lat + 0.1 depth on irregular depth levels,
+    U increasing with depth and V equal to lon"""
+    lon = np.linspace(0., 1., xdim, dtype=np.float32)
+    lat = np.linspace(0., 1., ydim, dtype=np.float32)
+    depth = np.array(depth, dtype=np.float32)
+    x, y, z = np.meshgrid(lon, lat, depth, indexing='ij')
+    return Grid.from_data(0.01 * z, lon, lat, x, lon, lat, depth=depth,
+                          field_data={'P': x + 2 * y + 0.1 * z}, mesh='flat')
+
+
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+def test_sampling_3D(mode, npart=10):
+    grid = grid_3D()
+    assert grid.P.data.shape == (1, 4, 11, 11)
+
+    def SampleSink(particle, grid, time, dt):
+        particle.depth += 10. * dt
+        particle.p = grid.P[time, particle.lon, particle.lat, particle.depth]
+        particle.u, particle.v = grid.UV[time, particle.lon, particle.lat, particle.depth]
+
+    lon = np.linspace(0.05, 0.95, npart, dtype=np.float32)
+    lat = np.linspace(0.9, 0.1, npart, dtype=np.float32)
+    depth = np.linspace(0., 60., npart, dtype=np.float32)
+    pset = ParticleSet(grid, pclass=pclass(mode), lon=lon, lat=lat, depth=depth)
+    pset.execute(SampleSink, starttime=0., endtime=3., dt=1.)
+    assert np.allclose([p.depth for p in pset], depth + 30.)
+    assert np.allclose([p.p for p in pset], lon + 2 * lat + 0.1 * (depth + 30.), rtol=1e-5)
+    assert np.allclose([p.u for p in pset], 0.01 * (depth + 30.), rtol=1e-5)
+    assert np.allclose([p.v for p in pset], lon, rtol=1e-5)
+
+
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+def test_advection_3D(mode, npart=4):
+    """Particles at different depths are advected by the velocities at their depth"""
+    grid = grid_3D()
+    grid.V.data[:] = 0.
+    depth = np.array([0., 5., 30., 75.], dtype=np.float32)
+    pset = ParticleSet(grid, pclass=ptype[mode], lon=0.1 * np.ones(npart),
+                       lat=0.5 * np.ones(npart), depth=depth)
+    pset.execute(AdvectionRK4, starttime=0., endtime=1., dt=0.1)
+    assert np.allclose([p.lon for p in pset], 0.1 + 0.01 * depth, rtol=1e-5)
+
+
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+def test_advection_3D_default_depth(mode, npart=4):
+    """Particles at the default depth of 0 are advected by the top level,
+    also if it is below the surface as in NEMO output"""
+    grid = grid_3D(depth=(0.494, 10., 50., 100.))
+    grid.V.data[:] = 0.
+    lon = np.linspace(0.1, 0.4, npart, dtype=np.float32)
+    pset = ParticleSet(grid, pclass=ptype[mode], lon=lon, lat=0.5 * np.ones(npart))
+    pset.execute(AdvectionRK4, starttime=0., endtime=1., dt=0.1)
+    assert np.allclose([p.depth for p in pset], 0.)
+    assert np.allclose([p.lon for p in pset], lon + 0.01 * 0.494, rtol=1e-5)
+
+
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+def test_sampling_staggered_and_coarse(mode, npart=10):
+    """Fields on staggered and coarser coordinates than U are sampled
+    with their own grid indices, which are shared by fields on the same grid"""
+    lon = np.linspace(0., 1., 21, dtype=np.float32)
+    lat = np.linspace(0., 1., 11, dtype=np.float32)
+    lon_v = lon + 0.025
+    lon_c = np.linspace(-1., 2., 4, dtype=np.float32)
+    lat_c = np.linspace(-1., 2., 3, dtype=np.float32)
+    x, y = np.meshgrid(lon_v, lat, indexing='ij')
+    xc, yc = np.meshgrid(lon_c, lat_c, indexing='ij')
+    grid = Grid.from_data(np.zeros(x.shape, dtype=np.float32), lon, lat, x, lon_v, lat,
+                          field_data={'P': y, 'C': (xc + 10 * yc, lon_c, lat_c)}, mesh='flat')
+    sets = [(names, [f.name for f in fields]) for names, fields in grid.coordinate_sets]
+    assert sets == [(('xi', 'yi', 'zi'), ['U']), (('xi_1', 'yi_1', 'zi_1'), ['V', 'P']),
+                    (('xi_2', 'yi_2', 'zi_2'), ['C'])]
+
+    class SampleParticle(ptype[mode]):
+        v = Variable('v', dtype=np.float32)
+        p = Variable('p', dtype=np.float32)
+        c = Variable('c', dtype=np.float32)
+
+    def SampleEast(particle, grid, time, dt):
+        particle.lon += 0.02
+        particle.v = grid.V[time, particle.lon, particle.lat]
+        particle.p = grid.P[time, particle.lon, particle.lat]
+        particle.c = grid.C[time, particle.lon, particle.lat]
+
+    lon = np.linspace(0.1, 0.7, npart, dtype=np.float32)
+    lat = np.linspace(0.9, 0.1, npart, dtype=np.float32)
+    pset = ParticleSet(grid, pclass=SampleParticle, lon=lon, lat=lat)
+    pset.execute(SampleEast, starttime=0., endtime=10., dt=1.)
+    lon += 0.2
+    assert np.allclose([p.v for p in pset], lon, rtol=1e-5)
+    assert np.allclose([p.p for p in pset], lat, rtol=1e-5)
+    assert np.allclose([p.c for p in pset], lon + 10 * lat, rtol=1e-5)
+    if mode == 'jit':
+        names = [v.name for v in pset.ptype.variables]
+        assert all(name in names for name in ['xi_1', 'yi_1', 'xi_2', 'yi_2'])
+        assert 'U' not in pset.kernel.field_args
+        # Indices of the coarse field point to the cells of the particles
+        assert all(lon_c[p._cptr['xi_2']] <= p.lon < lon_c[p._cptr['xi_2'] + 1] for p in pset)
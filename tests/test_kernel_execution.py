@@ -1,7 +1,9 @@
 from parcels import (
     Grid, ParticleSet, ScipyParticle, JITParticle, ErrorCode, KernelError,
-    OutOfBoundsError
+    OutOfBoundsError, compile_kernels, Kernel, Variable
 )
+from os import path, remove, walk
+import parcels.compiler
 import numpy as np
 import pytest
 
@@ -156,3 +158,293 @@ def test_execution_delete_out_of_bounds(grid, mode, npart=10):
     pset.execute(MoveRight, starttime=0., endtime=10., dt=1.,
                  recovery={ErrorCode.ErrorOutOfBounds: DeleteMe})
     assert len(pset) == 0
+
+
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+def test_execution_delete_and_recover(grid, mode, npart=10):
+    def DeleteNorthMoveRight(particle, grid, time, dt):
+        if particle.lat > 0.5:
+            particle.delete()
+        else:
+            grid.U[time, particle.lon + 0.1, particle.lat]
+            particle.lon += 0.1
+
+    def MoveLeft(particle):
+        particle.lon -= 1.
+
+    lon = np.linspace(0.05, 0.95, npart, dtype=np.float32)
+    lat = np.linspace(1, 0, npart, dtype=np.float32)
+    pset = ParticleSet(grid, pclass=ptype[mode], lon=lon, lat=lat)
+    pset.execute(DeleteNorthMoveRight, starttime=0., endtime=10., dt=1.,
+                 recovery={ErrorCode.ErrorOutOfBounds: MoveLeft})
+    south = lat <= 0.5
+    assert len(pset) == south.sum()
+    assert np.allclose([p.lon for p in pset], lon[south], rtol=1e-5)
+    assert np.allclose([p.lat for p in pset], lat[south], rtol=1e-5)
+    assert np.allclose([p.time for p in pset], 10., rtol=1e-5)
+
+
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+def test_execution_profile(grid, mode, npart=10):
+    def DeleteNorthProfiled(particle, grid, time, dt):
+        if particle.lat > 0.5:
+            return ErrorCode.Delete
+
+    lat = np.linspace(1, 0, npart, dtype=np.float32)
+    pset = ParticleSet(grid, pclass=ptype[mode],
+                       lon=np.linspace(0, 1, npart, dtype=np.float32), lat=lat)
+    pset.execute(DeleteNorthProfiled, starttime=0., endtime=10., dt=1., interval=5.,
+                 profile=True)
+    report = pset.profile.report()
+    north = (lat > 0.5).sum()
+    assert report['counters']['particle_steps'] == north + 10 * (npart - north)
+    assert report['counters']['deletions'] == north
+    assert report['counters']['repeats'] == 0
+    assert report['timers']['total'] >= report['timers']['kernel'] > 0.
+    assert report['throughput'] > 0.
+
+
+def test_execution_instrumented(grid, npart=10):
+    def SampleMoveEastInstrumented(particle, grid, time, dt):
+        grid.U[time, particle.lon, particle.lat]
+        particle.lon += 0.05
+
+    pset = ParticleSet(grid, pclass=JITParticle,
+                       lon=np.linspace(0, 0.4, npart, dtype=np.float32),
+                       lat=np.linspace(1, 0, npart, dtype=np.float32))
+    xi = sum(p.xi for p in pset)
+    kernel = pset.Kernel(SampleMoveEastInstrumented, instrument=True)
+    pset.execute(kernel, starttime=0., endtime=10., dt=1., profile=True)
+    stats = pset.profile.report()['kernel_stats']
+    assert stats['particles'] == npart
+    assert stats['iterations'] == 10 * npart
+    assert stats['interpolations'] == 10 * npart
+    # Two searches per interpolation plus the update of the particle index
+    assert stats['searches'] == 3 * stats['interpolations']
+    # Particles only move eastward, so index walks add up to the change of index
+    assert stats['search_steps'] == sum(p.xi for p in pset) - xi
+    assert stats['errors'][ErrorCode.Success.name] == 10 * npart
+    kernel.reset_stats()
+    assert kernel.stats()['iterations'] == 0
+
+
+@pytest.mark.parametrize('compiler_profile', ['native', 'pgo'])
+def test_execution_compiler_profile(grid, compiler_profile, npart=10):
+    def SampleMoveEastProfiled(particle, grid, time, dt):
+        u = grid.U[time, particle.lon, particle.lat]
+        particle.lon += 0.01 * (1. + u)
+
+    def make_pset():
+        return ParticleSet(grid, pclass=JITParticle,
+                           lon=np.linspace(0, 0.4, npart, dtype=np.float32),
+                           lat=np.linspace(0.9, 0.1, npart, dtype=np.float32))
+
+    pset_portable = make_pset()
+    kernel_portable = pset_portable.Kernel(SampleMoveEastProfiled)
+    pset_portable.execute(kernel_portable, starttime=0., endtime=20., dt=1.)
+    pset = make_pset()
+    kernel = pset.Kernel(SampleMoveEastProfiled, compiler_profile=compiler_profile)
+    if path.exists(kernel.lib_file):
+        remove(kernel.lib_file)
+    pset.execute(kernel, starttime=0., endtime=20., dt=1.)
+    assert kernel.lib_file != kernel_portable.lib_file
+    if compiler_profile == 'pgo':
+        # The training process writes profile data when it exits
+        pgo_dir = "%s-pgo" % path.splitext(kernel.src_file)[0]
+        assert any(f.endswith('.gcda') for _, _, files in walk(pgo_dir) for f in files)
+    assert np.allclose([p.lon for p in pset], [p.lon for p in pset_portable], rtol=1e-6)
+    # PGO training runs on a copy and must not move the particles twice
+    assert np.allclose([p.time for p in pset], 20.)
+
+
+@pytest.mark.parametrize('wait', [True, False])
+def test_compile_kernels(grid, wait, npart=10):
+    def MoveEastAhead(particle, grid, time, dt):
+        particle.lon += 0.01
+
+    def MoveNorthAhead(particle, grid, time, dt):
+        particle.lat += 0.02
+
+    pset = ParticleSet(grid, pclass=JITParticle,
+                       lon=np.linspace(0, 0.4, npart, dtype=np.float32),
+                       lat=np.linspace(0, 0.4, npart, dtype=np.float32))
+    kernels = [pset.Kernel(MoveEastAhead), pset.Kernel(MoveNorthAhead),
+               pset.Kernel(MoveEastAhead) + pset.Kernel(MoveNorthAhead)]
+    for kernel in kernels:
+        if path.exists(kernel.lib_file):
+            remove(kernel.lib_file)
+    compile_kernels(kernels, processes=2, wait=wait)
+    if wait:
+        assert all(path.exists(kernel.lib_file) for kernel in kernels)
+    pset.execute(kernels[2], starttime=0., endtime=10., dt=1.)
+    mtime = path.getmtime(kernels[2].lib_file)
+    assert np.allclose([p.lon for p in pset], np.linspace(0, 0.4, npart) + 0.1, rtol=1e-5)
+    assert np.allclose([p.lat for p in pset], np.linspace(0, 0.4, npart) + 0.2, rtol=1e-5)
+    # Cached libraries are not compiled again
+    pset.execute(kernels[2], starttime=10., endtime=11., dt=1.)
+    assert path.getmtime(kernels[2].lib_file) == mtime
+    if not wait:
+        # Background pools are joined once all their libraries are compiled
+        for kernel in kernels:
+            if kernel.lib_file in parcels.compiler._pending:
+                parcels.compiler._pending[kernel.lib_file].wait()
+        parcels.compiler._reap_pools()
+        assert len(parcels.compiler._pools) == 0
+
+
+def test_kernel_bundle(grid, tmpdir, monkeypatch, npart=10):
+    def MoveEastBundled(particle, grid, time, dt):
+        u = grid.U[time, particle.lon, particle.lat]
+        particle.lon += grid.speed * u
+
+    def MoveBack(particle):
+        particle.lon -= 0.5
+
+    grid.speed = 0.1
+    recovery = {ErrorCode.ErrorOutOfBounds: MoveBack}
+    lon = np.linspace(0.1, 0.8, npart, dtype=np.float32)
+    lat = np.linspace(0.9, 0.1, npart, dtype=np.float32)
+    pset = ParticleSet(grid, pclass=JITParticle, lon=lon, lat=lat)
+    kernel = pset.Kernel(MoveEastBundled, recovery=recovery)
+    name = str(tmpdir.join('MoveEastBundled'))
+    kernel.export_bundle(name)
+    pset.execute(kernel, starttime=0., endtime=10., dt=1., recovery=recovery)
+
+    # Loading the bundle must not need a C compiler
+    monkeypatch.setenv('CC', str(tmpdir.join('no-compiler')))
+    pset_bundled = ParticleSet(grid, pclass=JITParticle, lon=lon, lat=lat)
+    bundled = Kernel.from_bundle(name, grid, pset_bundled.ptype, recovery=recovery)
+    assert bundled.lib_file == "%s.so" % name
+    pset_bundled.execute(bundled, starttime=0., endtime=10., dt=1., recovery=recovery)
+    assert np.allclose([p.lon for p in pset_bundled], [p.lon for p in pset], rtol=1e-6)
+
+    class BundleParticle(JITParticle):
+        p = Variable('p', dtype=np.float32)
+
+    for args in [(grid, ParticleSet(grid, pclass=BundleParticle, lon=lon, lat=lat).ptype),
+                 (Grid.from_data(grid.U.data, grid.U.lon, grid.U.lat,
+                                 grid.V.data, grid.V.lon, grid.V.lat, mesh='flat'),
+                  pset.ptype)]:
+        with pytest.raises(RuntimeError):
+            Kernel.from_bundle(name, *args, recovery=recovery)
+    with pytest.raises(RuntimeError):
+        Kernel.from_bundle(name, grid, pset.ptype)
+
+
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+def test_execution_merge_locals(grid, mode, npart=10):
+    def MoveEastNoLocals(particle, grid, time, dt):
+        particle.lon += 0.01
+
+    def MoveNorthNoLocals(particle, grid, time, dt):
+        particle.lat += 0.02
+
+    def MoveEastLocal(particle, grid, time, dt):
+        step = 0.01
+        particle.lon += step
+
+    def MoveNorthLocal(particle, grid, time, dt):
+        step = 0.02
+        particle.lat += step
+
+    pset = ParticleSet(grid, pclass=ptype[mode],
+                       lon=np.linspace(0, 0.4, npart, dtype=np.float32),
+                       lat=np.linspace(0, 0.4, npart, dtype=np.float32))
+    no_locals = [pset.Kernel(MoveEastNoLocals), pset.Kernel(MoveNorthNoLocals)]
+    with_locals = [pset.Kernel(MoveEastLocal), pset.Kernel(MoveNorthLocal)]
+    pset.execute(no_locals[0] + no_locals[1], starttime=0., endtime=5., dt=1.)
+    pset.execute(with_locals[0] + with_locals[1], starttime=5., endtime=10., dt=1.)
+    assert np.allclose([p.lon for p in pset], np.linspace(0, 0.4, npart) + 0.1, rtol=1e-5)
+    assert np.allclose([p.lat for p in pset], np.linspace(0, 0.4, npart) + 0.2, rtol=1e-5)
+
+
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+def test_execution_recover_in_kernel_language(grid, mode, npart=10):
+    def MoveRight(particle, grid, time, dt):
+        grid.U[time, particle.lon + 0.1, particle.lat]
+        particle.lon += 0.1
+
+    def MoveLeftOrDelete(particle):
+        if particle.lat > 0.5:
+            particle.delete()
+        else:
+            particle.lon -= 1.
+
+    lon = np.linspace(0.05, 0.95, npart, dtype=np.float32)
+    lat = np.linspace(1, 0, npart, dtype=np.float32)
+    pset = ParticleSet(grid, pclass=ptype[mode], lon=lon, lat=lat)
+    pset.execute(MoveRight, starttime=0., endtime=10., dt=1.,
+                 recovery={ErrorCode.ErrorOutOfBounds: MoveLeftOrDelete})
+    if mode == 'jit':
+        assert ErrorCode.ErrorOutOfBounds in pset.kernel.recovery_jit
+    south = lat <= 0.5
+    assert len(pset) == south.sum()
+    assert np.allclose([p.lon for p in pset], lon[south], rtol=1e-5)
+
+
+def test_execution_recover_counters(grid, npart=10):
+    """Recoveries inside the compiled loop are counted like recoveries in Python"""
+    def MoveRightCounted(particle, grid, time, dt):
+        grid.U[time, particle.lon + 0.1, particle.lat]
+        particle.lon += 0.1
+
+    def MoveLeftOrDeleteCounted(particle):
+        if particle.lat > 0.5:
+            particle.delete()
+        else:
+            particle.lon -= 1.
+
+    reports = {}
+    for mode in ['scipy', 'jit']:
+        pset = ParticleSet(grid, pclass=ptype[mode],
+                           lon=np.linspace(0.05, 0.95, npart, dtype=np.float32),
+                           lat=np.linspace(1, 0, npart, dtype=np.float32))
+        pset.execute(MoveRightCounted, starttime=0., endtime=10., dt=1., profile=True,
+                     recovery={ErrorCode.ErrorOutOfBounds: MoveLeftOrDeleteCounted})
+        reports[mode] = pset.profile.report()
+    scipy, jit = reports['scipy']['counters'], reports['jit']['counters']
+    for event in ['particle_steps', 'repeats', 'deletions']:
+        assert jit[event] == scipy[event]
+    assert scipy['repeats'] == 0
+    assert jit['loop_recoveries'] == reports['scipy']['errors']['ErrorOutOfBounds'] > 0
+
+
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+def test_execution_recover_python_fallback(grid, mode, npart=10):
+    def MoveRight(particle, grid, time, dt):
+        grid.U[time, particle.lon + 0.1, particle.lat]
+        particle.lon += 0.1
+
+    recovered = []
+
+    def RecordAndDelete(particle):
+        recovered.append(particle.lon)
+        particle.delete()
+
+    lon = np.linspace(0.05, 0.95, npart, dtype=np.float32)
+    lat = np.linspace(1, 0, npart, dtype=np.float32)
+    pset = ParticleSet(grid, pclass=ptype[mode], lon=lon, lat=lat)
+    pset.execute(MoveRight, starttime=0., endtime=10., dt=1.,
+                 recovery={ErrorCode.ErrorOutOfBounds: RecordAndDelete})
+    if mode == 'jit':
+        assert ErrorCode.ErrorOutOfBounds not in pset.kernel.recovery_jit
+    assert len(pset) == 0
+    assert len(recovered) == npart
+
+
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+def test_execution_recover_error(grid, mode, npart=10):
+    """ Errors in recovery kernels are raised instead of falling back to Python """
+    def MoveRight(particle, grid, time, dt):
+        grid.U[time, particle.lon + 0.1, particle.lat]
+        particle.lon += 0.1
+
+    def MoveLeftTypo(particle):
+        particle.lon -= particle.dlon
+
+    pset = ParticleSet(grid, pclass=ptype[mode],
+                       lon=np.linspace(0.05, 0.95, npart, dtype=np.float32),
+                       lat=np.linspace(1, 0, npart, dtype=np.float32))
+    with pytest.raises(AttributeError):
+        pset.execute(MoveRight, starttime=0., endtime=10., dt=1.,
+                     recovery={ErrorCode.ErrorOutOfBounds: MoveLeftTypo})
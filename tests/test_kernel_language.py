@@ -1,6 +1,7 @@
 from parcels import Grid, ParticleSet, ScipyParticle, JITParticle, Kernel, Variable
 from parcels import random as parcels_random
 import numpy as np
+from scipy import stats
 import pytest
 import random as py_random
 
@@ -98,6 +99,57 @@ def random_series(npart, rngfunc, rngargs, mode):
     return series
 
 
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+def test_local_variable_types(grid, mode, npart=10):
+    """ Test that local variables mixed with time keep double precision """
+    class TestParticle(ptype[mode]):
+        p = Variable('p', dtype=np.float32)
+
+    def LocalDouble(particle, grid, time, dt):
+        t = time + 1.e-3
+        particle.p = t - time
+
+    pset = ParticleSet(grid, pclass=TestParticle,
+                       lon=np.linspace(0., 1., npart, dtype=np.float32),
+                       lat=np.zeros(npart, dtype=np.float32) + 0.5)
+    kernel = pset.Kernel(LocalDouble)
+    pset.execute(kernel, starttime=1.e6, endtime=1.e6 + 1., dt=1.)
+    assert np.allclose(np.array([p.p for p in pset]), 1.e-3, rtol=1e-6)
+    if mode == 'jit':
+        assert 'double t;' in kernel.ccode
+        # The loops pass dt on to the kernel without truncation
+        assert 'double endtime, double dt' in kernel.ccode
+        assert 'int *counts, double dt' in kernel.ccode
+
+
+def test_optimized_code(grid, npart=10):
+    """ Test that repeated field evaluations and expressions are computed
+    once in JIT kernels, unless their arguments are assigned in between """
+    def OptimizedSampling(particle, grid, time, dt):
+        x = particle.lon + 0.5 * 0.2
+        u1 = grid.U[time, x, particle.lat]
+        u2 = grid.U[time, x, particle.lat]
+        unused = u1 * 2.  # noqa
+        particle.p = u1 + u2 + (particle.lon + 0.1) * 2.
+        x = x + 0.1
+        particle.q = grid.U[time, x, particle.lat]
+
+    pvalues = []
+    for mode in ['scipy', 'jit']:
+        class TestParticle(ptype[mode]):
+            p = Variable('p', dtype=np.float32)
+            q = Variable('q', dtype=np.float32)
+        pset = ParticleSet(grid, pclass=TestParticle,
+                           lon=np.linspace(0., 0.7, npart, dtype=np.float32),
+                           lat=np.zeros(npart, dtype=np.float32) + 0.5)
+        kernel = pset.Kernel(OptimizedSampling)
+        pset.execute(kernel, endtime=1., dt=1.)
+        pvalues.append(np.array([(p.p, p.q) for p in pset]))
+    assert kernel.ccode.count('temporal_interpolation_linear(') == 2
+    assert 'unused =' not in kernel.ccode
+    assert np.allclose(pvalues[0], pvalues[1], rtol=1e-6)
+
+
 @pytest.mark.parametrize('mode', ['scipy', 'jit'])
 @pytest.mark.parametrize('rngfunc, rngargs', [
     ('random', []),
@@ -116,3 +168,113 @@ def test_random_float(grid, mode, rngfunc, rngargs, npart=10):
                          'random.%s(%s)' % (rngfunc, ', '.join([str(a) for a in rngargs])))
     pset.execute(kernel, endtime=1., dt=1.)
     assert np.allclose(np.array([p.p for p in pset]), series, rtol=1e-12)
+
+
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+def test_random_streams(grid, mode, npart=10):
+    """ Test counter-based random streams keyed on particle ID and time """
+    random = parcels_random
+
+    class TestParticle(ptype[mode]):
+        p = Variable('p', dtype=np.float32)
+        q = Variable('q', dtype=np.float32)
+
+    def TestStreams(particle, grid, time, dt):
+        particle.p = random.uniform(0., 20.)
+        particle.q = random.normalvariate(0., 1.)
+
+    pset = ParticleSet(grid, pclass=TestParticle,
+                       lon=np.linspace(0., 1., npart, dtype=np.float32),
+                       lat=np.zeros(npart, dtype=np.float32) + 0.5)
+    parcels_random.seed(1234)
+    pset.execute(pset.Kernel(TestStreams, random_streams=True), starttime=0., endtime=1., dt=1.)
+    for p in pset:
+        stream = parcels_random.RandomStream(p.id, 0.)
+        assert np.allclose([p.p, p.q], [stream.uniform(0., 20.), stream.normalvariate(0., 1.)],
+                           rtol=1e-6)
+    assert len(np.unique([p.p for p in pset])) == npart
+
+
+@pytest.mark.parametrize('rngfunc, rngargs', [
+    ('random', []),
+    ('uniform', [0., 20.]),
+    ('randint', [0, 20]),
+    ('normalvariate', [0., 1.]),
+])
+def test_random_array(rngfunc, rngargs, size=100):
+    """ Test that array variants match repeated scalar calls """
+    series = random_series(size, rngfunc, rngargs, 'jit')
+    array = getattr(parcels_random, rngfunc)(*rngargs, size=(10, size // 10))
+    assert array.shape == (10, size // 10)
+    assert np.allclose(array.ravel(), series, rtol=1e-12)
+
+
+def test_normalvariate_distribution(size=100000):
+    """ Statistical test of the normal distribution of the internal RNG """
+    parcels_random.seed(1234)
+    series = parcels_random.normalvariate(1., 2., size=size)
+    assert np.allclose(series.mean(), 1., atol=0.05)
+    assert np.allclose(series.std(), 2., rtol=0.02)
+    assert stats.kstest((series - 1.) / 2., 'norm').pvalue > 0.001
+    # Consecutive variates are generated in pairs and must be uncorrelated
+    assert abs(np.corrcoef(series[0::2], series[1::2])[0, 1]) < 0.02
+
+
+def test_normalvariate_reseed(size=3):
+    """ Test that seeding discards the cached second normal variate """
+    series = []
+    for _ in range(2):
+        parcels_random.seed(1)
+        series.append([parcels_random.normalvariate(0., 1.) for _ in range(size)])
+    assert np.allclose(series[0], series[1], rtol=1e-12)
+
+
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+def test_normalvariate_reseed_kernel(grid, mode, npart=3):
+    """ Test that reseeding makes normal variates drawn in kernels reproducible """
+    random = parcels_random
+
+    class TestParticle(ptype[mode]):
+        p = Variable('p', dtype=np.float32)
+
+    def NormalSample(particle, grid, time, dt):
+        particle.p = random.normalvariate(0., 1.)
+
+    pset = ParticleSet(grid, pclass=TestParticle,
+                       lon=np.linspace(0., 1., npart, dtype=np.float32),
+                       lat=np.zeros(npart, dtype=np.float32) + 0.5)
+    kernel = pset.Kernel(NormalSample)
+    series = []
+    for _ in range(2):
+        # An odd number of draws leaves a cached variate behind
+        parcels_random.seed(1)
+        pset.execute(kernel, starttime=0., endtime=1., dt=1.)
+        series.append([p.p for p in pset])
+    assert np.allclose(series[0], series[1], rtol=1e-12)
+
+
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+def test_normalvariate_streams_distribution(grid, mode, npart=2000):
+    """ Statistical test of the normal distribution of random streams """
+    random = parcels_random
+
+    class TestParticle(ptype[mode]):
+        p = Variable('p', dtype=np.float32)
+        q = Variable('q', dtype=np.float32)
+
+    def NormalStreams(particle, grid, time, dt):
+        particle.p = random.normalvariate(0., 1.)
+        particle.q = random.normalvariate(0., 1.)
+
+    pset = ParticleSet(grid, pclass=TestParticle,
+                       lon=np.linspace(0., 1., npart, dtype=np.float32),
+                       lat=np.zeros(npart, dtype=np.float32) + 0.5)
+    parcels_random.seed(1234)
+    pset.execute(pset.Kernel(NormalStreams, random_streams=True), starttime=0., endtime=1., dt=1.)
+    p = np.array([particle.p for particle in pset])
+    q = np.array([particle.q for particle in pset])
+    for series in [p, q]:
+        assert abs(series.mean()) < 0.1
+        assert np.allclose(series.std(), 1., rtol=0.05)
+        assert stats.kstest(series, 'norm').pvalue > 0.001
+    assert abs(np.corrcoef(p, q)[0, 1]) < 0.1
@@ -1,4 +1,5 @@
-from parcels import Grid, ParticleSet, Field, ScipyParticle, JITParticle
+from parcels import (Grid, ParticleSet, Field, ScipyParticle, JITParticle,
+                     ParticleCheckpoint, Variable)
 import numpy as np
 import pytest
 
@@ -48,6 +49,28 @@ def test_pset_create_field(grid, mode, npart=100):
     assert (np.array([p.lat for p in pset]) >= 0.).all()
 
 
+@pytest.mark.parametrize('sampling', ['monte_carlo', 'stratified'])
+def test_pset_create_field_distribution(grid, sampling, npart=3000):
+    np.random.seed(123456)
+    lon = np.linspace(0, 1, 10, dtype=np.float32)
+    lat = np.linspace(0, 1, 5, dtype=np.float32)
+    data = np.zeros((lat.size, lon.size), dtype=np.float32)
+    data[1:3, 2:8] = 1.
+    data[3, 5] = 6.
+    K = Field('K', data.copy(), lon, lat)
+    pset = ParticleSet.from_field(grid, size=npart, pclass=JITParticle, start_field=K,
+                                  mode=sampling)
+    # The start field is not normalised in place
+    assert np.allclose(K.data[0, :, :], data)
+    # Jitter keeps particles closest to the vertex of the cell they were drawn from
+    counts = pset.density(field=K, area_scale=False).T
+    assert counts.sum() == npart
+    assert counts[data == 0].sum() == 0
+    expected = npart * data / data.sum()
+    tolerance = 1. if sampling == 'stratified' else 0.05 * npart
+    assert np.abs(counts - expected).max() <= tolerance
+
+
 @pytest.mark.parametrize('mode', ['scipy', 'jit'])
 def test_pset_access(grid, mode, npart=100):
     lon = np.linspace(0, 1, npart, dtype=np.float32)
@@ -156,6 +179,44 @@ def test_pset_remove_index(grid, mode, npart=100):
     assert(pset.size == 0)
 
 
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+def test_pset_access_after_remove(grid, mode, npart=100):
+    lon = np.linspace(0, 1, npart, dtype=np.float32)
+    lat = np.linspace(1, 0, npart, dtype=np.float32)
+    pset = ParticleSet(grid, lon=lon, lat=lat, pclass=ptype[mode])
+    pset.remove(list(range(0, npart, 3)))
+    remaining = [i for i in range(npart) if i % 3 != 0]
+    assert np.allclose([pset[i].lon for i in range(len(pset))], lon[remaining])
+    assert np.allclose([p.lat for p in pset[-2:]], lat[remaining[-2:]])
+    # Live slots are only recomputed after the next change
+    assert pset._live_slots() is pset._live_slots()
+    pset[0] = pset[-1]
+    assert pset[0].lon == lon[remaining[-1]]
+
+
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+def test_pset_add_remove_interleaved(grid, mode, npart=100):
+    def MoveEast(particle, grid, time, dt):
+        particle.lon += 0.001
+
+    pset = ParticleSet(grid, lon=[], lat=[], pclass=ptype[mode])
+    removed = []
+    for i in range(npart):
+        pset.add(ptype[mode](lon=0.5, lat=i / float(npart), grid=grid))
+        if i % 3 == 2:
+            removed.append(pset.remove(0))
+        pset.execute(pset.Kernel(MoveEast), starttime=0., endtime=1., dt=1.)
+    assert pset.size == npart - len(removed)
+    # Removed particles are no longer advected and retain their state
+    ids = [p.id for p in removed]
+    assert all([p.id not in ids for p in pset])
+    assert all([p.lon < 0.5 + 0.001 * npart for p in removed])
+    # Particles are advected once for each execution since being added
+    lats = np.array([p.lat for p in pset])
+    nsteps = npart - np.round(lats * npart)
+    assert np.allclose([p.lon for p in pset], 0.5 + 0.001 * nsteps, rtol=1e-5)
+
+
 @pytest.mark.xfail(reason="Particle removal has not been implemented yet")
 @pytest.mark.parametrize('mode', ['scipy', 'jit'])
 def test_pset_remove_particle(grid, mode, npart=100):
@@ -211,6 +272,94 @@ def test_pset_multi_execute_delete(grid, mode, npart=10, n=5):
     assert np.allclose([p.lat - n*0.1 for p in pset], np.zeros(npart - n), rtol=1e-12)
 
 
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+def test_pset_checkpoint_restart(grid, mode, tmpdir, npart=10):
+    def MoveNorth(particle, grid, time, dt):
+        particle.lat += 0.01
+
+    lon = np.linspace(0, 1, npart, dtype=np.float32)
+    lat = np.zeros(npart, dtype=np.float32)
+    checkpoint = ParticleCheckpoint(tmpdir.join('pset').strpath, interval=2.)
+    pset = ParticleSet(grid, pclass=ptype[mode], lon=lon, lat=lat)
+    pset.execute(pset.Kernel(MoveNorth), starttime=0., endtime=5., dt=1., interval=1.,
+                 checkpoint=checkpoint)
+    ids = [p.id for p in pset]
+
+    restart = ParticleSet.from_checkpoint(grid, ptype[mode], checkpoint)
+    assert restart.restart['time'] == 5.
+    assert [p.id for p in restart] == ids
+    assert np.allclose([p.lat for p in restart], 0.05, rtol=1e-5)
+    restart.execute(restart.Kernel(MoveNorth), endtime=10., dt=1.)
+    assert np.allclose([p.time for p in restart], 10.)
+    assert np.allclose([p.lat for p in restart], 0.1, rtol=1e-5)
+
+
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+def test_pset_checkpoint_resume(grid, mode, tmpdir, npart=10):
+    """An interrupted run is resumed without arguments and matches the uninterrupted run"""
+    def MoveNorthTimed(particle, grid, time, dt):
+        particle.lat += 0.001 * dt * (1. + time)
+
+    lon = np.linspace(0, 1, npart, dtype=np.float32)
+    lat = np.zeros(npart, dtype=np.float32)
+    full = ParticleSet(grid, pclass=ptype[mode], lon=lon, lat=lat)
+    full.execute(full.Kernel(MoveNorthTimed), starttime=0., endtime=10., dt=0.5, interval=2.)
+
+    # Checkpoint of a run until 10 that was interrupted at 4
+    checkpoint = ParticleCheckpoint(tmpdir.join('pset').strpath)
+    pset = ParticleSet(grid, pclass=ptype[mode], lon=lon, lat=lat)
+    pset.execute(pset.Kernel(MoveNorthTimed), starttime=0., endtime=4., dt=0.5, interval=2.)
+    checkpoint.write(pset, 4., endtime=10., dt=0.5, interval=2.)
+
+    restart = ParticleSet.from_checkpoint(grid, ptype[mode], checkpoint)
+    restart.execute(restart.Kernel(MoveNorthTimed))
+    assert restart.restart is None
+    assert np.allclose([p.time for p in restart], 10.)
+    assert np.allclose([p.dt for p in restart], 0.5)
+    assert np.allclose([p.lat for p in restart], [p.lat for p in full], rtol=1e-6)
+
+
+@pytest.mark.parametrize('type', ['array', 'indexed'])
+def test_pset_execute_leap_buffer(grid, type, tmpdir, npart=10):
+    """Compare output of buffered multi-leap execution with per-leap execution"""
+    def MoveEastDelete(particle, grid, time, dt):
+        particle.lon += 0.01
+        if particle.lon > 0.95:
+            particle.delete()
+
+    lon = np.linspace(0.05, 0.25 if type == 'array' else 0.9, npart, dtype=np.float32)
+    lat = np.linspace(0.5, 0.5, npart, dtype=np.float32)
+    results = []
+    for leap_buffer in [None, 8, 30]:
+        pset = ParticleSet(grid, pclass=JITParticle, lon=lon, lat=lat)
+        kernel = pset.Kernel(MoveEastDelete)
+        calls = []
+        execute_leaps = kernel.execute_leaps
+
+        def count_calls(*args, **kwargs):
+            calls.append(execute_leaps(*args, **kwargs))
+            return calls[-1]
+        kernel.execute_leaps = count_calls
+        filename = tmpdir.join('pset%s' % leap_buffer).strpath
+        output_file = pset.ParticleFile(name=filename, type=type)
+        pset.execute(kernel, starttime=0., endtime=30., dt=1., interval=1.,
+                     output_file=output_file, leap_buffer=leap_buffer)
+        if leap_buffer is not None:
+            # Deletions in the middle of a buffer do not interrupt the leaps
+            assert calls == [(min(leap_buffer, 30 - i), min(leap_buffer, 30 - i))
+                             for i in range(0, 30, leap_buffer)]
+        output_file.dataset.sync()
+        results.append(dict((v, output_file.dataset.variables[v][:])
+                            for v in ['trajectory', 'time', 'lon', 'lat']))
+        results[-1]['trajectory'] -= results[-1]['trajectory'].min()
+        results[-1]['plon'] = [p.lon for p in pset]
+    if type == 'indexed':
+        assert len(results[0]['plon']) < npart
+    for result in results[1:]:
+        for v in ['trajectory', 'time', 'lon', 'lat', 'plon']:
+            assert np.allclose(results[0][v], result[v], rtol=1e-12)
+
+
 @pytest.mark.parametrize('mode', ['scipy', 'jit'])
 def test_density(grid, mode, npart=10):
     pset = ParticleSet(grid, pclass=ptype[mode],
@@ -222,3 +371,31 @@ def test_density(grid, mode, npart=10):
     for i in range(len(inds)):  # check locations (low rtol because of coarse grid)
         assert np.allclose(grid.U.lon[inds[i][0]], pset[i].lon, rtol=1e-1)
         assert np.allclose(grid.U.lat[inds[i][1]], pset[i].lat, rtol=1e-1)
+
+
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+def test_density_weighted(grid, mode, npart=500):
+    class WeightedParticle(ptype[mode]):
+        weight = Variable('weight', dtype=np.float32, initial=0.)
+
+    np.random.seed(1234)
+    pset = ParticleSet(grid, pclass=WeightedParticle,
+                       lon=np.random.uniform(0, 1, npart).astype(np.float32),
+                       lat=np.random.uniform(0, 1, npart).astype(np.float32))
+    for i, p in enumerate(pset):
+        p.weight = i % 7
+    # Coarser density field on part of the domain
+    lon = np.linspace(0.2, 0.8, 13, dtype=np.float32)
+    lat = np.linspace(0.1, 0.7, 7, dtype=np.float32)
+    field = Field('density', np.zeros((lat.size, lon.size), dtype=np.float32), lon, lat)
+    expected = np.zeros((lon.size, lat.size), dtype=np.float32)
+    half_lon, half_lat = (lon[1] - lon[0]) / 2, (lat[1] - lat[0]) / 2
+    for p in pset:
+        if lon[0] - half_lon < p.lon < lon[-1] + half_lon and lat[0] - half_lat < p.lat < lat[-1] + half_lat:
+            expected[np.argmin(np.abs(p.lon - lon)), np.argmin(np.abs(p.lat - lat))] += p.weight
+    arr = pset.density(field=field, particle_val='weight', area_scale=False)
+    assert np.allclose(arr, expected)
+    # Accumulating adds to the previous density in place
+    total = pset.density(field=field, particle_val='weight', area_scale=False, accumulate=arr)
+    assert total is arr
+    assert np.allclose(total, 2 * expected)